@@ -0,0 +1,108 @@
+"""
+Benchmark tistel against a synthetic library, without showing anything.
+
+    python -m benchmarks --images 2000 --save-baseline
+    python -m benchmarks --images 2000
+
+Everything the benchmarks write, including the library itself unless
+--library is given, ends up in a temporary directory that is used as
+HOME while they run. The results are compared against the baseline file
+and the exit status is 1 if anything has gotten slower than it allows.
+The baseline is only meaningful on the machine it was saved on.
+"""
+import argparse
+import os
+import sys
+import tempfile
+from pathlib import Path
+from typing import List, Tuple
+
+BASELINE = Path(__file__).resolve().parent / 'baseline.json'
+
+
+def size(text: str) -> Tuple[int, int]:
+    width, _, height = text.partition('x')
+    return int(width), int(height)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    parser.add_argument('--images', type=int, default=1000,
+                        help='How many images to generate')
+    parser.add_argument('--sizes', nargs='+', type=size, metavar='WxH',
+                        default=[(640, 480), (1920, 1080), (1080, 1920)])
+    parser.add_argument('--formats', nargs='+', choices=['png', 'jpg'],
+                        default=['png', 'jpg'])
+    parser.add_argument('--depth', type=int, default=2,
+                        help='How many levels of directories to spread the images over')
+    parser.add_argument('--tags', type=int, default=200,
+                        help='How many different tags to pick from')
+    parser.add_argument('--max-tags-per-image', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--library', type=Path,
+                        help='Use (and generate if empty) the library in this directory')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='How many times to run the whole-library benchmarks')
+    parser.add_argument('--queries', type=int, default=200,
+                        help='How many tag filters to time')
+    parser.add_argument('--tag-batches', type=int, default=100)
+    parser.add_argument('--tag-batch-size', type=int, default=20)
+    parser.add_argument('--thumbnails', type=int, default=200,
+                        help='How many thumbnails to generate')
+    parser.add_argument('--baseline', type=Path, default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Save the results as the new baseline instead of comparing')
+    parser.add_argument('--tolerance', type=float,
+                        help='How much slower than the baseline is still fine, as a fraction')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='tistel-benchmarks-') as temp_dir:
+        # Set up before tistel is imported, since that's when it decides
+        # where the cache and thumbnails go
+        os.environ['HOME'] = temp_dir
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+        from PyQt5 import QtWidgets
+
+        from .library import LibrarySpec, generate_library
+        from .results import (DEFAULT_TOLERANCE, Result, find_regressions,
+                              format_table, load_baseline, save_baseline)
+        from .suite import Suite
+
+        app = QtWidgets.QApplication(sys.argv[:1])
+        library = args.library or Path(temp_dir) / 'library'
+        if not library.exists() or not any(library.iterdir()):
+            print(f'Generating {args.images} images in {library}...', flush=True)
+            generate_library(library, LibrarySpec(
+                images=args.images, sizes=args.sizes, formats=args.formats, depth=args.depth,
+                tag_pool=args.tags, max_tags_per_image=args.max_tags_per_image,
+                seed=args.seed))
+        suite = Suite([library.resolve()], args.repeat, args.seed)
+        try:
+            results: List[Result] = suite.run(args.queries, args.tag_batches,
+                                              args.tag_batch_size, args.thumbnails)
+        finally:
+            suite.close()
+        del app
+    print(format_table(results))
+    if args.save_baseline:
+        save_baseline(args.baseline, results)
+        print(f'Saved the baseline to {args.baseline}')
+        return 0
+    baseline = load_baseline(args.baseline)
+    if not baseline:
+        print(f'No baseline at {args.baseline} to compare against')
+        return 0
+    regressions = find_regressions(
+        results, baseline,
+        DEFAULT_TOLERANCE if args.tolerance is None else args.tolerance)
+    if regressions:
+        print('Slower than the baseline:')
+        for regression in regressions:
+            print(f'  {regression}')
+        return 1
+    print('No regressions against the baseline')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,129 @@
+"""
+Synthetic image libraries to benchmark against.
+
+The tags are written straight into the files as XMP dc:subject, the same
+place exiv2 reads them from, so making a big library doesn't have to run
+exiv2 once per image.
+"""
+import random
+import struct
+import zlib
+from pathlib import Path
+from typing import List, NamedTuple, Sequence, Tuple
+from xml.sax.saxutils import escape
+
+from PyQt5 import QtCore, QtGui
+
+_XMP_PNG_KEYWORD = b'XML:com.adobe.xmp'
+_XMP_JPEG_HEADER = b'http://ns.adobe.com/xap/1.0/\x00'
+
+
+class LibrarySpec(NamedTuple):
+    images: int
+    # Image sizes to pick from at random
+    sizes: Sequence[Tuple[int, int]] = ((640, 480), (1920, 1080), (1080, 1920))
+    formats: Sequence[str] = ('png', 'jpg')
+    # How many levels of directories the images are spread out over
+    depth: int = 2
+    dirs_per_level: int = 4
+    tag_pool: int = 200
+    max_tags_per_image: int = 8
+    # Images without any tags, which are common in real libraries
+    untagged_ratio: float = 0.1
+    seed: int = 0
+
+
+def xmp_packet(tags: Sequence[str]) -> bytes:
+    items = ''.join(f'<rdf:li>{escape(tag)}</rdf:li>' for tag in tags)
+    return (
+        '<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>'
+        '<x:xmpmeta xmlns:x="adobe:ns:meta/">'
+        '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+        '<rdf:Description rdf:about="" xmlns:dc="http://purl.org/dc/elements/1.1/">'
+        f'<dc:subject><rdf:Bag>{items}</rdf:Bag></dc:subject>'
+        '</rdf:Description></rdf:RDF></x:xmpmeta>'
+        '<?xpacket end="w"?>'
+    ).encode('utf-8')
+
+
+def _read_length(data: bytes, offset: int, fmt: str = '>I') -> int:
+    length: int = struct.unpack_from(fmt, data, offset)[0]
+    return length
+
+
+def _png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return (struct.pack('>I', len(data)) + chunk_type + data
+            + struct.pack('>I', zlib.crc32(chunk_type + data)))
+
+
+def add_png_xmp(data: bytes, xmp: bytes) -> bytes:
+    # An uncompressed iTXt chunk with no language or translated keyword,
+    # right after IHDR
+    chunk = _png_chunk(b'iTXt', _XMP_PNG_KEYWORD + b'\x00\x00\x00\x00\x00' + xmp)
+    ihdr_end = 8 + 12 + _read_length(data, 8)
+    return data[:ihdr_end] + chunk + data[ihdr_end:]
+
+
+def add_jpeg_xmp(data: bytes, xmp: bytes) -> bytes:
+    payload = _XMP_JPEG_HEADER + xmp
+    segment = b'\xff\xe1' + struct.pack('>H', len(payload) + 2) + payload
+    # After the JFIF segment if there is one, since that has to come first
+    offset = 2
+    if data[2:4] == b'\xff\xe0':
+        offset += 2 + _read_length(data, 4, '>H')
+    return data[:offset] + segment + data[offset:]
+
+
+def encode_image(size: Tuple[int, int], image_format: str, rng: random.Random) -> bytes:
+    image = QtGui.QImage(size[0], size[1], QtGui.QImage.Format_RGB32)
+    # A gradient compresses and decodes more like a photo than a flat color
+    gradient = QtGui.QLinearGradient(0, 0, size[0], size[1])
+    gradient.setColorAt(0, QtGui.QColor.fromHsv(rng.randrange(360), 200, 220))
+    gradient.setColorAt(1, QtGui.QColor.fromHsv(rng.randrange(360), 120, 80))
+    painter = QtGui.QPainter(image)
+    painter.fillRect(image.rect(), gradient)
+    for _ in range(8):
+        painter.fillRect(rng.randrange(size[0]), rng.randrange(size[1]),
+                         rng.randrange(1, size[0] // 2 + 2), rng.randrange(1, size[1] // 2 + 2),
+                         QtGui.QColor.fromHsv(rng.randrange(360), 160, 160))
+    painter.end()
+    data = QtCore.QByteArray()
+    buf = QtCore.QBuffer(data)
+    buf.open(QtCore.QIODevice.WriteOnly)
+    image.save(buf, image_format.upper())
+    return data.data()
+
+
+def generate_library(root: Path, spec: LibrarySpec) -> List[Path]:
+    """Fill root with images as described by spec and return their paths."""
+    rng = random.Random(spec.seed)
+    tag_names = [f'tag{n:04}' for n in range(spec.tag_pool)]
+    # Some tags are a lot more common than others
+    weights = [1 / (n + 1) for n in range(spec.tag_pool)]
+    # Only a handful of different images are encoded, since that is by far
+    # the slowest part, and every file gets its own tags
+    templates = {(size, image_format): encode_image(size, image_format, rng)
+                 for size in spec.sizes for image_format in spec.formats}
+    paths = []
+    for n in range(spec.images):
+        directory = root
+        for _ in range(spec.depth):
+            directory = directory / f'dir{rng.randrange(spec.dirs_per_level)}'
+        directory.mkdir(parents=True, exist_ok=True)
+        size = rng.choice(spec.sizes)
+        image_format = rng.choice(spec.formats)
+        if rng.random() < spec.untagged_ratio:
+            tags: List[str] = []
+        else:
+            tags = sorted(set(rng.choices(tag_names, weights,
+                                          k=rng.randint(1, spec.max_tags_per_image))))
+        data = templates[(size, image_format)]
+        if tags:
+            if image_format == 'png':
+                data = add_png_xmp(data, xmp_packet(tags))
+            else:
+                data = add_jpeg_xmp(data, xmp_packet(tags))
+        path = directory / f'image{n:06}.{image_format}'
+        path.write_bytes(data)
+        paths.append(path)
+    return paths
@@ -0,0 +1,80 @@
+import json
+import math
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Sequence
+
+# How much slower than the baseline a benchmark can be before it counts
+# as a regression, since timings are never exactly the same twice
+DEFAULT_TOLERANCE = 0.2
+
+
+def percentile(samples: Sequence[float], fraction: float) -> float:
+    ordered = sorted(samples)
+    # Nearest rank, which doesn't make up values that were never measured
+    rank = max(1, math.ceil(fraction * len(ordered)))
+    return ordered[rank - 1]
+
+
+class Result(NamedTuple):
+    name: str
+    # How many things (images, queries, ...) each sample handled
+    items_per_sample: int
+    # Seconds per sample
+    samples: List[float]
+
+    @property
+    def throughput(self) -> float:
+        """Items per second over all samples."""
+        total = sum(self.samples)
+        return self.items_per_sample * len(self.samples) / total if total else math.inf
+
+    def summary(self) -> Dict[str, float]:
+        return {'p50': percentile(self.samples, 0.5),
+                'p90': percentile(self.samples, 0.9),
+                'p99': percentile(self.samples, 0.99),
+                'max': max(self.samples),
+                'throughput': self.throughput}
+
+
+def format_table(results: Sequence[Result]) -> str:
+    lines = [f'{"benchmark":<20}{"samples":>8}{"items/s":>12}'
+             f'{"p50 ms":>10}{"p90 ms":>10}{"p99 ms":>10}{"max ms":>10}']
+    for result in results:
+        summary = result.summary()
+        lines.append(f'{result.name:<20}{len(result.samples):>8}'
+                     f'{summary["throughput"]:>12.1f}'
+                     + ''.join(f'{summary[key] * 1000:>10.2f}'
+                               for key in ['p50', 'p90', 'p99', 'max']))
+    return '\n'.join(lines)
+
+
+def load_baseline(path: Path) -> Dict[str, Dict[str, float]]:
+    if not path.exists():
+        return {}
+    baseline: Dict[str, Dict[str, float]] = json.loads(path.read_text())
+    return baseline
+
+
+def save_baseline(path: Path, results: Sequence[Result]) -> None:
+    path.write_text(json.dumps({result.name: result.summary() for result in results},
+                               indent=2, sort_keys=True) + '\n')
+
+
+def find_regressions(results: Sequence[Result], baseline: Dict[str, Dict[str, float]],
+                     tolerance: float = DEFAULT_TOLERANCE) -> List[str]:
+    """
+    Compare the median and p90 of every result against the baseline and
+    describe the ones that have gotten slower by more than tolerance.
+    """
+    regressions = []
+    for result in results:
+        old = baseline.get(result.name)
+        if old is None:
+            continue
+        new = result.summary()
+        for key in ['p50', 'p90']:
+            if new[key] > old[key] * (1 + tolerance):
+                regressions.append(f'{result.name} {key}: {old[key] * 1000:.2f} ms '
+                                   f'-> {new[key] * 1000:.2f} ms '
+                                   f'({new[key] / old[key] - 1:+.0%})')
+    return regressions
@@ -0,0 +1,136 @@
+import random
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, List, Tuple
+
+from PyQt5 import QtWidgets
+
+from tistel.cache import CachedImageData
+from tistel.cache_service import CacheService
+from tistel.image_loading import Indexer, generate_thumbnail, thumbnail_path
+from tistel.path_table import PATHS
+from tistel.settings import Settings
+from tistel.shared import TagState, TagStates
+from tistel.tag_table import TAG_TABLE
+from tistel.thumb_view import ProgressBar, StatusBar, ThumbView, ThumbViewItem
+
+from .results import Result
+
+
+def timed(function: Callable[[], object]) -> float:
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+class Suite:
+    """
+    Runs the indexing, view, filtering, tagging and thumbnail pipelines
+    against a library the same way the GUI does, minus the main window.
+
+    Needs a QApplication, and should be run with HOME pointing somewhere
+    disposable since the cache and thumbnails end up in there.
+    """
+    def __init__(self, roots: List[Path], repeat: int, seed: int = 0) -> None:
+        self.roots = roots
+        self.repeat = repeat
+        self.rng = random.Random(seed)
+        self.cache_service = CacheService()
+        self.cache_service.load()
+        self.indexer = Indexer(self.cache_service)
+        self.parent = QtWidgets.QWidget()
+        self.thumb_view = ThumbView(ProgressBar(self.parent), StatusBar(self.parent),
+                                    Settings(), self.parent)
+        # Thumbnails are benchmarked on their own, without the view's loader
+        # thread getting in the way of everything else
+        self.thumb_view.image_queued.disconnect(self.thumb_view.thumb_loader.load_image)
+        self.entries: List[Tuple[int, CachedImageData]] = []
+
+    def close(self) -> None:
+        self.thumb_view.thumb_loader_thread.quit()
+        self.thumb_view.thumb_loader_thread.wait()
+
+    def _snapshot(self) -> List[Tuple[int, CachedImageData]]:
+        snapshots: List[List[Tuple[int, CachedImageData]]] = []
+        self.cache_service.snapshot_ready.connect(lambda _, entries: snapshots.append(entries))
+        self.cache_service.request_snapshot(0, self.roots)
+        self.cache_service.snapshot_ready.disconnect()
+        return snapshots[0]
+
+    def index_cold(self) -> Result:
+        samples = []
+        for _ in range(self.repeat):
+            self.cache_service.clear()
+            samples.append(timed(lambda: self.indexer.index_images(self.roots, False)))
+        self.entries = self._snapshot()
+        return Result('index cold', len(self.entries), samples)
+
+    def index_warm(self) -> Result:
+        samples = [timed(lambda: self.indexer.index_images(self.roots, False))
+                   for _ in range(self.repeat)]
+        return Result('index warm', len(self.entries), samples)
+
+    def load_index(self) -> Result:
+        samples = [timed(lambda: self.thumb_view.load_index(self.entries, False))
+                   for _ in range(self.repeat)]
+        return Result('load index', len(self.entries), samples)
+
+    def _random_states(self, tag_ids: List[int]) -> TagStates:
+        whitelist = frozenset(self.rng.sample(tag_ids, min(len(tag_ids),
+                                                           self.rng.randint(1, 2))))
+        blacklist = frozenset(self.rng.sample(tag_ids, min(len(tag_ids),
+                                                           self.rng.randint(0, 1)))) - whitelist
+        return TagStates(whitelist, blacklist, TagState.DEFAULT)
+
+    def _filter(self, states: TagStates) -> None:
+        # What the main window does whenever the filter changes
+        self.thumb_view.set_tag_filter(states)
+        self.thumb_view.get_tag_count()
+
+    def filter(self, queries: int) -> Result:
+        tag_ids = list(self.thumb_view.get_tag_count()[1])
+        samples = []
+        for _ in range(queries):
+            states = self._random_states(tag_ids)
+            samples.append(timed(lambda: self._filter(states)))
+        self._filter(TagStates(frozenset(), frozenset(), TagState.DEFAULT))
+        return Result('filter', 1, samples)
+
+    def tag_images(self, batches: int, batch_size: int) -> Result:
+        items: List[ThumbViewItem] = list(self.thumb_view.items())
+        new_tags = [TAG_TABLE.intern(f'benchmark tag {n}') for n in range(8)]
+        states = TagStates(frozenset(new_tags[:1]), frozenset(), TagState.DEFAULT)
+        batch_size = min(batch_size, len(items))
+        samples = []
+        for _ in range(batches):
+            batch = self.rng.sample(items, batch_size)
+            tag = self.rng.choice(new_tags)
+
+            def tag_batch() -> None:
+                # The in-memory part of MainWindow.set_image_tags, which is
+                # what keeps the GUI busy while the files are written
+                for item in batch:
+                    item.tags = item.tags ^ {tag}
+                self.thumb_view.update_tag_index(list(batch))
+                self._filter(states)
+            samples.append(timed(tag_batch))
+        return Result('tag images', batch_size, samples)
+
+    def thumbnails(self, count: int) -> Result:
+        samples = []
+        with tempfile.TemporaryDirectory() as thumb_dir:
+            for image_id, _ in self.entries[:count]:
+                path = PATHS.path(image_id)
+                thumb_path, uri = thumbnail_path(path, Path(thumb_dir))
+                samples.append(timed(lambda: generate_thumbnail(thumb_path, path, uri)))
+        return Result('thumbnails', 1, samples)
+
+    def run(self, queries: int, tag_batches: int, tag_batch_size: int,
+            thumbnails: int) -> List[Result]:
+        return [self.index_cold(),
+                self.index_warm(),
+                self.load_index(),
+                self.filter(queries),
+                self.tag_images(tag_batches, tag_batch_size),
+                self.thumbnails(thumbnails)]
@@ -12,10 +12,13 @@ setuptools.setup(
     include_package_data=True,
     long_description=long_description,
     long_description_content_type="text/markdown",
-    packages=setuptools.find_packages(),
+    packages=setuptools.find_packages(exclude=['benchmarks']),
     entry_points={
         'gui_scripts': [
             'tistel=tistel.tistel:main'
+        ],
+        'console_scripts': [
+            'tistel-index=tistel.headless:main'
         ]
     },
 )
@@ -0,0 +1,55 @@
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import List
+
+import pytest
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PyQt5 import QtGui, QtWidgets  # noqa: E402
+
+from tistel.image_view import ImagePreview  # noqa: E402
+
+pytestmark = pytest.mark.skipif(shutil.which('exiv2') is None,
+                                reason='loading images needs exiv2')
+
+
+@pytest.fixture(scope='module')
+def app() -> QtWidgets.QApplication:
+    return QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+
+def make_images(directory: Path, count: int) -> List[Path]:
+    paths = []
+    for n in range(count):
+        image = QtGui.QImage(4000, 3000, QtGui.QImage.Format_RGB32)
+        image.fill(QtGui.QColor.fromHsv(n * 60, 200, 200))
+        path = directory / f'{n}.jpg'
+        assert image.save(str(path))
+        paths.append(path)
+    return paths
+
+
+def test_prefetched_neighbours_are_cached(app: QtWidgets.QApplication, tmp_path: Path) -> None:
+    paths = make_images(tmp_path, 5)
+    parent = QtWidgets.QWidget()
+    preview = ImagePreview(parent)
+    preview.resize(800, 600)
+    try:
+        preview.load_image(paths[0], None)
+        preview.prefetch(paths[1:])
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline \
+                and not all(path in preview.image_cache for path in paths):
+            app.processEvents()
+            time.sleep(0.01)
+        assert [path for path in paths if path not in preview.image_cache] == []
+        # The current image was shown and not just cached
+        assert preview.image_path == paths[0]
+    finally:
+        preview.loader_thread.quit()
+        preview.tile_loader_thread.quit()
+        preview.loader_thread.wait()
+        preview.tile_loader_thread.wait()
@@ -0,0 +1,35 @@
+from typing import Counter
+
+from tistel.tag_cooccurrence import TagCooccurrence
+from tistel.tag_index import TagIndex
+
+A, B, C = 0, 1, 2
+
+
+def test_removing_a_tag_from_an_image() -> None:
+    index = TagIndex()
+    index.build([(A, B), (A,)])
+    cooccurrence = TagCooccurrence(index)
+    assert cooccurrence.row(A) == Counter({B: 1})
+    old_tags = index.row_tags[0]
+    index.set_row_tags(0, {B})
+    cooccurrence.update(old_tags, {B})
+    assert cooccurrence.row(A) == Counter()
+    assert cooccurrence.row(B) == Counter()
+    assert cooccurrence.related(Counter({A: 1}), {A}) == []
+
+
+def test_updated_rows_match_fresh_ones() -> None:
+    index = TagIndex()
+    index.build([(A, B), (A, B, C), (C,)])
+    cooccurrence = TagCooccurrence(index)
+    for tag in [A, B, C]:
+        cooccurrence.row(tag)
+    for row, new_tags in [(1, {A}), (0, {B, C}), (2, {A, C})]:
+        old_tags = index.row_tags[row]
+        index.set_row_tags(row, new_tags)
+        cooccurrence.update(old_tags, new_tags)
+    fresh = TagCooccurrence(index)
+    for tag in [A, B, C]:
+        assert cooccurrence.row(tag) == fresh.row(tag)
+        assert dict(cooccurrence.top(tag)) == dict(fresh.top(tag))
@@ -0,0 +1,2 @@
+# Imported before anything else so that --profile-startup can time the imports
+from .startup_profile import STARTUP_PROFILE  # noqa: F401
@@ -0,0 +1,301 @@
+"""
+The image cache and its file format.
+
+The cache is stored as a binary file laid out in columns:
+
+    header       magic, format version, update time and the counts below
+    directories  string table of parent directories
+    tags         string table of tag names
+    file names   string table with one file name per image
+    columns      directory id, size, width, height, mtime, ctime
+    tag offsets  where each image's tag ids start in the list below
+    tag ids      every image's tag ids, one after the other
+
+A string table is its byte length followed by its strings in UTF-8,
+separated by null bytes. Everything is little-endian.
+"""
+from __future__ import annotations
+
+import json
+import mmap
+import struct
+import sys
+from array import array
+from dataclasses import dataclass
+from pathlib import Path
+from typing import (Any, Dict, Iterator, List, MutableMapping, NamedTuple,
+                    Sequence, Tuple, Union, cast)
+
+from .path_table import PATHS
+from .shared import CACHE, JSON_CACHE
+from .tag_table import TAG_TABLE
+
+MAGIC = b'TISTELCB'
+VERSION = 1
+
+_HEADER = struct.Struct('<8sHd4I')
+_STRING_TABLE_SIZE = struct.Struct('<Q')
+# The array module only promises minimum sizes, so pick the codes that
+# have the right ones here
+_U32 = 'I' if array('I').itemsize == 4 else 'L'
+_I32 = 'i' if array('i').itemsize == 4 else 'l'
+
+
+class CacheError(Exception):
+    pass
+
+
+class CachedImageData(NamedTuple):
+    # Sorted tag ids
+    tags: Tuple[int, ...]
+    size: int
+    w: int
+    h: int
+    mtime: float
+    ctime: float
+
+
+class _Columns:
+    """The images as they were loaded, which never change afterwards."""
+    def __init__(self) -> None:
+        # Tag id in the file -> tag id in the tag table
+        self.tag_map = array(_U32)
+        self.sizes = array('Q')
+        self.widths = array(_I32)
+        self.heights = array(_I32)
+        self.mtimes = array('d')
+        self.ctimes = array('d')
+        self.tag_offsets = array(_U32, [0])
+        self.tag_ids = array(_U32)
+        # Lots of images have the exact same tags, so share those tuples
+        self.tag_sets: Dict[Tuple[int, ...], Tuple[int, ...]] = {}
+
+    def image_tags(self, row: int) -> Tuple[int, ...]:
+        ids = tuple(self.tag_ids[self.tag_offsets[row]:self.tag_offsets[row + 1]])
+        tags = self.tag_sets.get(ids)
+        if tags is None:
+            tag_map = self.tag_map
+            tags = self.tag_sets[ids] = tuple(sorted(tag_map[tag_id] for tag_id in ids))
+        return tags
+
+    def image(self, row: int) -> CachedImageData:
+        return CachedImageData(
+            tags=self.image_tags(row),
+            size=self.sizes[row],
+            w=self.widths[row],
+            h=self.heights[row],
+            mtime=self.mtimes[row],
+            ctime=self.ctimes[row],
+        )
+
+
+class CachedImages(MutableMapping[int, CachedImageData]):
+    """
+    The cached images by image id, kept as the columns they were loaded
+    from and only turned into CachedImageData when asked for.
+
+    Images that are added or changed afterwards are stored as they are.
+    """
+    def __init__(self) -> None:
+        self._columns = _Columns()
+        # Image id -> row in the columns or the image itself
+        self._images: Dict[int, Union[int, CachedImageData]] = {}
+
+    def copy(self) -> CachedImages:
+        images = CachedImages()
+        images._columns = self._columns
+        images._images = self._images.copy()
+        return images
+
+    def __getitem__(self, image_id: int) -> CachedImageData:
+        image = self._images[image_id]
+        if isinstance(image, int):
+            return self._columns.image(image)
+        return image
+
+    def __setitem__(self, image_id: int, image: CachedImageData) -> None:
+        self._images[image_id] = image
+
+    def __delitem__(self, image_id: int) -> None:
+        del self._images[image_id]
+
+    def __contains__(self, image_id: object) -> bool:
+        return image_id in self._images
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._images)
+
+    def __len__(self) -> int:
+        return len(self._images)
+
+    @classmethod
+    def decode(cls, data: memoryview) -> Tuple[float, CachedImages]:
+        reader = _Reader(data)
+        (magic, version, updated, dir_count, tag_count,
+         image_count, tag_id_count) = _HEADER.unpack(reader.take(_HEADER.size))
+        if magic != MAGIC:
+            raise CacheError('not a cache file')
+        if version != VERSION:
+            raise CacheError(f'unsupported cache version: {version}')
+        images = cls()
+        columns = images._columns
+        dir_ids = [PATHS.add_dir(directory) for directory in reader.read_strings(dir_count)]
+        columns.tag_map = array(_U32, [TAG_TABLE.intern(tag)
+                                       for tag in reader.read_strings(tag_count)])
+        names = reader.read_strings(image_count)
+        file_dir_ids = reader.read_array(_U32, image_count)
+        columns.sizes = reader.read_array('Q', image_count)
+        columns.widths = reader.read_array(_I32, image_count)
+        columns.heights = reader.read_array(_I32, image_count)
+        columns.mtimes = reader.read_array('d', image_count)
+        columns.ctimes = reader.read_array('d', image_count)
+        columns.tag_offsets = reader.read_array(_U32, image_count + 1)
+        columns.tag_ids = reader.read_array(_U32, tag_id_count)
+        images._images = {PATHS.add(dir_ids[dir_id], name): row
+                          for row, (dir_id, name)
+                          in enumerate(zip(file_dir_ids, names))}
+        return updated, images
+
+    def encode(self, updated: float) -> bytes:
+        columns = self._columns
+        # Path table dir id -> dir id in the file
+        dir_ids: Dict[int, int] = {}
+        # Tag table id -> tag id in the file
+        tag_ids: Dict[int, int] = {}
+        names: List[str] = []
+        image_dir_ids: List[int] = []
+        tag_offsets = [0]
+        image_tag_ids: List[int] = []
+        numbers: List[Tuple[int, int, int, float, float]] = []
+        # Rows that are still in the columns are copied over as they are,
+        # without making a CachedImageData for them
+        for image_id, image in self._images.items():
+            image_dir_ids.append(dir_ids.setdefault(PATHS.dir_id(image_id), len(dir_ids)))
+            names.append(PATHS.name(image_id))
+            if isinstance(image, int):
+                tags = columns.image_tags(image)
+                numbers.append((columns.sizes[image], columns.widths[image],
+                                columns.heights[image], columns.mtimes[image],
+                                columns.ctimes[image]))
+            else:
+                tags = image.tags
+                numbers.append((image.size, image.w, image.h, image.mtime, image.ctime))
+            image_tag_ids.extend(tag_ids.setdefault(tag, len(tag_ids)) for tag in tags)
+            tag_offsets.append(len(image_tag_ids))
+        sizes, widths, heights, mtimes, ctimes = zip(*numbers) if numbers else ([],) * 5
+        data = bytearray(_HEADER.pack(MAGIC, VERSION, updated, len(dir_ids),
+                                      len(tag_ids), len(names), len(image_tag_ids)))
+        _write_strings(data, [PATHS.directory(dir_id) for dir_id in dir_ids])
+        _write_strings(data, [TAG_TABLE.name(tag_id) for tag_id in tag_ids])
+        _write_strings(data, names)
+        _write_array(data, _U32, image_dir_ids)
+        _write_array(data, 'Q', sizes)
+        _write_array(data, _I32, widths)
+        _write_array(data, _I32, heights)
+        _write_array(data, 'd', mtimes)
+        _write_array(data, 'd', ctimes)
+        _write_array(data, _U32, tag_offsets)
+        _write_array(data, _U32, image_tag_ids)
+        return bytes(data)
+
+
+def _write_array(data: bytearray, typecode: str, values: Sequence[Any]) -> None:
+    column = array(typecode, values)
+    if sys.byteorder == 'big':
+        column.byteswap()
+    data += column.tobytes()
+
+
+def _write_strings(data: bytearray, strings: Sequence[str]) -> None:
+    blob = '\0'.join(strings).encode()
+    data += _STRING_TABLE_SIZE.pack(len(blob))
+    data += blob
+
+
+class _Reader:
+    def __init__(self, data: memoryview) -> None:
+        self.data = data
+        self.pos = 0
+
+    def take(self, size: int) -> memoryview:
+        if self.pos + size > len(self.data):
+            raise CacheError('the cache file is truncated')
+        chunk = self.data[self.pos:self.pos + size]
+        self.pos += size
+        return chunk
+
+    def read_array(self, typecode: str, count: int) -> array[Any]:
+        column = array(typecode)
+        column.frombytes(self.take(count * column.itemsize))
+        if sys.byteorder == 'big':
+            column.byteswap()
+        return column
+
+    def read_strings(self, count: int) -> List[str]:
+        (size,) = _STRING_TABLE_SIZE.unpack(self.take(_STRING_TABLE_SIZE.size))
+        if not count:
+            return []
+        strings = str(self.take(size), 'utf-8').split('\0')
+        if len(strings) != count:
+            raise CacheError(f'expected {count} strings in the cache, found {len(strings)}')
+        return strings
+
+
+@dataclass
+class Cache:
+    updated: float
+    images: CachedImages
+
+    @classmethod
+    def load(cls) -> Cache:
+        """
+        Load the cache, falling back on the old JSON cache if there's no
+        binary one yet.
+        """
+        if not CACHE.exists() and JSON_CACHE.exists():
+            return cls.load_json(JSON_CACHE)
+        with CACHE.open('rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            view = memoryview(data)
+            try:
+                updated, images = CachedImages.decode(view)
+            finally:
+                view.release()
+        return Cache(updated=updated, images=images)
+
+    def save(self) -> None:
+        if not CACHE.parent.exists():
+            CACHE.parent.mkdir(parents=True)
+        # Write to a separate file first so a crash can't leave half a cache
+        tmp_path = CACHE.with_name(CACHE.name + '.tmp')
+        tmp_path.write_bytes(self.images.encode(self.updated))
+        tmp_path.replace(CACHE)
+        if JSON_CACHE.exists():
+            JSON_CACHE.unlink()
+
+    @classmethod
+    def load_json(cls, path: Path) -> Cache:
+        data: Dict[str, Union[float, Dict[str, Union[List[str], int, float]]]] = \
+            json.loads(path.read_text())
+        images = CachedImages()
+        for k, v in cast(Dict[str, Any], data['images']).items():
+            images[PATHS.intern(k)] = CachedImageData(
+                tags=tuple(sorted(TAG_TABLE.intern_all(cast(List[str], v['tags'])))),
+                size=cast(int, v['size']),
+                w=cast(int, v['w']),
+                h=cast(int, v['h']),
+                mtime=cast(float, v['mtime']),
+                ctime=cast(float, v['ctime']),
+            )
+        return Cache(updated=cast(float, data['updated']), images=images)
+
+    def export_json(self, path: Path) -> None:
+        """Write the cache as JSON, mostly for debugging."""
+        path.write_text(json.dumps({
+            'updated': self.updated,
+            'images': {
+                path: {**image._asdict(), 'tags': TAG_TABLE.sorted_names(image.tags)}
+                for path, image in sorted((PATHS.path_string(image_id), image)
+                                          for image_id, image in self.images.items())
+            }
+        }, indent=2))
@@ -0,0 +1,181 @@
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple, cast
+
+from libsyntyche.widgets import Signal0, mk_signal0, mk_signal2
+from PyQt5 import QtCore
+
+from .cache import Cache, CachedImageData, CachedImages
+from .journal import Journal
+from .path_table import PATHS
+from .shared import CACHE, JSON_CACHE
+from .startup_profile import STARTUP_PROFILE
+
+# How long to wait for more changes before saving the cache, in ms
+SAVE_DELAY = 2000
+
+
+class CacheService(QtCore.QObject):
+    """
+    Owns the in-memory cache on its own thread, so that the GUI thread
+    never has to parse or serialize the whole thing.
+
+    Snapshots and updates go through a lock that is only held while the
+    dict itself is copied or changed. Saving happens a little while after
+    the last change, so a burst of changes only writes the file once.
+    """
+    # request id, List[Tuple[int, CachedImageData]] sorted by path
+    snapshot_ready = mk_signal2(int, list)
+    _changed = mk_signal0()
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._lock = threading.Lock()
+        self._loaded = threading.Event()
+        self._cache = Cache(updated=time.time(), images=CachedImages())
+        self._dirty = False
+        self._save_timer: Optional[QtCore.QTimer] = None
+        # Whether the journal was recovered when loading, since until it has
+        # been it holds entries that nothing else may throw away
+        self.recovered = False
+
+    @STARTUP_PROFILE.phase('cache load')
+    def load(self) -> None:
+        """
+        Load the cache from disk after finishing any tag writes that were
+        cut short last time. Anything asking for the cache before this is
+        done waits for it.
+        """
+        # _schedule_save isn't a pyqtSlot, so PyQt connects it through a
+        # proxy object that gets the thread the service is on at the time of
+        # connecting and doesn't follow it if it's moved afterwards. This
+        # runs after the service has been moved to its own thread, so the
+        # save timer ends up there instead of on the GUI thread.
+        self._changed.connect(self._schedule_save)
+        journal = Journal()
+        try:
+            journal.recover()
+        except Exception:
+            # Leave the journal alone so the next start can try again, but
+            # don't keep everything waiting for the cache because of it
+            logging.exception('failed to recover the tag write journal')
+        else:
+            self.recovered = True
+        if CACHE.exists() or JSON_CACHE.exists():
+            try:
+                cache = Cache.load()
+            except Exception:
+                logging.exception('failed to load the cache')
+                cache = Cache(updated=time.time(), images=CachedImages())
+        else:
+            cache = Cache(updated=time.time(), images=CachedImages())
+        with self._lock:
+            # The cache might have been cleared while it was loading
+            if not self._loaded.is_set():
+                self._cache = cache
+                self._loaded.set()
+        if self.recovered:
+            if self.apply_journal(journal):
+                self.flush()
+            journal.checkpoint()
+
+    def snapshot(self) -> CachedImages:
+        """
+        Return a copy of the cached images. The entries themselves are
+        shared, but they are only ever replaced and never changed.
+        """
+        self._loaded.wait()
+        with self._lock:
+            return self._cache.images.copy()
+
+    def request_snapshot(self, request_id: int, root_paths: Iterable[Path]) -> None:
+        """Send the ids of the cached images under root_paths that still exist."""
+        self.snapshot_ready.emit(request_id, self._snapshot_entries(root_paths))
+
+    @STARTUP_PROFILE.phase('cache snapshot')
+    def _snapshot_entries(self, root_paths: Iterable[Path]
+                          ) -> List[Tuple[int, CachedImageData]]:
+        roots = [str(root).rstrip(os.sep) + os.sep for root in root_paths]
+        images = self.snapshot()
+        # Whether each directory is under one of the roots
+        dirs_in_roots: Dict[int, bool] = {}
+        entries: List[Tuple[int, CachedImageData]] = []
+        missing: List[int] = []
+        for path, image_id in sorted((PATHS.path_string(image_id), image_id)
+                                     for image_id in images):
+            if not os.path.exists(path):
+                missing.append(image_id)
+                continue
+            dir_id = PATHS.dir_id(image_id)
+            in_roots = dirs_in_roots.get(dir_id)
+            if in_roots is None:
+                directory = PATHS.directory(dir_id) + os.sep
+                in_roots = dirs_in_roots[dir_id] = \
+                    any(directory.startswith(root) for root in roots)
+            if in_roots:
+                entries.append((image_id, images[image_id]))
+        if missing:
+            with self._lock:
+                for image_id in missing:
+                    self._cache.images.pop(image_id, None)
+            self._mark_changed()
+        return entries
+
+    def update_images(self, images: Dict[int, CachedImageData]) -> None:
+        if not images:
+            return
+        self._loaded.wait()
+        with self._lock:
+            self._cache.images.update(images)
+        self._mark_changed()
+
+    def apply_journal(self, journal: Journal) -> bool:
+        """Bring the cache up to date with the finished writes in journal."""
+        self._loaded.wait()
+        with self._lock:
+            applied = journal.apply(self._cache)
+        if applied:
+            self._mark_changed()
+        return applied
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache = Cache(updated=time.time(), images=CachedImages())
+            self._dirty = False
+            self._loaded.set()
+            for path in [CACHE, JSON_CACHE]:
+                if path.exists():
+                    path.unlink()
+
+    def flush(self) -> None:
+        """Save the cache right away if it has unsaved changes."""
+        if self._save_timer is not None:
+            self._save_timer.stop()
+        with self._lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            cache = Cache(updated=time.time(), images=self._cache.images.copy())
+        try:
+            cache.save()
+        except Exception:
+            logging.exception('failed to save the cache')
+
+    def _mark_changed(self) -> None:
+        with self._lock:
+            self._dirty = True
+        # Goes through a signal so the timer is always started on the
+        # service's own thread, wherever the change came from
+        self._changed.emit()
+
+    def _schedule_save(self) -> None:
+        if self._save_timer is None:
+            self._save_timer = QtCore.QTimer(self)
+            self._save_timer.setSingleShot(True)
+            self._save_timer.setInterval(SAVE_DELAY)
+            cast(Signal0, self._save_timer.timeout).connect(self.flush)
+        if not self._save_timer.isActive():
+            self._save_timer.start()
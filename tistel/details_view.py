@@ -1,10 +1,11 @@
-from typing import Optional
+from typing import List, Optional, Tuple
 
 from PyQt5 import QtWidgets
 from PyQt5.QtCore import Qt
 
 from . import jfti
-from .shared import IconWidget, ImageData, clear_layout, human_filesize
+from .shared import IconWidget, ImageData, human_filesize
+from .tag_table import TAG_TABLE
 
 
 class DetailsBox(QtWidgets.QScrollArea):
@@ -27,6 +28,9 @@ class DetailsBox(QtWidgets.QScrollArea):
         self.dimensions = QtWidgets.QLabel(self)
         layout.addWidget(self.dimensions)
         self.tag_box = QtWidgets.QGridLayout()
+        # The tag rows are reused between images and only hidden when
+        # they're not needed, since making new ones is slow
+        self.tag_rows: List[Tuple[IconWidget, QtWidgets.QLabel]] = []
         layout.addLayout(self.tag_box)
         self.fileformat = QtWidgets.QLabel(self)
         self.fileformat.setWordWrap(True)
@@ -40,7 +44,7 @@ class DetailsBox(QtWidgets.QScrollArea):
             self.filename.clear()
             self.filesize.clear()
             self.dimensions.clear()
-            clear_layout(self.tag_box)
+            self.set_tags([])
         else:
             path = image.path
             self.directory.setText(f'<b>Directory:</b> {path.parent}')
@@ -53,12 +57,21 @@ class DetailsBox(QtWidgets.QScrollArea):
             width, height = image.dimensions
             self.dimensions.setText(f'<b>Dimensions:</b> {width} x {height}')
             self.filesize.setText(f'<b>Size:</b> {human_filesize(image.file_size)}')
-            clear_layout(self.tag_box)
-            for n, tag in enumerate(image.tags):
-                tag_icon = IconWidget('tag', 16, self)
-                tag_icon.setObjectName('tag_icon')
-                self.tag_box.addWidget(tag_icon, n, 0)
-                label = QtWidgets.QLabel(tag, self)
-                label.setObjectName('tag')
-                self.tag_box.addWidget(label, n, 1)
+            self.set_tags(TAG_TABLE.sorted_names(image.tags))
             self.update()
+
+    def set_tags(self, tags: List[str]) -> None:
+        while len(self.tag_rows) < len(tags):
+            n = len(self.tag_rows)
+            tag_icon = IconWidget('tag', 16, self)
+            tag_icon.setObjectName('tag_icon')
+            self.tag_box.addWidget(tag_icon, n, 0)
+            label = QtWidgets.QLabel(self)
+            label.setObjectName('tag')
+            self.tag_box.addWidget(label, n, 1)
+            self.tag_rows.append((tag_icon, label))
+        for n, (tag_icon, label) in enumerate(self.tag_rows):
+            if n < len(tags) and label.text() != tags[n]:
+                label.setText(tags[n])
+            tag_icon.setVisible(n < len(tags))
+            label.setVisible(n < len(tags))
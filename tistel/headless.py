@@ -0,0 +1,160 @@
+"""
+tistel-index: update the cache and the thumbnails without the GUI.
+
+This runs the same indexing and thumbnail generation as opening the
+program does, so it can be run from cron or after importing a batch of
+images to have the GUI open on an up-to-date cache.
+"""
+import argparse
+import logging
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from .cache import CachedImageData
+from .path_table import PATHS
+from .shared import THUMBNAILS
+from .trace import TRACE
+
+# ionice's numbers for the scheduling classes
+IONICE_CLASSES = {'best-effort': '2', 'idle': '3'}
+# At most this many seconds between progress lines
+PROGRESS_INTERVAL = 1.0
+
+
+class Progress:
+    """Progress lines on stdout, without flooding it when things go fast."""
+    def __init__(self, text: str, total: int) -> None:
+        self.text = text
+        self.total = total
+        self.count = 0
+        self.last_shown = 0.0
+
+    def advance(self) -> None:
+        self.count += 1
+        now = time.monotonic()
+        if self.count == self.total or now - self.last_shown >= PROGRESS_INTERVAL:
+            self.last_shown = now
+            print(f'{self.text}... ({self.count}/{self.total})', flush=True)
+
+
+def set_io_priority(io_class: str) -> None:
+    try:
+        subprocess.run(['ionice', '-c', IONICE_CLASSES[io_class], '-p', str(os.getpid())],
+                       check=True, stderr=subprocess.PIPE)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logging.warning(f'failed to set the io priority: {e}')
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        prog='tistel-index',
+        description='Update the image cache and thumbnails without opening tistel')
+    parser.add_argument('paths', nargs='*', metavar='path', type=Path,
+                        help='Index these paths instead of the ones in the settings')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='How many images to work on at once (default: %(default)s)')
+    parser.add_argument('--nice', type=int, metavar='n',
+                        help='Add this to the process\'s niceness')
+    parser.add_argument('--ionice', choices=sorted(IONICE_CLASSES),
+                        help='Run with this io scheduling class')
+    parser.add_argument('--no-thumbnails', action='store_true',
+                        help='Only update the cache')
+    parser.add_argument('--regenerate-thumbnails', action='store_true',
+                        help='Make new thumbnails even for the images that have one')
+    parser.add_argument('--trace', metavar='path', type=Path,
+                        help='Time the indexing and thumbnail stages and write '
+                             'them to this path as a Chrome trace')
+    logging.basicConfig()
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error('--jobs has to be at least 1')
+    if args.nice is not None:
+        os.nice(args.nice)
+    if args.ionice is not None:
+        set_io_priority(args.ionice)
+    if args.trace is not None:
+        TRACE.enable()
+
+    # The thumbnails need a QGuiApplication, but not a display
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt5 import QtGui
+
+    from .cache_service import CacheService
+    from .image_loading import (find_images, generate_thumbnail, is_cached,
+                                read_image_data, thumbnail_path)
+    from .settings import Settings
+
+    app = QtGui.QGuiApplication(sys.argv[:1])
+    config = Settings.load(args.paths or None)
+    root_paths = config.active_paths
+    if not root_paths:
+        parser.error('no paths given and none in the settings')
+
+    print('Loading cache...', flush=True)
+    cache_service = CacheService()
+    cache_service.load()
+    cached_images = cache_service.snapshot()
+
+    print('Searching for images...', flush=True)
+    with TRACE.span('discovery'):
+        image_paths = list(find_images(root_paths))
+    print(f'Found {len(image_paths)} images', flush=True)
+
+    def index_image(path: Path) -> Optional[Tuple[int, CachedImageData]]:
+        with TRACE.span('stat'):
+            stat = path.stat()
+        if is_cached(path, stat, cached_images):
+            TRACE.count('index cache hits')
+            return None
+        TRACE.count('index cache misses')
+        data = read_image_data(path, stat)
+        return None if data is None else (PATHS.intern(path), data)
+
+    new_images: Dict[int, CachedImageData] = {}
+    progress = Progress('Indexing images', len(image_paths))
+    with ThreadPoolExecutor(args.jobs) as pool:
+        with TRACE.span('indexing'):
+            for result in pool.map(index_image, image_paths):
+                progress.advance()
+                if result is not None:
+                    new_images[result[0]] = result[1]
+        print(f'Updating cache with {len(new_images)} new or changed images...', flush=True)
+        with TRACE.span('cache update'):
+            cache_service.update_images(new_images)
+            cache_service.flush()
+
+        if not args.no_thumbnails:
+            if not THUMBNAILS.exists():
+                THUMBNAILS.mkdir(parents=True)
+
+            def make_thumbnail(path: Path) -> bool:
+                with TRACE.span('thumbnail'):
+                    thumb_path, uri = thumbnail_path(path)
+                    if not args.regenerate_thumbnails and thumb_path.is_file():
+                        TRACE.count('thumbnail cache hits')
+                        return True
+                    TRACE.count('thumbnail cache misses')
+                    return generate_thumbnail(thumb_path, path, uri)
+
+            failed: List[Path] = []
+            progress = Progress('Generating thumbnails', len(image_paths))
+            for path, success in zip(image_paths, pool.map(make_thumbnail, image_paths)):
+                progress.advance()
+                if not success:
+                    failed.append(path)
+            for path in failed:
+                print(f'Failed to make a thumbnail for {path}', flush=True)
+    del app
+    if args.trace is not None:
+        TRACE.save(args.trace)
+    print('Done', flush=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,21 +1,34 @@
-import hashlib
 import logging
+import os
 import struct
-import subprocess
-import time
 import zlib
+from collections import OrderedDict
 from pathlib import Path
-from typing import Dict, Iterable, List, Optional, Tuple, cast
+from typing import (Dict, Generic, Iterable, Iterator, List, Mapping,
+                    NamedTuple, Optional, Tuple, TypeVar, cast)
 from urllib.parse import quote
 
-from libsyntyche.widgets import mk_signal1, mk_signal3
+from libsyntyche.widgets import mk_signal1, mk_signal2, mk_signal3
 from PyQt5 import QtCore, QtGui
 from PyQt5.QtCore import Qt
 
 from . import jfti
-from .shared import CACHE, THUMBNAILS, Cache, CachedImageData
+from .cache import CachedImageData
+from .cache_service import CacheService
+from .path_table import PATHS
+from .shared import THUMBNAILS
+from .startup_profile import STARTUP_PROFILE
+from .tag_table import TAG_TABLE
+from .trace import TRACE
 
 THUMB_SIZE = QtCore.QSize(192, 128)
+# The size of a zoom tile, in pixels at the tile's level of detail
+TILE_SIZE = 512
+# The most pixels a whole zoom level is decoded at for formats that can't
+# decode only part of an image. Past that the normal preview has to do.
+MAX_LEVEL_PIXELS = 32 * 1024 ** 2
+
+K = TypeVar('K')
 
 
 def set_rotation(orientation: int) -> QtGui.QTransform:
@@ -33,15 +46,52 @@ def set_rotation(orientation: int) -> QtGui.QTransform:
 
 
 def extract_metadata(path: Path) -> Tuple[List[str], Tuple[int, int]]:
+    TRACE.count('exiv2 calls', 2)
     try:
-        tags = sorted(jfti.read_tags(path))
+        with TRACE.span('exiv2 tags'):
+            tags = sorted(jfti.read_tags(path))
     except Exception:
         logging.exception(f'getting metadata failed in file {path!r}')
         raise
-    size = jfti.dimensions(path)
+    with TRACE.span('exiv2 dimensions'):
+        size = jfti.dimensions(path)
     return tags, size
 
 
+def find_images(root_paths: Iterable[Path]) -> Iterator[Path]:
+    for root_path in root_paths:
+        for path in root_path.rglob('**/*'):
+            if path.suffix.lower() in jfti.IMAGE_EXTS:
+                yield path
+
+
+def is_cached(path: Path, stat: os.stat_result,
+              cached_images: Mapping[int, CachedImageData]) -> bool:
+    image_id = PATHS.lookup(path)
+    cached = cached_images.get(image_id) if image_id is not None else None
+    return cached is not None and stat.st_mtime == cached.mtime \
+        and stat.st_size == cached.size
+
+
+def read_image_data(path: Path, stat: os.stat_result) -> Optional[CachedImageData]:
+    """Read what the cache needs to know about an image, or None if that fails."""
+    try:
+        tags, (width, height) = extract_metadata(path)
+    except OSError:
+        return None
+    except Exception:
+        logging.exception(f'failed to index image {path!r}')
+        return None
+    return CachedImageData(
+        tags=tuple(sorted(TAG_TABLE.intern_all(tags))),
+        size=stat.st_size,
+        w=width,
+        h=height,
+        mtime=stat.st_mtime,
+        ctime=stat.st_ctime
+    )
+
+
 def png_text_chunk(name: bytes, text: bytes) -> bytes:
     header_and_data = b'tEXt%s\x00%s' % (name, text)
     length = struct.pack('>I', len(header_and_data) - 4)
@@ -68,9 +118,12 @@ def try_to_load_image(path: Path
     return None, None
 
 
+@TRACE.span('exiv2 orientation')
 def try_to_get_orientation(path: Path) -> Optional[int]:
     if not path.exists():
         return None
+    import subprocess
+    TRACE.count('exiv2 calls')
     try:
         text = subprocess.check_output(['exiv2', '-P', 'v',
                                         '-K', 'Exif.Image.Orientation', str(path)],
@@ -89,25 +142,160 @@ def try_to_get_orientation(path: Path) -> Optional[int]:
     return None
 
 
+class PreviewImage(NamedTuple):
+    path: Path
+    image: QtGui.QImage
+    # The size of the whole image after rotation, regardless of how big
+    # the decoded image is
+    full_size: QtCore.QSize
+    # Anything other than 1 means it's an animation and image is null, with
+    # 0 meaning that it isn't known how many frames it has
+    frame_count: int = 1
+
+
+def load_preview_image(path: Path, max_size: Optional[QtCore.QSize] = None
+                       ) -> PreviewImage:
+    reader = QtGui.QImageReader(str(path))
+    if path.suffix.lower() == '.gif' and reader.supportsAnimation():
+        # Counting the frames can mean going through the whole file, so it
+        # has to be done here and not when the image is shown
+        frame_count = reader.imageCount()
+        if frame_count != 1:
+            return PreviewImage(path, QtGui.QImage(), reader.size(), frame_count)
+    transform: Optional[QtGui.QTransform] = None
+    orientation = try_to_get_orientation(path)
+    if orientation:
+        transform = set_rotation(orientation)
+    full_size = reader.size()
+    if transform is not None and orientation in {6, 8}:
+        full_size.transpose()
+    if max_size is not None and full_size.isValid() \
+            and (full_size.width() > max_size.width()
+                 or full_size.height() > max_size.height()):
+        # Let the decoder do the downscaling, which is a lot cheaper than
+        # decoding the whole thing and scaling it afterwards
+        scaled_size = full_size.scaled(max_size, Qt.KeepAspectRatio)
+        if transform is not None and orientation in {6, 8}:
+            scaled_size.transpose()
+        reader.setScaledSize(scaled_size)
+    image = reader.read()
+    if not image.isNull() and transform is not None and not transform.isIdentity():
+        image = image.transformed(transform)
+    if not full_size.isValid():
+        full_size = image.size()
+    return PreviewImage(path, image, full_size)
+
+
+class TileKey(NamedTuple):
+    path: Path
+    # The image is scaled down by 2**level
+    level: int
+    column: int
+    row: int
+
+
+def orientation_transform(orientation: Optional[int], size: QtCore.QSize
+                          ) -> QtGui.QTransform:
+    # Like set_rotation, but maps straight from file coordinates to
+    # rotated image coordinates without going negative
+    transform = set_rotation(orientation or 1)
+    rect = transform.mapRect(QtCore.QRectF(QtCore.QPointF(0, 0), QtCore.QSizeF(size)))
+    return QtGui.QTransform(transform.m11(), transform.m12(),
+                            transform.m21(), transform.m22(),
+                            -rect.x(), -rect.y())
+
+
+def tile_rect(level: int, column: int, row: int, full_size: QtCore.QSize) -> QtCore.QRect:
+    span = TILE_SIZE << level
+    return QtCore.QRect(column * span, row * span, span, span).intersected(
+        QtCore.QRect(QtCore.QPoint(0, 0), full_size))
+
+
+def scale_down(size: QtCore.QSize, level: int) -> QtCore.QSize:
+    step = 1 << level
+    return QtCore.QSize(max(1, (size.width() + step - 1) // step),
+                        max(1, (size.height() + step - 1) // step))
+
+
+def load_tiles(key: TileKey, orientation: Optional[int],
+               level_image: Optional[QtGui.QImage] = None
+               ) -> Tuple[List[Tuple[TileKey, QtGui.QImage]], Optional[QtGui.QImage]]:
+    """
+    Load the tile for key. If the whole level had to be decoded for it,
+    that is returned as well, and can be passed back in as level_image to
+    cut out the level's other tiles without decoding it again.
+    """
+    if level_image is not None:
+        return [(key, level_image.copy(key.column * TILE_SIZE, key.row * TILE_SIZE,
+                                       TILE_SIZE, TILE_SIZE))], level_image
+    reader = QtGui.QImageReader(str(key.path))
+    raw_size = reader.size()
+    if not raw_size.isValid():
+        return [], None
+    rotation = set_rotation(orientation or 1)
+    to_image = orientation_transform(orientation, raw_size)
+    full_size = to_image.mapRect(QtCore.QRect(QtCore.QPoint(0, 0), raw_size)).size()
+    if reader.supportsOption(QtGui.QImageIOHandler.ClipRect):
+        rect = tile_rect(key.level, key.column, key.row, full_size)
+        raw_rect = to_image.inverted()[0].mapRect(rect)
+        reader.setClipRect(raw_rect)
+        reader.setScaledSize(scale_down(raw_rect.size(), key.level))
+        image = reader.read()
+        if image.isNull():
+            return [], None
+        return [(key, image.transformed(rotation))], None
+    # If the format can't decode parts of the image, the whole level has to
+    # be decoded, unless it's too big to keep memory use in check
+    level_size = scale_down(raw_size, key.level)
+    if level_size.width() * level_size.height() > MAX_LEVEL_PIXELS:
+        return [], None
+    reader.setScaledSize(level_size)
+    image = reader.read()
+    if image.isNull():
+        return [], None
+    return load_tiles(key, orientation, image.transformed(rotation))
+
+
+def thumbnail_pixmap(icon: QtGui.QIcon) -> QtGui.QPixmap:
+    pixmap = icon.pixmap(THUMB_SIZE)
+    # Thumbnails are padded with transparency to fit THUMB_SIZE, so crop
+    # that away to get something with the same shape as the real image
+    rect = QtGui.QRegion(pixmap.mask()).boundingRect()
+    if rect.isEmpty():
+        return pixmap
+    return pixmap.copy(rect)
+
+
+def thumbnail_path(image_path: Path, directory: Path = THUMBNAILS) -> Tuple[Path, bytes]:
+    """Where the thumbnail for image_path goes, and the URI it's named after."""
+    import hashlib
+    uri = b'file://' + quote(str(image_path)).encode()
+    return directory / (hashlib.md5(uri).hexdigest() + '.png'), uri
+
+
 def generate_thumbnail(thumb_path: Path, image_path: Path,
                        uri_path: bytes) -> bool:
     pngbytes = QtCore.QByteArray()
     buf = QtCore.QBuffer(pngbytes)
-    pixmap, img_format = try_to_load_image(image_path)
+    # For animations this is the first frame
+    with TRACE.span('decode'):
+        pixmap, img_format = try_to_load_image(image_path)
     if pixmap is None:
         return False
     # Rotate the thumbnail
     orientation = try_to_get_orientation(image_path)
-    if orientation:
-        transform = set_rotation(orientation)
-        if not transform.isIdentity():
-            pixmap = pixmap.transformed(transform)
-    scaled_pixmap = pixmap.scaled(THUMB_SIZE,
-                                  aspectRatioMode=QtCore.Qt.KeepAspectRatio,
-                                  transformMode=QtCore.Qt.SmoothTransformation)
-    # Get rid of potentially broked ICCP data by copying the pixel data
-    p2 = scaled_pixmap.copy()
-    p2.save(buf, 'PNG')
+    with TRACE.span('scale'):
+        if orientation:
+            transform = set_rotation(orientation)
+            if not transform.isIdentity():
+                pixmap = pixmap.transformed(transform)
+        scaled_pixmap = pixmap.scaled(THUMB_SIZE,
+                                      aspectRatioMode=QtCore.Qt.KeepAspectRatio,
+                                      transformMode=QtCore.Qt.SmoothTransformation)
+        # Get rid of potentially broked ICCP data by copying the pixel data
+        p2 = scaled_pixmap.copy()
+    with TRACE.span('PNG encode'):
+        p2.save(buf, 'PNG')
     data = pngbytes.data()
     # let's figure out where to insert our P-P-P-PAYLOAD *obnoxious air horns*
     offset = 8
@@ -118,8 +306,9 @@ def generate_thumbnail(thumb_path: Path, image_path: Path,
     uri = png_text_chunk(b'Thumb::URI', uri_path)
     software = png_text_chunk(b'Software', b'imgview')
     data = data[:offset] + mtime + uri + software + data[offset:]
-    thumb_path.write_bytes(data)
-    thumb_path.chmod(0o600)
+    with TRACE.span('write'):
+        thumb_path.write_bytes(data)
+        thumb_path.chmod(0o600)
     return True
 
 
@@ -135,8 +324,9 @@ class ImageLoader(QtCore.QObject):
         self.base_thumb.fill(Qt.transparent)
         self.fail_icon = QtGui.QIcon(fail_thumb)
         self.fail_icon.addPixmap(fail_thumb, QtGui.QIcon.Selected)
-        self.cached_thumbs: Dict[Path, QtGui.QIcon] = {}
+        self.cached_thumbs: Dict[int, QtGui.QIcon] = {}
 
+    @TRACE.span('load thumbnail')
     def make_thumb(self, path: Path) -> QtGui.QIcon:
         img = self.base_thumb.copy()
         thumb = QtGui.QImage(str(path))
@@ -152,28 +342,112 @@ class ImageLoader(QtCore.QObject):
         return icon
 
     def load_image(self, batch: int,
-                   imgs: Iterable[Tuple[int, bool, Path]]) -> None:
-        for index, skip_cache, path in imgs:
-            if not skip_cache and path in self.cached_thumbs:
+                   imgs: Iterable[Tuple[int, bool, int]]) -> None:
+        for index, skip_cache, image_id in imgs:
+            if not skip_cache and image_id in self.cached_thumbs:
+                TRACE.count('thumbnail cache hits')
                 self.thumbnail_ready.emit(index, batch,
-                                          self.cached_thumbs[path])
+                                          self.cached_thumbs[image_id])
                 continue
-            m = hashlib.md5()
-            uri = b'file://' + quote(str(path)).encode()
-            m.update(uri)
-            thumb_path = self.cache_path / (m.hexdigest() + '.png')
-            if skip_cache or not thumb_path.is_file():
-                success = generate_thumbnail(thumb_path, path, uri)
-                if success:
-                    icon = self.make_thumb(thumb_path)
-                    self.cached_thumbs[path] = icon
+            with TRACE.span('thumbnail'):
+                path = PATHS.path(image_id)
+                thumb_path, uri = thumbnail_path(path, self.cache_path)
+                if skip_cache or not thumb_path.is_file():
+                    TRACE.count('thumbnail cache misses')
+                    success = generate_thumbnail(thumb_path, path, uri)
+                    if success:
+                        icon = self.make_thumb(thumb_path)
+                        self.cached_thumbs[image_id] = icon
+                    else:
+                        icon = self.fail_icon
                 else:
-                    icon = self.fail_icon
-                self.thumbnail_ready.emit(index, batch, icon)
-            else:
-                icon = self.make_thumb(thumb_path)
-                self.cached_thumbs[path] = icon
-                self.thumbnail_ready.emit(index, batch, icon)
+                    TRACE.count('thumbnail cache hits')
+                    icon = self.make_thumb(thumb_path)
+                    self.cached_thumbs[image_id] = icon
+            self.thumbnail_ready.emit(index, batch, icon)
+
+
+class ImageCache(Generic[K]):
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._images: 'OrderedDict[K, QtGui.QImage]' = OrderedDict()
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._images
+
+    def get(self, key: K) -> Optional[QtGui.QImage]:
+        image = self._images.get(key)
+        if image is not None:
+            self._images.move_to_end(key)
+        return image
+
+    def put(self, key: K, image: QtGui.QImage) -> None:
+        old_image = self._images.pop(key, None)
+        if old_image is not None:
+            self.total_bytes -= old_image.sizeInBytes()
+        image_bytes = image.sizeInBytes()
+        if image_bytes > self.max_bytes:
+            return
+        self._images[key] = image
+        self.total_bytes += image_bytes
+        while self.total_bytes > self.max_bytes:
+            _, evicted = self._images.popitem(last=False)
+            self.total_bytes -= evicted.sizeInBytes()
+
+    def clear(self) -> None:
+        self._images.clear()
+        self.total_bytes = 0
+
+
+class PreviewLoader(QtCore.QObject):
+    image_loaded = mk_signal2(int, object)
+    image_prefetched = mk_signal1(object)
+
+    def __init__(self) -> None:
+        super().__init__()
+        # These are set directly from the GUI thread, so that requests that
+        # have been superseded while they were queued can be skipped
+        self.latest_request = 0
+        self.latest_prefetch = 0
+
+    def load_image(self, request_id: int, path: Path, max_size: QtCore.QSize) -> None:
+        if request_id != self.latest_request:
+            return
+        preview = load_preview_image(path, max_size)
+        if request_id == self.latest_request:
+            self.image_loaded.emit(request_id, preview)
+
+    def prefetch_image(self, prefetch_id: int, path: Path, max_size: QtCore.QSize) -> None:
+        if prefetch_id != self.latest_prefetch:
+            return
+        # Once it's been decoded it's worth keeping, even if it's stale
+        self.image_prefetched.emit(load_preview_image(path, max_size))
+
+
+class TileLoader(QtCore.QObject):
+    tiles_loaded = mk_signal1(list)
+
+    def __init__(self) -> None:
+        super().__init__()
+        # Same deal as in PreviewLoader
+        self.latest_request = 0
+        self._orientation: Optional[Tuple[Path, Optional[int]]] = None
+        # The last whole level that was decoded, for formats that can't
+        # decode only one tile
+        self._level: Optional[Tuple[Path, int, QtGui.QImage]] = None
+
+    def load_tile(self, request_id: int, key: TileKey) -> None:
+        if request_id != self.latest_request:
+            return
+        if self._orientation is None or self._orientation[0] != key.path:
+            self._orientation = (key.path, try_to_get_orientation(key.path))
+        level_image = None
+        if self._level is not None and self._level[:2] == (key.path, key.level):
+            level_image = self._level[2]
+        tiles, level_image = load_tiles(key, self._orientation[1], level_image)
+        self._level = None if level_image is None else (key.path, key.level, level_image)
+        self.tiles_loaded.emit(tiles)
 
 
 class Indexer(QtCore.QObject):
@@ -182,21 +456,28 @@ class Indexer(QtCore.QObject):
     set_max = mk_signal1(int)
     done = mk_signal1(bool)
 
+    def __init__(self, cache_service: CacheService) -> None:
+        super().__init__()
+        self.cache_service = cache_service
+
     def index_images(self, paths: Iterable[Path],
                      skip_thumb_cache: bool) -> None:
+        self._update_cache(paths)
+        self.done.emit(skip_thumb_cache)
+
+    @STARTUP_PROFILE.phase('indexing')
+    @TRACE.span('indexing')
+    def _update_cache(self, paths: Iterable[Path]) -> None:
         self.set_max.emit(0)
         self.set_value.emit(0)
         self.set_text.emit('Loading cache...')
-        if CACHE.exists():
-            cache = Cache.load()
-        else:
-            cache = Cache(updated=time.time(), images={})
+        with TRACE.span('cache snapshot'):
+            cached_images = self.cache_service.snapshot()
+        new_images: Dict[int, CachedImageData] = {}
         image_paths = []
         count = 0
-        for root_path in paths:
-            for path in root_path.rglob('**/*'):
-                if path.suffix.lower() not in {'.png', '.jpg'}:
-                    continue
+        with TRACE.span('discovery'):
+            for path in find_images(paths):
                 count += 1
                 self.set_text.emit(f'Searching for images... '
                                    f'({count} found)')
@@ -208,28 +489,17 @@ class Indexer(QtCore.QObject):
             self.set_text.emit(f'Indexing images... ({count}/{total})')
             self.set_value.emit(count)
             count += 1
-            stat = path.stat()
-            if path in cache.images \
-                    and stat.st_mtime == cache.images[path].mtime \
-                    and stat.st_size == cache.images[path].size:
-                continue
-            try:
-                tags, (width, height) = extract_metadata(path)
-            except OSError:
+            with TRACE.span('stat'):
+                stat = path.stat()
+            if is_cached(path, stat, cached_images):
+                TRACE.count('index cache hits')
                 continue
-            except Exception as e:
-                logging.exception(f'failed to index image {path!r}')
-            else:
-                cache.images[path] = CachedImageData(
-                    tags=tags,
-                    size=stat.st_size,
-                    w=width,
-                    h=height,
-                    mtime=stat.st_mtime,
-                    ctime=stat.st_ctime
-                )
+            TRACE.count('index cache misses')
+            data = read_image_data(path, stat)
+            if data is not None:
+                new_images[PATHS.intern(path)] = data
         self.set_max.emit(0)
         self.set_value.emit(0)
-        self.set_text.emit('Saving cache...')
-        cache.save()
-        self.done.emit(skip_thumb_cache)
+        self.set_text.emit('Updating cache...')
+        with TRACE.span('cache update'):
+            self.cache_service.update_images(new_images)
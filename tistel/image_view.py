@@ -1,22 +1,90 @@
-from typing import Optional, cast
+import math
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple, cast
 
-from libsyntyche.widgets import Signal1, mk_signal1
+from libsyntyche.widgets import (Signal0, Signal1, mk_signal1, mk_signal2,
+                                 mk_signal3)
 from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtCore import Qt
 
+from .image_loading import (TILE_SIZE, ImageCache, PreviewImage, PreviewLoader,
+                            TileKey, TileLoader, tile_rect)
+
+PREVIEW_CACHE_BYTES = 512 * 1024 ** 2
+TILE_CACHE_BYTES = 256 * 1024 ** 2
+# Animations whose scaled frames fit in this are decoded only once
+ANIMATION_CACHE_BYTES = 64 * 1024 ** 2
+MAX_ZOOM = 8.0
+ZOOM_STEP = 1.25
+# Don't bother making mipmaps smaller than this
+MIN_MIPMAP_SIZE = 256
+MAX_MIPMAP_LEVELS = 4
+
 
 class ImagePreview(QtWidgets.QLabel):
     change_image = mk_signal1(int)
+    image_queued = mk_signal3(int, object, QtCore.QSize)
+    prefetch_queued = mk_signal3(int, object, QtCore.QSize)
+    tile_queued = mk_signal2(int, object)
 
     def __init__(self, parent: QtWidgets.QWidget) -> None:
         super().__init__(parent)
         self.fail = False
+        self.request_id = 0
+        # Prefetches have their own ids, so that showing an image doesn't
+        # throw away the neighbours that were queued along with it
+        self.prefetch_id = 0
+        self.current_path: Optional[Path] = None
+        self.image_cache: ImageCache[Path] = ImageCache(PREVIEW_CACHE_BYTES)
+        self.full_sizes: Dict[Path, QtCore.QSize] = {}
+        # How many frames the animated images that have been loaded have
+        self.frame_counts: Dict[Path, int] = {}
+        # The image currently shown, if it's a real image and not a placeholder
+        self.image_path: Optional[Path] = None
+        self.mipmaps: List[QtGui.QPixmap] = []
+        # How many images in each direction to decode ahead of time
+        self.prefetch_count = 2
         self.image: Optional[QtGui.QPixmap] = None
         self.animation: Optional[QtGui.QMovie] = None
         self.animation_size: Optional[QtCore.QSize] = None
         self.current_frame: Optional[QtGui.QPixmap] = None
         self.empty_image = QtGui.QPixmap(128, 128)
         self.empty_image.fill(Qt.transparent)
+        # Zoom is in screen pixels per image pixel, or None when the
+        # whole image is fit to the widget
+        self.zoom: Optional[float] = None
+        self.zoom_center = QtCore.QPointF()
+        self.drag_pos: Optional[QtCore.QPoint] = None
+        self.tile_cache: ImageCache[TileKey] = ImageCache(TILE_CACHE_BYTES)
+        self.tile_request_id = 0
+        self.pending_tiles: Set[TileKey] = set()
+
+        self.loader_thread = QtCore.QThread()
+        cast(Signal0, QtWidgets.QApplication.instance().aboutToQuit  # type: ignore
+             ).connect(self.loader_thread.quit)
+        self.loader = PreviewLoader()
+        self.loader.moveToThread(self.loader_thread)
+        self.image_queued.connect(self.loader.load_image)
+        self.prefetch_queued.connect(self.loader.prefetch_image)
+        self.loader.image_loaded.connect(self.image_loaded)
+        self.loader.image_prefetched.connect(self.image_prefetched)
+        self.loader_thread.start()
+
+        self.tile_loader_thread = QtCore.QThread()
+        cast(Signal0, QtWidgets.QApplication.instance().aboutToQuit  # type: ignore
+             ).connect(self.tile_loader_thread.quit)
+        self.tile_loader = TileLoader()
+        self.tile_loader.moveToThread(self.tile_loader_thread)
+        self.tile_queued.connect(self.tile_loader.load_tile)
+        self.tile_loader.tiles_loaded.connect(self.tiles_loaded)
+        self.tile_loader_thread.start()
+
+        # Resizing uses fast scaling, and this does a proper smooth
+        # scaling (and reloads the image if needed) when it's done
+        self.resize_timer = QtCore.QTimer(self)
+        self.resize_timer.setSingleShot(True)
+        self.resize_timer.setInterval(150)
+        cast(Signal0, self.resize_timer.timeout).connect(self.resize_done)
 
     def sizeHint(self) -> QtCore.QSize:
         # TODO: dont hardcode this
@@ -27,16 +95,57 @@ class ImagePreview(QtWidgets.QLabel):
             self.change_image.emit(-1)
         elif event.key() == Qt.Key_Right:
             self.change_image.emit(1)
+        elif event.key() == Qt.Key_Z:
+            self.set_zoom(1.0 if self.zoom is None else None)
+        elif event.key() in {Qt.Key_Plus, Qt.Key_Equal}:
+            self.set_zoom(self.current_zoom() * ZOOM_STEP)
+        elif event.key() == Qt.Key_Minus and self.zoom is not None:
+            self.set_zoom(self.current_zoom() / ZOOM_STEP)
+        elif event.key() == Qt.Key_Escape and self.zoom is not None:
+            self.set_zoom(None)
         else:
             event.ignore()
 
     def wheelEvent(self, event: QtGui.QWheelEvent) -> None:
         super().wheelEvent(event)
-        if event.angleDelta().y() > 0:
+        if self.zoom is not None or event.modifiers() & Qt.ControlModifier:
+            steps = event.angleDelta().y() / 120
+            self.set_zoom(self.current_zoom() * ZOOM_STEP ** steps, QtCore.QPointF(event.pos()))
+        elif event.angleDelta().y() > 0:
             self.change_image.emit(-1)
         else:
             self.change_image.emit(1)
 
+    def mouseDoubleClickEvent(self, event: QtGui.QMouseEvent) -> None:
+        if self.zoom is None:
+            self.set_zoom(1.0, QtCore.QPointF(event.pos()))
+        else:
+            self.set_zoom(None)
+
+    def mousePressEvent(self, event: QtGui.QMouseEvent) -> None:
+        if self.zoom is not None and event.button() == Qt.LeftButton:
+            self.drag_pos = event.pos()
+            self.setCursor(Qt.ClosedHandCursor)
+        else:
+            super().mousePressEvent(event)
+
+    def mouseMoveEvent(self, event: QtGui.QMouseEvent) -> None:
+        if self.zoom is not None and self.drag_pos is not None:
+            diff = QtCore.QPointF(event.pos() - self.drag_pos)
+            self.drag_pos = event.pos()
+            self.zoom_center -= diff / self.zoom
+            self.clamp_zoom_center()
+            self.update_tiles()
+        else:
+            super().mouseMoveEvent(event)
+
+    def mouseReleaseEvent(self, event: QtGui.QMouseEvent) -> None:
+        if self.drag_pos is not None:
+            self.drag_pos = None
+            self.unsetCursor()
+        else:
+            super().mouseReleaseEvent(event)
+
     def resize_keep_ratio(self, size: QtCore.QSize) -> QtCore.QSize:
         width, height = size.width(), size.height()
         total_width, total_height = self.width(), self.height()
@@ -58,7 +167,9 @@ class ImagePreview(QtWidgets.QLabel):
         super().paintEvent(event)
         painter = QtGui.QPainter(self)
         w, h = self.width(), self.height()
-        if self.current_frame is not None:
+        if self.zoom is not None and self.image is not None:
+            self.paint_zoomed(painter)
+        elif self.current_frame is not None:
             pw, ph = self.current_frame.width(), self.current_frame.height()
             x = (w - pw) // 2
             y = (h - ph) // 2
@@ -69,19 +180,45 @@ class ImagePreview(QtWidgets.QLabel):
             painter.drawLine(0, w, 0, h)
 
     def resizeEvent(self, event: QtGui.QResizeEvent) -> None:
-        if self.image is not None:
-            self.update_image_size()
+        if self.zoom is not None:
+            self.update_tiles()
+        elif self.image is not None:
+            self.update_image_size(fast=True)
+            self.resize_timer.start()
         elif self.animation is not None:
             self.update_animation_size()
+            self.resize_timer.start()
         super().resizeEvent(event)
 
+    def resize_done(self) -> None:
+        if self.image_path is not None and self.current_path is None \
+                and self.zoom is None:
+            image = self.image_cache.get(self.image_path)
+            if image is None or not self.is_sharp_enough(self.image_path, image):
+                self.current_path = self.image_path
+                self.image_queued.emit(self.request_id, self.image_path, self.decode_size())
+        elif self.animation is not None \
+                and self.animation.cacheMode() == QtGui.QMovie.CacheAll \
+                and self.animation.currentPixmap().size() != self.animation.scaledSize():
+            # Cached frames keep the size they were decoded at, so start over
+            path = Path(self.animation.fileName())
+            self.set_animation(QtGui.QMovie(str(path)), self.frame_counts.get(path, 0))
+            return
+        self.update_image_size()
+
     def clear(self) -> None:
+        self.cancel_loading()
         self.image = self.animation = self.current_frame = None
+        self.image_path = None
+        self.zoom = None
         self.fail = False
         self.update()
 
     def set_fail(self) -> None:
+        self.cancel_loading()
         self.image = self.animation = self.current_frame = None
+        self.image_path = None
+        self.zoom = None
         self.fail = True
         self.update()
 
@@ -90,14 +227,26 @@ class ImagePreview(QtWidgets.QLabel):
             self.current_frame = self.animation.currentPixmap()
             self.update()
 
-    def set_animation(self, animation: QtGui.QMovie) -> None:
+    def set_animation(self, animation: QtGui.QMovie, frame_count: int) -> None:
+        self.cancel_loading()
         self.image = None
+        self.image_path = None
+        self.zoom = None
         self.fail = False
         self.animation = animation
-        cast(Signal1[QtGui.QPixmap], self.animation.frameChanged).connect(self.new_frame)
-        self.animation.start()
-        self.animation_size = self.animation.currentImage().size()
+        self.animation_size = QtGui.QImageReader(animation.fileName()).size()
+        if not self.animation_size.isValid():
+            animation.jumpToFrame(0)
+            self.animation_size = animation.currentImage().size()
+        # Set the size before starting so that no frames are decoded at
+        # full size, and only keep the frames around if they're small enough
         self.update_animation_size()
+        size = animation.scaledSize()
+        frame_bytes = size.width() * size.height() * 4
+        if 0 < frame_count * frame_bytes <= ANIMATION_CACHE_BYTES:
+            animation.setCacheMode(QtGui.QMovie.CacheAll)
+        cast(Signal1[QtGui.QPixmap], animation.frameChanged).connect(self.new_frame)
+        animation.start()
 
     def update_animation_size(self) -> None:
         if self.animation_size is not None and self.animation is not None:
@@ -105,20 +254,216 @@ class ImagePreview(QtWidgets.QLabel):
             self.animation.setScaledSize(size)
             self.update()
 
+    def cancel_loading(self) -> None:
+        self.request_id += 1
+        self.loader.latest_request = self.request_id
+        self.current_path = None
+
+    def decode_size(self) -> QtCore.QSize:
+        return self.size() * self.devicePixelRatioF()
+
+    def is_sharp_enough(self, path: Path, image: QtGui.QImage) -> bool:
+        full_size = self.full_sizes.get(path)
+        if full_size is None or image.size() == full_size:
+            return True
+        needed_size = full_size.scaled(self.decode_size(), Qt.KeepAspectRatio)
+        # Allow for some rounding errors
+        return image.width() >= needed_size.width() - 1
+
+    def load_image(self, path: Path, placeholder: Optional[QtGui.QPixmap]) -> None:
+        frame_count = self.frame_counts.get(path)
+        if frame_count is not None:
+            self.set_animation(QtGui.QMovie(str(path)), frame_count)
+            return
+        cached_image = self.image_cache.get(path)
+        if cached_image is not None:
+            self.show_image(path, cached_image)
+            if self.is_sharp_enough(path, cached_image):
+                return
+        else:
+            # Show the placeholder (usually the thumbnail) until the real
+            # image has been decoded in the background
+            self.setPixmap(placeholder)
+        self.current_path = path
+        self.image_queued.emit(self.request_id, path, self.decode_size())
+
+    def prefetch(self, paths: Iterable[Path]) -> None:
+        # These are queued after the current image and dropped by the
+        # loader as soon as another set of neighbours is prefetched
+        self.prefetch_id += 1
+        self.loader.latest_prefetch = self.prefetch_id
+        for path in paths:
+            if path not in self.image_cache and path not in self.frame_counts:
+                self.prefetch_queued.emit(self.prefetch_id, path, self.decode_size())
+
+    def image_prefetched(self, preview: PreviewImage) -> None:
+        path, image, full_size, frame_count = preview
+        if frame_count != 1:
+            self.frame_counts[path] = frame_count
+        elif not image.isNull():
+            self.image_cache.put(path, image)
+            self.full_sizes[path] = full_size
+
+    def image_loaded(self, request_id: int, preview: PreviewImage) -> None:
+        path, image, full_size, frame_count = preview
+        if frame_count != 1:
+            self.frame_counts[path] = frame_count
+        elif not image.isNull():
+            self.image_cache.put(path, image)
+            self.full_sizes[path] = full_size
+        if request_id != self.request_id or path != self.current_path:
+            return
+        if frame_count != 1:
+            self.set_animation(QtGui.QMovie(str(path)), frame_count)
+        elif image.isNull():
+            self.set_fail()
+        else:
+            self.show_image(path, image)
+
+    def show_image(self, path: Path, image: QtGui.QImage) -> None:
+        # Stay zoomed in if this is just a sharper version of the same image
+        zoom = (self.zoom, self.zoom_center) if path == self.image_path else None
+        self.setPixmap(QtGui.QPixmap.fromImage(image))
+        self.image_path = path
+        if zoom is not None:
+            self.zoom, self.zoom_center = zoom
+            self.update()
+
     def setPixmap(self, image: Optional[QtGui.QPixmap]) -> None:
+        self.cancel_loading()
         if image is None:
             self.image = self.empty_image
         else:
             self.image = image
+        self.image_path = None
+        self.zoom = None
+        self.mipmaps = [self.image]
         self.fail = False
         self.animation = None
         self.update_image_size()
 
-    def update_image_size(self) -> None:
+    def mipmap(self, size: QtCore.QSize) -> QtGui.QPixmap:
+        # Pick the smallest level that is still at least as big as the
+        # target, and make it if it doesn't exist yet
+        while len(self.mipmaps) < MAX_MIPMAP_LEVELS:
+            last = self.mipmaps[-1]
+            half_size = last.size() / 2
+            if half_size.width() < max(size.width(), MIN_MIPMAP_SIZE) \
+                    or half_size.height() < max(size.height(), MIN_MIPMAP_SIZE):
+                break
+            self.mipmaps.append(last.scaled(half_size, transformMode=Qt.SmoothTransformation))
+        for pixmap in reversed(self.mipmaps):
+            if pixmap.width() >= size.width() or pixmap.height() >= size.height():
+                return pixmap
+        return self.mipmaps[0]
+
+    def update_image_size(self, fast: bool = False) -> None:
         if self.image is not None:
-            self.current_frame = self.image.scaled(
+            target_size = self.image.size().scaled(self.size(), Qt.KeepAspectRatio)
+            source = self.mipmap(target_size) if fast else self.image
+            self.current_frame = source.scaled(
                 self.size(),
                 aspectRatioMode=Qt.KeepAspectRatio,
-                transformMode=QtCore.Qt.SmoothTransformation
+                transformMode=(Qt.FastTransformation if fast
+                               else Qt.SmoothTransformation)
             )
             self.update()
+
+    def full_size(self) -> Optional[QtCore.QSize]:
+        if self.image_path is None:
+            return None
+        return self.full_sizes.get(self.image_path)
+
+    def current_zoom(self) -> float:
+        if self.zoom is not None:
+            return self.zoom
+        full_size = self.full_size()
+        if full_size is None or full_size.isEmpty():
+            return 1.0
+        return min(self.width() / full_size.width(), self.height() / full_size.height())
+
+    def set_zoom(self, zoom: Optional[float],
+                 anchor: Optional[QtCore.QPointF] = None) -> None:
+        full_size = self.full_size()
+        if full_size is None or full_size.isEmpty():
+            return
+        fit_zoom = min(self.width() / full_size.width(), self.height() / full_size.height())
+        if zoom is None or zoom <= fit_zoom:
+            self.zoom = None
+            self.pending_tiles.clear()
+            self.update_image_size()
+            return
+        widget_center = QtCore.QPointF(self.width() / 2, self.height() / 2)
+        if anchor is None:
+            anchor = widget_center
+        if self.zoom is None:
+            self.zoom_center = QtCore.QPointF(full_size.width() / 2, full_size.height() / 2)
+        # Keep whatever is under the anchor in the same place on screen
+        anchor_pos = self.zoom_center + (anchor - widget_center) / self.current_zoom()
+        self.zoom = min(zoom, MAX_ZOOM)
+        self.zoom_center = anchor_pos - (anchor - widget_center) / self.zoom
+        self.clamp_zoom_center()
+        self.update_tiles()
+
+    def clamp_zoom_center(self) -> None:
+        full_size = self.full_size()
+        if full_size is not None:
+            self.zoom_center.setX(min(max(self.zoom_center.x(), 0), full_size.width()))
+            self.zoom_center.setY(min(max(self.zoom_center.y(), 0), full_size.height()))
+
+    def zoom_origin(self) -> QtCore.QPointF:
+        # Where the top left corner of the image is on screen
+        zoom = self.current_zoom()
+        return QtCore.QPointF(self.width() / 2 - self.zoom_center.x() * zoom,
+                              self.height() / 2 - self.zoom_center.y() * zoom)
+
+    def visible_tiles(self) -> List[TileKey]:
+        full_size = self.full_size()
+        if self.zoom is None or self.image_path is None or full_size is None:
+            return []
+        level = max(0, math.floor(math.log2(1 / self.zoom)))
+        span = TILE_SIZE << level
+        origin = self.zoom_origin()
+        left = max(0.0, -origin.x() / self.zoom)
+        top = max(0.0, -origin.y() / self.zoom)
+        right = min(float(full_size.width()), (self.width() - origin.x()) / self.zoom)
+        bottom = min(float(full_size.height()), (self.height() - origin.y()) / self.zoom)
+        return [TileKey(self.image_path, level, column, row)
+                for row in range(int(top // span), math.ceil(bottom / span))
+                for column in range(int(left // span), math.ceil(right / span))]
+
+    def update_tiles(self) -> None:
+        missing_tiles = {key for key in self.visible_tiles() if key not in self.tile_cache}
+        if missing_tiles != self.pending_tiles:
+            # Drop the queued tiles that aren't needed anymore
+            self.tile_request_id += 1
+            self.tile_loader.latest_request = self.tile_request_id
+            self.pending_tiles = missing_tiles
+            for key in sorted(missing_tiles, key=lambda k: (k.row, k.column)):
+                self.tile_queued.emit(self.tile_request_id, key)
+        self.update()
+
+    def tiles_loaded(self, tiles: List[Tuple[TileKey, QtGui.QImage]]) -> None:
+        for key, image in tiles:
+            self.tile_cache.put(key, image)
+            self.pending_tiles.discard(key)
+        if self.zoom is not None:
+            self.update()
+
+    def paint_zoomed(self, painter: QtGui.QPainter) -> None:
+        full_size = self.full_size()
+        if self.zoom is None or self.image is None or full_size is None:
+            return
+        painter.setRenderHint(QtGui.QPainter.SmoothPixmapTransform)
+        origin = self.zoom_origin()
+        # The normal preview stands in for any tiles that haven't loaded yet
+        painter.drawPixmap(QtCore.QRectF(origin, QtCore.QSizeF(full_size) * self.zoom),
+                           self.image, QtCore.QRectF(self.image.rect()))
+        for key in self.visible_tiles():
+            tile = self.tile_cache.get(key)
+            if tile is not None:
+                rect = tile_rect(key.level, key.column, key.row, full_size)
+                painter.drawImage(
+                    QtCore.QRectF(origin + QtCore.QPointF(rect.topLeft()) * self.zoom,
+                                  QtCore.QSizeF(rect.size()) * self.zoom),
+                    tile)
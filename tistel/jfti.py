@@ -1,8 +1,6 @@
 import logging
 import mimetypes
 import re
-import subprocess
-import xml.etree.ElementTree as ET
 from pathlib import Path
 from typing import Iterable, Optional, Set, Tuple
 
@@ -13,6 +11,8 @@ IMAGE_EXTS = ('.png', '.jpg', '.gif')
 IMAGE_MAGICS = ([_PNG_MAGIC],
                 [_JPEG_MAGIC],
                 [b'GIF87a', b'GIF89a'])
+# exiv2 can read GIFs but not write any metadata to them
+TAGGABLE_FORMATS = frozenset({'image/png', 'image/jpeg'})
 
 
 NS = {'x': 'adobe:ns:meta/',
@@ -41,7 +41,7 @@ def identify_image_format(fname: Path) -> Optional[str]:
     elif data[:2] == _JPEG_MAGIC:
         return 'image/jpeg'
     elif data[:3] == b'GIF':
-        if data[3:6] == b'89a':
+        if data[3:6] in {b'87a', b'89a'}:
             return 'image/gif'
         else:
             raise ImageError(f'Unsupported GIF format: {data[3:6]!r}')
@@ -49,6 +49,7 @@ def identify_image_format(fname: Path) -> Optional[str]:
 
 
 def dimensions(fname: Path) -> Tuple[int, int]:
+    import subprocess
     try:
         text = subprocess.check_output(['exiv2', '-p', 's', str(fname)],
                                        stderr=subprocess.PIPE,
@@ -63,6 +64,8 @@ def dimensions(fname: Path) -> Tuple[int, int]:
 
 
 def read_tags(fname: Path) -> Iterable[str]:
+    import subprocess
+    import xml.etree.ElementTree as ET
     try:
         result = subprocess.check_output(['exiv2', '-p', 'X', str(fname)],
                                          stderr=subprocess.PIPE, encoding='utf-8')
@@ -86,6 +89,7 @@ def set_tags(fname: Path, tags: Set[str]) -> None:
     for tag in tags:
         args.extend(['-M', f'set {tt} {tag}'])
     args.append(str(fname))
+    import subprocess
     try:
         result = subprocess.check_output(args, stderr=subprocess.PIPE,
                                          encoding='utf-8')
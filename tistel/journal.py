@@ -0,0 +1,159 @@
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any, Dict, FrozenSet, Iterable, List, NamedTuple, Tuple
+
+from . import jfti
+from .cache import Cache
+from .path_table import PATHS
+from .shared import JOURNAL
+from .tag_table import TAG_TABLE
+
+# How many tag writes to log before and after writing the files
+GROUP_SIZE = 32
+
+
+class TagWrite(NamedTuple):
+    image_id: int
+    old_tags: FrozenSet[int]
+    new_tags: FrozenSet[int]
+
+
+class Journal:
+    """
+    An append-only log of tag writes, so that the files and the cache
+    can't end up disagreeing if the program dies halfway through.
+
+    Every write is logged before the file is touched and its result is
+    logged afterwards, a whole group at a time with a single fsync each.
+    The cache is updated from the finished writes, including the new
+    mtime and size of the files so that reloading doesn't have to look
+    at them again, and only then is the journal emptied.
+    """
+    def __init__(self, path: Path = JOURNAL) -> None:
+        self.path = path
+        self.next_id = 0
+        # Whether next_id has been picked up from what's already in the file
+        self._ids_read = False
+
+    def _append(self, records: Iterable[Dict[str, Any]]) -> None:
+        if not self.path.parent.exists():
+            self.path.parent.mkdir(parents=True)
+        data = ''.join(json.dumps(record) + '\n' for record in records).encode()
+        with self.path.open('a+b') as f:
+            # Don't glue the new records onto a torn line from a crash
+            if f.seek(0, os.SEEK_END) > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    data = b'\n' + data
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def log_intents(self, writes: List[TagWrite]) -> List[int]:
+        if not self._ids_read:
+            # Entries left over from a recovery that failed must not have
+            # their ids reused, or their results get mixed up with these
+            self.read()
+        entry_ids = list(range(self.next_id, self.next_id + len(writes)))
+        self.next_id += len(writes)
+        self._append({'op': 'begin', 'id': entry_id, 'path': PATHS.path_string(write.image_id),
+                      'old': TAG_TABLE.sorted_names(write.old_tags),
+                      'new': TAG_TABLE.sorted_names(write.new_tags)}
+                     for entry_id, write in zip(entry_ids, writes))
+        return entry_ids
+
+    @staticmethod
+    def done_record(entry_id: int, path: Path) -> Dict[str, Any]:
+        stat = path.stat()
+        return {'op': 'done', 'id': entry_id,
+                'mtime': stat.st_mtime, 'size': stat.st_size}
+
+    @staticmethod
+    def failed_record(entry_id: int) -> Dict[str, Any]:
+        return {'op': 'failed', 'id': entry_id}
+
+    def commit(self, records: List[Dict[str, Any]]) -> None:
+        if records:
+            self._append(records)
+
+    def read(self) -> Tuple[Dict[int, TagWrite], Dict[int, Dict[str, Any]]]:
+        intents: Dict[int, TagWrite] = {}
+        results: Dict[int, Dict[str, Any]] = {}
+        if not self.path.exists():
+            return intents, results
+        with self.path.open(encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A torn write at the end, which means its group was
+                    # never committed
+                    logging.warning(f'skipping broken journal line: {line!r}')
+                    continue
+                if record['op'] == 'begin':
+                    intents[record['id']] = TagWrite(PATHS.intern(record['path']),
+                                                     TAG_TABLE.intern_all(record['old']),
+                                                     TAG_TABLE.intern_all(record['new']))
+                else:
+                    results[record['id']] = record
+        self.next_id = max(intents, default=-1) + 1
+        self._ids_read = True
+        return intents, results
+
+    def apply(self, cache: Cache) -> bool:
+        """
+        Update cache with the finished writes and return whether there
+        were any.
+        """
+        intents, results = self.read()
+        applied = False
+        for entry_id, result in sorted(results.items()):
+            if result['op'] != 'done' or entry_id not in intents:
+                continue
+            write = intents[entry_id]
+            image = cache.images.get(write.image_id)
+            if image is None:
+                logging.error(f"The image at {PATHS.path_string(write.image_id)!r} couldn't "
+                              "be found in the cache! This shouldn't happen!")
+                continue
+            cache.images[write.image_id] = image._replace(
+                tags=tuple(sorted(write.new_tags)), mtime=result['mtime'], size=result['size'])
+            applied = True
+        return applied
+
+    def checkpoint(self) -> None:
+        if self.path.exists():
+            self.path.unlink()
+        self.next_id = 0
+        self._ids_read = True
+
+    def recover(self) -> None:
+        """
+        Finish or roll back whatever was going on when the program quit.
+        The journal is left as it is so the cache can be updated from it.
+        """
+        intents, results = self.read()
+        if not intents:
+            return
+        records = []
+        for entry_id, write in sorted(intents.items()):
+            if entry_id in results:
+                continue
+            path = PATHS.path(write.image_id)
+            try:
+                current_tags = TAG_TABLE.intern_all(jfti.read_tags(path))
+                if current_tags == write.old_tags:
+                    # The change was confirmed but never made it to the file
+                    jfti.set_tags(path, set(TAG_TABLE.sorted_names(write.new_tags)))
+                elif current_tags != write.new_tags:
+                    # Something else has changed the file since, so leave it
+                    # to the indexer
+                    records.append(self.failed_record(entry_id))
+                    continue
+                records.append(self.done_record(entry_id, path))
+            except Exception:
+                logging.exception(f'failed to recover tag write to {path!r}')
+                records.append(self.failed_record(entry_id))
+        self.commit(records)
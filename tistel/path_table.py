@@ -0,0 +1,83 @@
+import os.path
+import threading
+from array import array
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+_U32 = 'I' if array('I').itemsize == 4 else 'L'
+
+
+class PathTable:
+    """
+    Every image path the program has seen, stored once as a directory id
+    plus a file name and handed out as an integer image id.
+
+    Ids are never reused or removed, so they can be passed between threads
+    freely and only turned back into paths when a file actually has to be
+    touched. Adding paths takes a lock, looking them up doesn't.
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._dirs: List[str] = []
+        self._dir_ids: Dict[str, int] = {}
+        # Dir id -> file name -> image id
+        self._dir_images: List[Dict[str, int]] = []
+        self._image_dirs = array(_U32)
+        self._names: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def add_dir(self, directory: str) -> int:
+        dir_id = self._dir_ids.get(directory)
+        if dir_id is None:
+            with self._lock:
+                dir_id = self._dir_ids.get(directory)
+                if dir_id is None:
+                    dir_id = len(self._dirs)
+                    self._dirs.append(directory)
+                    self._dir_images.append({})
+                    self._dir_ids[directory] = dir_id
+        return dir_id
+
+    def add(self, dir_id: int, name: str) -> int:
+        images = self._dir_images[dir_id]
+        image_id = images.get(name)
+        if image_id is None:
+            with self._lock:
+                image_id = images.get(name)
+                if image_id is None:
+                    image_id = len(self._names)
+                    self._names.append(name)
+                    self._image_dirs.append(dir_id)
+                    images[name] = image_id
+        return image_id
+
+    def intern(self, path: Union[Path, str]) -> int:
+        directory, name = os.path.split(path)
+        return self.add(self.add_dir(directory), name)
+
+    def lookup(self, path: Union[Path, str]) -> Optional[int]:
+        directory, name = os.path.split(path)
+        dir_id = self._dir_ids.get(directory)
+        if dir_id is None:
+            return None
+        return self._dir_images[dir_id].get(name)
+
+    def dir_id(self, image_id: int) -> int:
+        return self._image_dirs[image_id]
+
+    def directory(self, dir_id: int) -> str:
+        return self._dirs[dir_id]
+
+    def name(self, image_id: int) -> str:
+        return self._names[image_id]
+
+    def path_string(self, image_id: int) -> str:
+        return os.path.join(self._dirs[self._image_dirs[image_id]], self._names[image_id])
+
+    def path(self, image_id: int) -> Path:
+        return Path(self.path_string(image_id))
+
+
+PATHS = PathTable()
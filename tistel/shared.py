@@ -1,36 +1,43 @@
 from __future__ import annotations
 
 import enum
+import functools
 import itertools
-import json
-from dataclasses import dataclass
 from pathlib import Path
-from typing import (Any, Callable, Dict, FrozenSet, Generic, Iterable, List,
-                    NamedTuple, Optional, Protocol, Set, Tuple, TypeVar, Union,
-                    cast)
+from typing import (Callable, Dict, FrozenSet, Generic, Iterable, NamedTuple,
+                    Optional, Protocol, Tuple, TypeVar, Union, cast)
 
-from libsyntyche.widgets import Signal2, mk_signal2
-from PyQt5 import QtCore, QtGui, QtSvg, QtWidgets
+from libsyntyche.widgets import Signal0, Signal2, mk_signal2
+from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtCore import Qt
 
 _data_ids = itertools.count(start=Qt.UserRole)
 
-PATH = next(_data_ids)
+IMAGE_ID = next(_data_ids)
 DIMENSIONS = next(_data_ids)
 FILE_SIZE = next(_data_ids)
 TAGS = next(_data_ids)
 TAG_STATE = next(_data_ids)
 TAG_NAME = next(_data_ids)
+TAG_ID = next(_data_ids)
 TAG_COUNT = next(_data_ids)
 VISIBLE_TAG_COUNT = next(_data_ids)
 HOVERING = next(_data_ids)
 FILE_FORMAT = next(_data_ids)
-PATH_STRING = next(_data_ids)
-FILE_NAME = next(_data_ids)
 IS_NEW = next(_data_ids)
+SORT_PATH = next(_data_ids)
+SORT_FILE_NAME = next(_data_ids)
+SORT_FILE_SIZE = next(_data_ids)
+SORT_MTIME = next(_data_ids)
+SORT_CTIME = next(_data_ids)
+SORT_PIXEL_COUNT = next(_data_ids)
+SORT_ASPECT_RATIO = next(_data_ids)
 
 CONFIG = Path.home() / '.config' / 'tistel' / 'config.json'
-CACHE = Path.home() / '.cache' / 'tistel' / 'cache.json'
+CACHE = Path.home() / '.cache' / 'tistel' / 'cache.bin'
+# The cache used to be stored as JSON, which is still loaded if it's there
+JSON_CACHE = Path.home() / '.cache' / 'tistel' / 'cache.json'
+JOURNAL = Path.home() / '.cache' / 'tistel' / 'journal'
 THUMBNAILS = Path.home() / '.thumbnails' / 'normal'
 DATA_PATH = Path(__file__).resolve().parent / 'data'
 CSS_FILE = DATA_PATH / 'qt.css'
@@ -43,8 +50,8 @@ class TagState(enum.Enum):
 
 
 class TagStates(NamedTuple):
-    whitelist: FrozenSet[str]
-    blacklist: FrozenSet[str]
+    whitelist: FrozenSet[int]
+    blacklist: FrozenSet[int]
     untagged_state: TagState
 
 
@@ -65,14 +72,6 @@ class ImageData(Protocol):
     def file_format(self, file_format: str) -> None:
         ...
 
-    @property
-    def file_name(self) -> str:
-        ...
-
-    @file_name.setter
-    def file_name(self, file_name: str) -> None:
-        ...
-
     @property
     def file_size(self) -> int:
         ...
@@ -82,83 +81,29 @@ class ImageData(Protocol):
         ...
 
     @property
-    def path(self) -> Path:
+    def image_id(self) -> int:
         ...
 
-    @path.setter
-    def path(self, path: Path) -> None:
+    @image_id.setter
+    def image_id(self, image_id: int) -> None:
         ...
 
     @property
-    def path_string(self) -> str:
+    def path(self) -> Path:
         ...
 
-    @path_string.setter
-    def path_string(self, path_string: str) -> None:
+    def icon(self) -> QtGui.QIcon:
         ...
 
     @property
-    def tags(self) -> Set[str]:
+    def tags(self) -> FrozenSet[int]:
         ...
 
     @tags.setter
-    def tags(self, tags: Set[str]) -> None:
+    def tags(self, tags: FrozenSet[int]) -> None:
         ...
 
 
-@dataclass
-class CachedImageData:
-    tags: List[str]
-    size: int
-    w: int
-    h: int
-    mtime: float
-    ctime: float
-
-
-@dataclass
-class Cache:
-    updated: float
-    images: Dict[Path, CachedImageData]
-
-    @classmethod
-    def load(cls) -> Cache:
-        data: Dict[str, Union[float, Dict[str, Union[List[str], int, float]]]] = \
-            json.loads(CACHE.read_text())
-        return Cache(
-            updated=cast(float, data['updated']),
-            images={
-                Path(k): CachedImageData(
-                    tags=cast(List[str], v['tags']),
-                    size=cast(int, v['size']),
-                    w=cast(int, v['w']),
-                    h=cast(int, v['h']),
-                    mtime=cast(float, v['mtime']),
-                    ctime=cast(float, v['ctime']),
-                )  # **cast(Dict[str, Union[List[str], int, float]], v))
-                for k, v in cast(Dict[str, Any], data['images']).items()
-            }
-        )
-
-    def save(self) -> None:
-        if not CACHE.parent.exists():
-            CACHE.parent.mkdir(parents=True)
-        CACHE.write_text(json.dumps({
-            'updated': self.updated,
-            'images': {
-                str(path): {
-                    'tags': img_data.tags,
-                    'size': img_data.size,
-                    'w': img_data.w,
-                    'h': img_data.h,
-                    'mtime': img_data.mtime,
-                    'ctime': img_data.ctime,
-                }
-                for path, img_data in self.images.items()
-            }
-        }))
-
-
 T = TypeVar('T', bound=QtGui.QStandardItem)
 
 
@@ -301,16 +246,89 @@ class CustomDrawListWidget(ListWidget2[T2]):
         self.last_item = item
 
 
-class IconWidget(QtSvg.QSvgWidget):
+class CustomDrawListView(QtWidgets.QListView):
+    """The same as CustomDrawListWidget but for any model, with the hovered
+    row kept in the view instead of in the items."""
+    def __init__(self, parent: QtWidgets.QWidget,
+                 delegate: Callable[[QtWidgets.QWidget], S]) -> None:
+        super().__init__(parent)
+        self.setItemDelegate(delegate(self))
+        self.setMouseTracking(True)
+        # All rows are the same height, which saves a lot of work in the view
+        self.setUniformItemSizes(True)
+        self.hover_row = -1
+
+    def setModel(self, model: Optional[QtCore.QAbstractItemModel]) -> None:
+        super().setModel(model)
+        if model is not None:
+            cast(Signal0, model.modelReset).connect(self._forget_hover_row)
+            cast(Signal0, model.layoutChanged).connect(self._forget_hover_row)
+
+    def _forget_hover_row(self) -> None:
+        self.hover_row = -1
+        self.unsetCursor()
+
+    def set_hover_row(self, row: int) -> None:
+        if row != self.hover_row:
+            self.setCursor(Qt.PointingHandCursor if row >= 0 else Qt.ArrowCursor)
+            for changed_row in (self.hover_row, row):
+                if changed_row >= 0:
+                    self.viewport().update(self.visualRect(self.model().index(changed_row, 0)))
+            self.hover_row = row
+
+    def mouseMoveEvent(self, event: QtGui.QMouseEvent) -> None:
+        self.set_hover_row(self.indexAt(event.pos()).row())
+
+    def leaveEvent(self, event: QtCore.QEvent) -> None:
+        super().leaveEvent(event)
+        self.set_hover_row(-1)
+
+    def enterEvent(self, event: QtCore.QEvent) -> None:
+        super().enterEvent(event)
+        self.set_hover_row(self.indexAt(cast(QtGui.QEnterEvent, event).pos()).row())
+
+
+@functools.lru_cache(maxsize=None)
+def load_svg(name: str, stroke: str) -> bytes:
+    path = DATA_PATH / 'icons' / f'{name}.svg'
+    with open(path, 'rb') as f:
+        data = f.read()
+    return data.replace(b'stroke="currentColor"',
+                        b'stroke="' + stroke.encode() + b'"')
+
+
+@functools.lru_cache(maxsize=None)
+def render_svg(name: str, resolution: int, stroke: str,
+               pixel_ratio: float) -> QtGui.QPixmap:
+    from PyQt5 import QtSvg
+    renderer = QtSvg.QSvgRenderer(load_svg(name, stroke))
+    size = int(resolution * pixel_ratio)
+    pixmap = QtGui.QPixmap(size, size)
+    pixmap.fill(Qt.transparent)
+    painter = QtGui.QPainter(pixmap)
+    renderer.render(painter)
+    painter.end()
+    pixmap.setDevicePixelRatio(pixel_ratio)
+    return pixmap
+
+
+def render_svg_for(widget: Optional[QtWidgets.QWidget], name: str,
+                   resolution: int, stroke: str) -> QtGui.QPixmap:
+    if widget is not None:
+        pixel_ratio = widget.devicePixelRatioF()
+    else:
+        pixel_ratio = cast(QtGui.QGuiApplication,
+                           QtWidgets.QApplication.instance()).devicePixelRatio()
+    return render_svg(name, resolution, stroke, pixel_ratio)
+
+
+class IconWidget(QtWidgets.QLabel):
     def __init__(self, name: str, resolution: int,
                  parent: QtWidgets.QWidget) -> None:
         super().__init__(parent)
         self.setFixedSize(QtCore.QSize(resolution, resolution))
-        path = DATA_PATH / 'icons' / f'{name}.svg'
-        with open(path, 'rb') as f:
-            data = f.read()
-        data = data.replace(b'stroke="currentColor"', b'stroke="#eee"')
-        self.load(data)
+        # Rendered once per process and shared by every widget using it
+        self.setPixmap(render_svg_for(parent, name, resolution, '#eee'))
 
 
 def make_svg_icon(name: str, resolution: int,
@@ -319,24 +337,24 @@ def make_svg_icon(name: str, resolution: int,
     if not isinstance(color, QtGui.QColor):
         color = QtGui.QColor(color)
     color_str = f'{color.red():0>2x}{color.green():0>2x}{color.blue():0>2x}'
-    path = DATA_PATH / 'icons' / f'{name}.svg'
-    with open(path, 'rb') as f:
-        data = f.read()
-    data = data.replace(b'stroke="currentColor"',
-                        b'stroke="#' + color_str.encode() + b'"')
-    renderer = QtSvg.QSvgRenderer(data)
-    pixmap = QtGui.QPixmap(resolution, resolution)
-    pixmap.fill(Qt.transparent)
-    painter = QtGui.QPainter(pixmap)
-    renderer.render(painter)
-    painter.end()
-    icon = QtGui.QIcon(pixmap)
-    return icon
+    return QtGui.QIcon(render_svg_for(None, name, resolution, f'#{color_str}'))
+
+
+class SortableModel(Protocol):
+    def setSortRole(self, role: int) -> None:
+        ...
+
+    def sortOrder(self) -> Qt.SortOrder:
+        ...
+
+    def sort(self, column: int, order: Qt.SortOrder = ...) -> None:
+        ...
 
 
 def make_sort_menu(parent: QtWidgets.QWidget,
-                   sort_model: QtCore.QSortFilterProxyModel,
+                   sort_model: SortableModel,
                    titles_and_sort_roles: Dict[str, int],
+                   prepare_sort_role: Optional[Callable[[int], None]] = None,
                    ) -> QtWidgets.QPushButton:
     menu = QtWidgets.QMenu(parent)
 
@@ -360,6 +378,8 @@ def make_sort_menu(parent: QtWidgets.QWidget,
         order = sort_model.sortOrder()
         for key_action, sort_role in zip(sort_key_actions, titles_and_sort_roles.values()):
             if action == key_action:
+                if prepare_sort_role is not None:
+                    prepare_sort_role(sort_role)
                 sort_model.setSortRole(sort_role)
                 break
         else:
@@ -7,8 +7,8 @@ from PyQt5.QtWidgets import QPushButton
 
 from .file_tree_view import DirectoryTree
 from .settings import Settings
-from .shared import (PATH, TAG_COUNT, TAG_NAME, TAG_STATE, VISIBLE_TAG_COUNT,
-                     TagState, make_svg_icon)
+from .shared import (TAG_COUNT, TAG_NAME, TAG_STATE, VISIBLE_TAG_COUNT, TagState,
+                     make_svg_icon)
 from .tag_list import TagListContainer
 
 
@@ -0,0 +1,59 @@
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, TextIO, Tuple
+
+
+class StartupProfile:
+    """
+    How long the different parts of starting up take, for --profile-startup.
+
+    Some of the phases run on other threads and overlap with the rest, so
+    besides how long each one took the report also says when it was done,
+    counted from when the package was first imported. Nothing is recorded
+    unless the profile has been enabled, and only up until the report.
+    """
+    def __init__(self) -> None:
+        self.enabled = False
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+        # Name, duration or None for a single point in time, and when it was done
+        self._phases: List[Tuple[str, Optional[float], float]] = []
+
+    def enable(self) -> None:
+        self.enabled = True
+        # Everything up until now has been imports
+        self._record('imports', self.started)
+
+    def _record(self, name: str, start: Optional[float]) -> None:
+        if not self.enabled:
+            return
+        end = time.perf_counter()
+        with self._lock:
+            self._phases.append((name, None if start is None else end - start,
+                                 end - self.started))
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Time a block, or every call to a function when used as a decorator."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record(name, start)
+
+    def finish(self, name: str, file: TextIO = sys.stderr) -> None:
+        """Record the end of starting up and print the report."""
+        if not self.enabled:
+            return
+        self._record(name, None)
+        self.enabled = False
+        lines = ['Startup profile (ms):']
+        for phase_name, duration, done in self._phases:
+            duration_str = '' if duration is None else f'{duration * 1000:.1f}'
+            lines.append(f'  {phase_name:<24}{duration_str:>10}   done at {done * 1000:>8.1f}')
+        print('\n'.join(lines), file=file)
+
+
+STARTUP_PROFILE = StartupProfile()
@@ -0,0 +1,83 @@
+import itertools
+from typing import Counter, Dict, Iterable, List, Set, Tuple
+
+from .tag_index import TagIndex, bitmap_rows
+
+# How many of the most common neighbours to keep ready for each tag
+TOP_K = 50
+# How many of the selection's most common tags to rank the others by
+MAX_SCORED_TAGS = 20
+
+
+class TagCooccurrence:
+    """
+    A sparse matrix of how many images every pair of tags share.
+
+    Each row of the matrix (one tag and the counts of everything it's been
+    used together with) is worked out from the tag index when it's first
+    needed. Changing the tags of an image only affects the rows of the
+    tags it had or got, and those are updated in place from the old and
+    new tags instead of being worked out again.
+    """
+    def __init__(self, index: TagIndex) -> None:
+        self.index = index
+        self._rows: Dict[int, Counter[int]] = {}
+        # The top neighbours of each row, until the row changes
+        self._top: Dict[int, List[Tuple[int, int]]] = {}
+
+    def clear(self) -> None:
+        self._rows = {}
+        self._top = {}
+
+    def neighbours(self, tag: int) -> Counter[int]:
+        row_tags = self.index.row_tags
+        rows = bitmap_rows(self.index.tags.get(tag, 0))
+        counts = Counter(itertools.chain.from_iterable(row_tags[row] for row in rows))
+        del counts[tag]
+        return counts
+
+    def update(self, old_tags: Iterable[int], new_tags: Iterable[int]) -> None:
+        """Account for one image's tags changing from old_tags to new_tags."""
+        old_tags = set(old_tags)
+        new_tags = set(new_tags)
+        for tag in old_tags | new_tags:
+            row = self._rows.get(tag)
+            if row is None:
+                continue
+            if tag in old_tags:
+                row.subtract(old_tags - {tag})
+            if tag in new_tags:
+                row.update(new_tags - {tag})
+            # Anything the image had can have dropped to 0, even if it
+            # still has it, since this tag might be the one that's gone
+            for other in old_tags - {tag}:
+                if other in row and row[other] <= 0:
+                    del row[other]
+            self._top.pop(tag, None)
+
+    def row(self, tag: int) -> Counter[int]:
+        row = self._rows.get(tag)
+        if row is None:
+            row = self._rows[tag] = self.neighbours(tag)
+        return row
+
+    def top(self, tag: int) -> List[Tuple[int, int]]:
+        top = self._top.get(tag)
+        if top is None:
+            top = self.row(tag).most_common(TOP_K)
+            self._top[tag] = top
+        return top
+
+    def related(self, tag_weights: Counter[int], exclude: Set[int]) -> List[int]:
+        """
+        Rank the tags by how often they show up together with the weighted
+        tags, leaving out the excluded ones and anything that never does.
+        Only the most heavily weighted tags are used, so a big selection
+        with lots of tags doesn't cost more than a small one.
+        """
+        scores: Counter[int] = Counter()
+        for tag, weight in tag_weights.most_common(MAX_SCORED_TAGS):
+            for other, count in self.top(tag):
+                if other not in exclude:
+                    scores[other] += weight * count
+        return [tag for tag, _ in scores.most_common()]
@@ -0,0 +1,133 @@
+from typing import (Counter, Dict, FrozenSet, Iterable, List, Optional, Tuple,
+                    Union)
+
+from .tag_table import TAG_TABLE
+
+
+def popcount(bitmap: int) -> int:
+    return bin(bitmap).count('1')
+
+
+def make_bitmap(rows: Iterable[int], size: int) -> int:
+    # Setting bits one by one on a big int copies it every time, so go
+    # through a bytearray instead
+    data = bytearray((size + 7) // 8)
+    for row in rows:
+        data[row >> 3] |= 1 << (row & 7)
+    return int.from_bytes(data, 'little')
+
+
+def bitmap_rows(bitmap: int) -> List[int]:
+    # Searching the binary string is done in C, unlike shifting the int
+    # bit by bit
+    bits = bin(bitmap)[:1:-1]
+    rows = []
+    row = bits.find('1')
+    while row >= 0:
+        rows.append(row)
+        row = bits.find('1', row + 1)
+    return rows
+
+
+class TagIndex:
+    def __init__(self) -> None:
+        self.size = 0
+        self.untagged = 0
+        # Tag id -> bitmap of the rows with that tag
+        self.tags: Dict[int, int] = {}
+        self.row_tags: List[FrozenSet[int]] = []
+        # Bumped whenever a tag is added to or removed from the index
+        self.generation = 0
+        self._tag_names: Optional[List[str]] = None
+
+    @property
+    def all_rows(self) -> int:
+        return (1 << self.size) - 1
+
+    @property
+    def tag_names(self) -> List[str]:
+        if self._tag_names is None:
+            self._tag_names = TAG_TABLE.sorted_names(self.tags)
+        return self._tag_names
+
+    def _tags_changed(self) -> None:
+        self.generation += 1
+        self._tag_names = None
+
+    def clear(self) -> None:
+        self.build([])
+
+    def build(self, row_tags: Iterable[Union[Tuple[int, ...], FrozenSet[int]]]) -> None:
+        # Most images share their tags with lots of others, so share the
+        # sets as well
+        tag_sets: Dict[Union[Tuple[int, ...], FrozenSet[int]], FrozenSet[int]] = {}
+        self.row_tags = []
+        for tag_ids in row_tags:
+            tag_set = tag_sets.get(tag_ids)
+            if tag_set is None:
+                tag_set = tag_sets[tag_ids] = frozenset(tag_ids)
+            self.row_tags.append(tag_set)
+        self.size = len(self.row_tags)
+        rows_per_tag: Dict[int, List[int]] = {}
+        untagged_rows: List[int] = []
+        for row, tags in enumerate(self.row_tags):
+            if not tags:
+                untagged_rows.append(row)
+            for tag in tags:
+                rows_per_tag.setdefault(tag, []).append(row)
+        self.untagged = make_bitmap(untagged_rows, self.size)
+        self.tags = {tag: make_bitmap(rows, self.size)
+                     for tag, rows in rows_per_tag.items()}
+        self._tags_changed()
+
+    def set_row_tags(self, row: int, tags: Iterable[int]) -> bool:
+        old_tags = self.row_tags[row]
+        new_tags = frozenset(tags)
+        if old_tags == new_tags:
+            return False
+        bit = 1 << row
+        tags_changed = False
+        for tag in old_tags - new_tags:
+            bitmap = self.tags[tag] & ~bit
+            if bitmap:
+                self.tags[tag] = bitmap
+            else:
+                del self.tags[tag]
+                tags_changed = True
+        for tag in new_tags - old_tags:
+            if tag not in self.tags:
+                tags_changed = True
+            self.tags[tag] = self.tags.get(tag, 0) | bit
+        if tags_changed:
+            self._tags_changed()
+        if new_tags:
+            self.untagged &= ~bit
+        else:
+            self.untagged |= bit
+        self.row_tags[row] = new_tags
+        return True
+
+    def count(self, visible: int,
+              previous: Optional[Tuple[int, int, Counter[int]]] = None
+              ) -> Tuple[int, Counter[int]]:
+        if previous is not None:
+            old_visible, old_untagged, old_tag_count = previous
+            # If the filter only got narrower, subtract the rows that were
+            # hidden instead of counting everything again
+            if not visible & ~old_visible:
+                hidden = old_visible & ~visible
+                tag_count = old_tag_count.copy()
+                for tag, bitmap in self.tags.items():
+                    if bitmap & hidden:
+                        new_count = tag_count[tag] - popcount(bitmap & hidden)
+                        if new_count > 0:
+                            tag_count[tag] = new_count
+                        else:
+                            del tag_count[tag]
+                return (old_untagged - popcount(self.untagged & hidden), tag_count)
+        tag_count = Counter()
+        for tag, bitmap in self.tags.items():
+            count = popcount(bitmap & visible)
+            if count:
+                tag_count[tag] = count
+        return (popcount(self.untagged & visible), tag_count)
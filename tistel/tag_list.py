@@ -1,13 +1,15 @@
-import enum
-from typing import Counter, FrozenSet, List, Optional, cast
+from typing import (Any, Counter, Dict, FrozenSet, Iterable, List, Optional, Set,
+                    Tuple, cast)
 
-from libsyntyche.widgets import Signal0, kill_theming, mk_signal0
+from libsyntyche.widgets import Signal0, Signal1, kill_theming, mk_signal0
 from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtCore import Qt, pyqtProperty  # type: ignore
 from PyQt5.QtGui import QColor
 
 from . import shared
-from .shared import ImageData, ListWidget2, TagState, TagStates
+from .shared import ImageData, TagState, TagStates
+from .tag_search import TagSearchIndex
+from .tag_table import TAG_TABLE
 
 
 class UntaggedToggle(QtWidgets.QCheckBox):
@@ -78,6 +80,13 @@ class TagListContainer(QtWidgets.QWidget):
         self.show_untagged_toggle.setObjectName('show_untagged_toggle')
         layout.addWidget(self.show_untagged_toggle, stretch=1)
 
+        # Tag search
+        self.search_input = QtWidgets.QLineEdit(self)
+        self.search_input.setObjectName('tag_search_input')
+        self.search_input.setPlaceholderText('Search tags')
+        self.search_input.setClearButtonEnabled(True)
+        layout.addWidget(self.search_input)
+
         # Tag list
         self.list_widget = TagListWidget(self)
         self.list_widget.setObjectName('tag_list')
@@ -86,28 +95,27 @@ class TagListContainer(QtWidgets.QWidget):
         layout.addWidget(self.list_widget)
 
         self.tag_state_updated = self.list_widget.tag_state_updated
+        cast(Signal1[str], self.search_input.textChanged).connect(
+            self.list_widget.tag_model.set_search_text)
         self.show_untagged_toggle.toggled.connect(self.tag_state_updated.emit)
 
         self.sort_button = shared.make_sort_menu(
             self,
-            cast(QtCore.QSortFilterProxyModel, self.list_widget.model()),
+            self.list_widget.tag_model,
             {'Name': shared.TAG_NAME,
              'Count': shared.TAG_COUNT},
         )
         buttons_hbox.addWidget(self.sort_button)
 
         def clear_tag_filters() -> None:
-            for item in self.list_widget.items():
-                item.tag_state = TagState.DEFAULT
+            self.list_widget.tag_model.clear_tag_states()
             self.show_untagged_toggle.setChecked(False)
             self.list_widget.tag_state_updated.emit()
 
         cast(Signal0, clear_button.clicked).connect(clear_tag_filters)
 
     def set_current_image_data(self, image: Optional[ImageData]) -> None:
-        self.list_widget.current_image_tags = (
-            frozenset() if image is None else frozenset(image.tags)
-        )
+        self.list_widget.current_image_tags = frozenset() if image is None else image.tags
         self.show_untagged_toggle.current_is_untagged = (image is not None
                                                          and len(image.tags) == 0)
 
@@ -118,58 +126,217 @@ class TagListContainer(QtWidgets.QWidget):
         self.show_untagged_toggle.selected_has_untagged = any(not image.tags for image in images)
 
     def get_tag_states(self) -> TagStates:
-        whitelist = set()
-        blacklist = set()
         untagged_state = (TagState.WHITELISTED
                           if self.show_untagged_toggle.isChecked()
                           else TagState.DEFAULT)
-        for tag_item in self.list_widget.items():
-            state = tag_item.tag_state
-            tag = tag_item.tag_name
-            if state == TagState.WHITELISTED:
-                whitelist.add(tag)
-            elif state == TagState.BLACKLISTED:
-                blacklist.add(tag)
-        return TagStates(whitelist=frozenset(whitelist),
-                         blacklist=frozenset(blacklist),
+        model = self.list_widget.tag_model
+        return TagStates(whitelist=frozenset(model.tags_with_state(TagState.WHITELISTED)),
+                         blacklist=frozenset(model.tags_with_state(TagState.BLACKLISTED)),
                          untagged_state=untagged_state)
 
-    def set_tags(self, untagged: int, tags: Counter[str]) -> None:
-        self.list_widget.clear()
-        for tag, count in tags.most_common():
-            self.list_widget.create_tag(tag, count)
+    def set_tags(self, untagged: int, tags: Counter[int]) -> None:
+        self.list_widget.tag_model.set_tags(tags)
         self.show_untagged_toggle.total_count = untagged
         self.show_untagged_toggle.update()
-        model = cast(QtCore.QSortFilterProxyModel, self.list_widget.model())
-        model.sort(0, model.sortOrder())
-
-    def update_tags(self, untagged: int, tag_count_diff: Counter[str],
-                    created_tags: FrozenSet[str]) -> None:
-        tag_items_to_delete: List[int] = []
-        for i, tag_item in enumerate(self.list_widget.items()):
-            tag = tag_item.tag_name
-            diff = tag_count_diff.get(tag, 0)
-            if diff != 0:
-                new_count = tag_item.tag_count + diff
-                if new_count <= 0:
-                    tag_items_to_delete.append(i)
-                tag_item.tag_count = new_count
-        # Get rid of the items in reverse order to not mess up the numbers
-        for i in reversed(tag_items_to_delete):
-            self.list_widget.takeRow(i)
-        for tag in created_tags:
-            count = tag_count_diff.get(tag, 0)
-            if count > 0:
-                self.list_widget.create_tag(tag, count)
+
+    def update_tags(self, untagged: int, tag_count_diff: Counter[int],
+                    created_tags: FrozenSet[int]) -> None:
+        self.list_widget.tag_model.update_tag_counts(tag_count_diff, created_tags)
         self.show_untagged_toggle.total_count = untagged
         self.show_untagged_toggle.update()
 
-    def update_visible_tags(self, tag_count: Counter[str]) -> None:
-        for item in self.list_widget.items():
-            tag = item.tag_name
+    def update_visible_tags(self, tag_count: Counter[int]) -> None:
+        self.list_widget.tag_model.set_visible_counts(tag_count)
+
+
+def changed_ranges(rows: Iterable[int]) -> Iterable[Tuple[int, int]]:
+    # Group sorted row numbers into (first, last) runs of consecutive rows
+    first = last = -2
+    for row in rows:
+        if row != last + 1:
+            if first >= 0:
+                yield (first, last)
+            first = row
+        last = row
+    if first >= 0:
+        yield (first, last)
+
+
+class TagListModel(QtCore.QAbstractListModel):
+    """
+    The tags are stored by id in plain lists, and the model keeps track of
+    which id is in which row itself. These ids are the tags' positions in
+    the lists, not the ones from the tag table, which are only used to get
+    things in and out of the model. That way changing the counts or states
+    of many tags only needs a few dataChanged signals, and sorting is done
+    once when asked for instead of after every change like with a proxy.
+
+    Only the tags matching the search text get a row, but all of them are
+    kept up to date.
+    """
+    def __init__(self, parent: Optional[QtCore.QObject] = None) -> None:
+        super().__init__(parent)
+        # Model id -> tag table id, and the other way around
+        self.tags: List[int] = []
+        self.ids: Dict[int, int] = {}
+        self.names: List[str] = []
+        self.totals: List[int] = []
+        self.visible: List[int] = []
+        self.states: List[TagState] = []
+        # All tag ids in sorted order, and the ones that are shown
+        self.order: List[int] = []
+        self.rows: List[int] = []
+        self.search_text = ''
+        self.search_index = TagSearchIndex()
+        self.matches: Optional[Set[int]] = None
+        self._sort_role = shared.TAG_NAME
+        self._sort_order = Qt.AscendingOrder
+
+    def rowCount(self, parent: QtCore.QModelIndex = QtCore.QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.rows)
+
+    def data(self, index: QtCore.QModelIndex, role: int = Qt.DisplayRole) -> Any:
+        if not index.isValid() or index.row() >= len(self.rows):
+            return None
+        tag_id = self.rows[index.row()]
+        if role == Qt.DisplayRole:
+            return f'{self.names[tag_id]}   ({self.visible[tag_id]}/{self.totals[tag_id]})'
+        elif role == shared.TAG_NAME:
+            return self.names[tag_id]
+        elif role == shared.TAG_ID:
+            return self.tags[tag_id]
+        elif role == shared.TAG_COUNT:
+            return self.totals[tag_id]
+        elif role == shared.VISIBLE_TAG_COUNT:
+            return self.visible[tag_id]
+        elif role == shared.TAG_STATE:
+            return self.states[tag_id]
+        return None
+
+    def _emit_changed(self, rows: Iterable[int], roles: List[int]) -> None:
+        for first, last in changed_ranges(sorted(rows)):
+            self.dataChanged.emit(self.index(first), self.index(last), roles)
+
+    def set_tags(self, tags: Counter[int],
+                 states: Optional[Dict[int, TagState]] = None) -> None:
+        self.beginResetModel()
+        self.tags = list(tags)
+        self.names = [TAG_TABLE.name(tag) for tag in self.tags]
+        self.totals = [tags[tag] for tag in self.tags]
+        self.visible = list(self.totals)
+        if states is None:
+            self.states = [TagState.DEFAULT] * len(self.tags)
+        else:
+            self.states = [states.get(tag, TagState.DEFAULT) for tag in self.tags]
+        self.ids = {tag: tag_id for tag_id, tag in enumerate(self.tags)}
+        self.order = self._sorted_ids(range(len(self.names)))
+        self.search_index.build(self.names)
+        self.matches = self.search_index.search(self.search_text)
+        self._update_rows()
+        self.endResetModel()
+
+    def _update_rows(self) -> None:
+        if self.matches is None:
+            self.rows = self.order
+        else:
+            matches = self.matches
+            self.rows = [tag_id for tag_id in self.order if tag_id in matches]
+
+    def set_search_text(self, text: str) -> None:
+        matches = self.search_index.search(text)
+        self.search_text = text
+        if matches == self.matches:
+            return
+        self.beginResetModel()
+        self.matches = matches
+        self._update_rows()
+        self.endResetModel()
+
+    def update_tag_counts(self, tag_count_diff: Counter[int],
+                          created_tags: FrozenSet[int]) -> None:
+        changed_ids: List[int] = []
+        for tag, diff in tag_count_diff.items():
+            tag_id = self.ids.get(tag)
+            if tag_id is not None and diff:
+                self.totals[tag_id] += diff
+                changed_ids.append(tag_id)
+        removed = any(self.totals[tag_id] <= 0 for tag_id in changed_ids)
+        added = [tag for tag in created_tags
+                 if tag not in self.ids and tag_count_diff.get(tag, 0) > 0]
+        if removed or added:
+            # Only the tagging dialog does this, so just redo everything
+            # but keep the states of the tags that are still around
+            old_states = {self.tags[tag_id]: self.states[tag_id]
+                          for tag_id in range(len(self.tags))}
+            tags = Counter({self.tags[tag_id]: self.totals[tag_id]
+                            for tag_id in range(len(self.tags))
+                            if self.totals[tag_id] > 0})
+            tags.update({tag: tag_count_diff[tag] for tag in added})
+            self.set_tags(tags, old_states)
+            return
+        self._emit_changed(self._rows_of(changed_ids), [Qt.DisplayRole, shared.TAG_COUNT])
+        if self._sort_role == shared.TAG_COUNT and changed_ids:
+            self.sort(0, self._sort_order)
+
+    def _rows_of(self, tag_ids: Iterable[int]) -> Iterable[int]:
+        wanted = set(tag_ids)
+        return (row for row, tag_id in enumerate(self.rows) if tag_id in wanted)
+
+    def set_visible_counts(self, tag_count: Counter[int]) -> None:
+        changed_ids: List[int] = []
+        for tag_id, tag in enumerate(self.tags):
             new_count = tag_count[tag]
-            item.visible_tag_count = new_count
-            item.setText(self.list_widget._tag_format(tag, new_count, item.tag_count))
+            if new_count != self.visible[tag_id]:
+                self.visible[tag_id] = new_count
+                changed_ids.append(tag_id)
+        self._emit_changed(self._rows_of(changed_ids),
+                           [Qt.DisplayRole, shared.VISIBLE_TAG_COUNT])
+
+    def tags_with_state(self, state: TagState) -> Iterable[int]:
+        return (self.tags[tag_id] for tag_id, tag_state in enumerate(self.states)
+                if tag_state == state)
+
+    def set_tag_state(self, row: int, state: TagState) -> None:
+        self.states[self.rows[row]] = state
+        self._emit_changed([row], [shared.TAG_STATE])
+
+    def clear_tag_states(self) -> None:
+        changed_ids = [tag_id for tag_id, state in enumerate(self.states)
+                       if state != TagState.DEFAULT]
+        for tag_id in changed_ids:
+            self.states[tag_id] = TagState.DEFAULT
+        self._emit_changed(self._rows_of(changed_ids), [shared.TAG_STATE])
+
+    # The same interface as QSortFilterProxyModel, for the sort menu
+
+    def setSortRole(self, role: int) -> None:
+        self._sort_role = role
+
+    def sortOrder(self) -> Qt.SortOrder:
+        return self._sort_order
+
+    def _sorted_ids(self, tag_ids: Iterable[int]) -> List[int]:
+        names = self.names
+        key: Any
+        if self._sort_role == shared.TAG_COUNT:
+            totals = self.totals
+            key = lambda tag_id: (totals[tag_id], names[tag_id])  # noqa: E731
+        else:
+            key = names.__getitem__
+        return sorted(tag_ids, key=key, reverse=self._sort_order == Qt.DescendingOrder)
+
+    def sort(self, column: int, order: Qt.SortOrder = Qt.AscendingOrder) -> None:
+        self._sort_order = order
+        self.layoutAboutToBeChanged.emit()
+        old_rows = self.rows
+        self.order = self._sorted_ids(self.order)
+        self._update_rows()
+        new_row_of = {tag_id: row for row, tag_id in enumerate(self.rows)}
+        old_indexes = self.persistentIndexList()
+        self.changePersistentIndexList(
+            old_indexes,
+            [self.index(new_row_of[old_rows[index.row()]]) for index in old_indexes])
+        self.layoutChanged.emit()
 
 
 class TagListDelegate(QtWidgets.QStyledItemDelegate):
@@ -177,18 +344,18 @@ class TagListDelegate(QtWidgets.QStyledItemDelegate):
               option: QtWidgets.QStyleOptionViewItem,
               index: QtCore.QModelIndex) -> None:
         parent = cast(TagListWidget, option.styleObject)
-        item = parent.itemFromIndex(index)
-        tag = item.tag_name
+        tag = cast(str, index.data(shared.TAG_NAME))
+        tag_id = cast(int, index.data(shared.TAG_ID))
         painter.setRenderHints(QtGui.QPainter.Antialiasing)
         indicator_width = 12
         indicator_radius = int(indicator_width * 0.8 / 2)
         padding = (option.rect.height() - option.fontMetrics.height()) // 2
         rect = option.rect.adjusted(padding + indicator_width, padding, -padding, -padding)
-        if parent.current_image_tags and tag in parent.current_image_tags:
+        if parent.current_image_tags and tag_id in parent.current_image_tags:
             painter.fillRect(option.rect, cast(QColor, parent.current_image_tags_color))
-        elif tag in parent.selected_images_tags:
+        elif tag_id in parent.selected_images_tags:
             painter.fillRect(option.rect, cast(QColor, parent.selected_images_tags_color))
-        state = item.tag_state
+        state = cast(TagState, index.data(shared.TAG_STATE))
         colors = {TagState.WHITELISTED: cast(QColor, parent.whitelisted_color),
                   TagState.DEFAULT: cast(QColor, parent.default_color),
                   TagState.BLACKLISTED: cast(QColor, parent.blacklisted_color)}
@@ -196,9 +363,9 @@ class TagListDelegate(QtWidgets.QStyledItemDelegate):
         font = option.font
         font.setBold(False)
         font.setItalic(False)
-        count = item.tag_count
-        visible_count = item.visible_tag_count
-        if item.hovering:
+        count = cast(int, index.data(shared.TAG_COUNT))
+        visible_count = cast(int, index.data(shared.VISIBLE_TAG_COUNT))
+        if index.row() == parent.hover_row:
             painter.fillRect(option.rect, QColor(255, 255, 255, 0x33))
         if (count == 0 or visible_count == 0) and state != TagState.BLACKLISTED:
             color.setAlphaF(0.4)
@@ -218,86 +385,38 @@ class TagListDelegate(QtWidgets.QStyledItemDelegate):
         painter.drawText(rect, Qt.AlignRight | Qt.TextSingleLine, f'{visible_count} / {count}')
 
 
-class TagListItem(shared.CustomDrawListItem):
-    @property
-    def tag_count(self) -> int:
-        return cast(int, self.data(shared.TAG_COUNT))
-
-    @tag_count.setter
-    def tag_count(self, tag_count: int) -> None:
-        self.setData(tag_count, shared.TAG_COUNT)
-
-    @property
-    def tag_name(self) -> str:
-        return cast(str, self.data(shared.TAG_NAME))
-
-    @tag_name.setter
-    def tag_name(self, tag_name: str) -> None:
-        self.setData(tag_name, shared.TAG_NAME)
-
-    @property
-    def tag_state(self) -> TagState:
-        return cast(TagState, self.data(shared.TAG_STATE))
-
-    @tag_state.setter
-    def tag_state(self, tag_state: TagState) -> None:
-        self.setData(tag_state, shared.TAG_STATE)
-
-    @property
-    def visible_tag_count(self) -> int:
-        return cast(int, self.data(shared.VISIBLE_TAG_COUNT))
-
-    @visible_tag_count.setter
-    def visible_tag_count(self, visible_tag_count: int) -> None:
-        self.setData(visible_tag_count, shared.VISIBLE_TAG_COUNT)
-
-
-class TagListWidget(shared.CustomDrawListWidget[TagListItem]):
+class TagListWidget(shared.CustomDrawListView):
     tag_state_updated = mk_signal0()
 
     def __init__(self, parent: QtWidgets.QWidget) -> None:
         super().__init__(parent, TagListDelegate)
-        self._selected_images_tags: FrozenSet[str] = frozenset()
-        self._current_image_tags: FrozenSet[str] = frozenset()
+        self.tag_model = TagListModel(self)
+        self.setModel(self.tag_model)
+        self._selected_images_tags: FrozenSet[int] = frozenset()
+        self._current_image_tags: FrozenSet[int] = frozenset()
         self._default_color = QColor(Qt.white)
         self._whitelisted_color = QColor(Qt.green)
         self._blacklisted_color = QColor(Qt.red)
         self._current_image_tags_color = QColor(Qt.yellow)
         self._selected_images_tags_color = QColor(Qt.blue)
 
-    @staticmethod
-    def _tag_format(tag: str, visible: int, total: int) -> str:
-        return f'{tag}   ({visible}/{total})'
-
-    def create_tag(self, tag: str, count: int) -> None:
-        item = TagListItem(self._tag_format(tag, count, count))
-        item.tag_name = tag
-        item.tag_count = count
-        item.visible_tag_count = count
-        item.tag_state = TagState.DEFAULT
-        self.addItem(item)
-
     @property
-    def selected_images_tags(self) -> FrozenSet[str]:
+    def selected_images_tags(self) -> FrozenSet[int]:
         return self._selected_images_tags
 
     @selected_images_tags.setter
-    def selected_images_tags(self, tags: FrozenSet[str]) -> None:
+    def selected_images_tags(self, tags: FrozenSet[int]) -> None:
         self._selected_images_tags = tags
-        self.update()
+        self.viewport().update()
 
     @property
-    def current_image_tags(self) -> FrozenSet[str]:
+    def current_image_tags(self) -> FrozenSet[int]:
         return self._current_image_tags
 
     @current_image_tags.setter
-    def current_image_tags(self, tags: FrozenSet[str]) -> None:
+    def current_image_tags(self, tags: FrozenSet[int]) -> None:
         self._current_image_tags = tags
-        self.update()
-
-    def clear(self) -> None:
-        self.last_item = None
-        super().clear()
+        self.viewport().update()
 
     @pyqtProperty(QColor)
     def default_color(self) -> QColor:
@@ -340,10 +459,10 @@ class TagListWidget(shared.CustomDrawListWidget[TagListItem]):
         self._current_image_tags_color = color
 
     def mousePressEvent(self, event: QtGui.QMouseEvent) -> None:
-        item = self.itemAt(event.pos())
-        if item is not None:
+        index = self.indexAt(event.pos())
+        if index.isValid():
             new_state: Optional[TagState] = None
-            state = item.tag_state
+            state = cast(TagState, index.data(shared.TAG_STATE))
             if event.button() == Qt.LeftButton:
                 if state == TagState.DEFAULT:
                     new_state = TagState.WHITELISTED
@@ -355,5 +474,5 @@ class TagListWidget(shared.CustomDrawListWidget[TagListItem]):
                 else:
                     new_state = TagState.DEFAULT
             if new_state is not None:
-                item.tag_state = new_state
+                self.tag_model.set_tag_state(index.row(), new_state)
                 self.tag_state_updated.emit()
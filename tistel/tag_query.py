@@ -0,0 +1,219 @@
+from __future__ import annotations
+
+import bisect
+import fnmatch
+import re
+from typing import List, NamedTuple, Optional, Sequence, Tuple, Union
+
+from .shared import TagState, TagStates
+from .tag_index import TagIndex
+from .tag_table import TAG_TABLE
+
+
+class QueryError(Exception):
+    pass
+
+
+class Tag(NamedTuple):
+    name: str
+
+
+class Pattern(NamedTuple):
+    pattern: str
+
+
+class AnyOf(NamedTuple):
+    tag_ids: Tuple[int, ...]
+
+
+class Untagged(NamedTuple):
+    pass
+
+
+class Not(NamedTuple):
+    operand: Node
+
+
+class And(NamedTuple):
+    operands: Tuple[Node, ...]
+
+
+class Or(NamedTuple):
+    operands: Tuple[Node, ...]
+
+
+Node = Union[Tag, Pattern, AnyOf, Untagged, Not, And, Or]
+
+EVERYTHING: Node = And(())
+
+_TOKEN_RE = re.compile(r'\s*(?:(?P<op>[()|&!-])|"(?P<quoted>[^"]*)("|$)|(?P<tag>[^\s()|&"]+))')
+_WILDCARDS = frozenset('*?[')
+
+
+def _tokenize(text: str) -> List[Tuple[str, str]]:
+    tokens: List[Tuple[str, str]] = []
+    pos = 0
+    while pos < len(text):
+        match = _TOKEN_RE.match(text, pos)
+        if match is None or match.end() == pos:
+            break
+        pos = match.end()
+        if match['op'] is not None:
+            tokens.append(('op', match['op']))
+        elif match['quoted'] is not None:
+            if not match[3]:
+                raise QueryError('unterminated quote')
+            tokens.append(('tag', match['quoted']))
+        elif match['tag'] is not None:
+            name = match['tag']
+            tokens.append(('pattern' if _WILDCARDS.intersection(name) else 'tag', name))
+    return tokens
+
+
+class _Parser:
+    def __init__(self, text: str) -> None:
+        self.tokens = _tokenize(text)
+        self.pos = 0
+
+    def peek(self) -> Optional[Tuple[str, str]]:
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def parse(self) -> Node:
+        if not self.tokens:
+            return EVERYTHING
+        node = self.parse_or()
+        token = self.peek()
+        if token is not None:
+            raise QueryError(f'unexpected {token[1]!r}')
+        return node
+
+    def parse_or(self) -> Node:
+        operands = [self.parse_and()]
+        while self.peek() == ('op', '|'):
+            self.pos += 1
+            operands.append(self.parse_and())
+        return operands[0] if len(operands) == 1 else Or(tuple(operands))
+
+    def parse_and(self) -> Node:
+        operands = [self.parse_unary()]
+        while True:
+            token = self.peek()
+            if token == ('op', '&'):
+                self.pos += 1
+            elif token is None or token in {('op', '|'), ('op', ')')}:
+                break
+            operands.append(self.parse_unary())
+        return operands[0] if len(operands) == 1 else And(tuple(operands))
+
+    def parse_unary(self) -> Node:
+        token = self.peek()
+        if token is None:
+            raise QueryError('unexpected end of query')
+        self.pos += 1
+        kind, value = token
+        if kind == 'tag':
+            return Tag(value)
+        elif kind == 'pattern':
+            return Pattern(value)
+        elif value in {'-', '!'}:
+            return Not(self.parse_unary())
+        elif value == '(':
+            node = self.parse_or()
+            if self.peek() != ('op', ')'):
+                raise QueryError('missing closing parenthesis')
+            self.pos += 1
+            return node
+        raise QueryError(f'unexpected {value!r}')
+
+
+def parse(text: str) -> Node:
+    return _Parser(text).parse()
+
+
+def from_tag_states(states: TagStates) -> Node:
+    operands: List[Node] = []
+    if states.untagged_state == TagState.WHITELISTED:
+        operands.append(Untagged())
+    elif states.untagged_state == TagState.BLACKLISTED:
+        operands.append(Not(Untagged()))
+    # The tag states are ids already, so they don't need compiling
+    operands.extend(AnyOf((tag_id,)) for tag_id in sorted(states.whitelist))
+    operands.extend(Not(AnyOf((tag_id,))) for tag_id in sorted(states.blacklist))
+    return And(tuple(operands))
+
+
+def expand_pattern(pattern: str, tag_names: Sequence[str]) -> Tuple[str, ...]:
+    prefix = pattern[:-1]
+    if pattern.endswith('*') and not _WILDCARDS.intersection(prefix):
+        # Plain prefixes can be looked up in the sorted tag list directly
+        start = bisect.bisect_left(tag_names, prefix)
+        end = start
+        while end < len(tag_names) and tag_names[end].startswith(prefix):
+            end += 1
+        return tuple(tag_names[start:end])
+    return tuple(name for name in tag_names if fnmatch.fnmatchcase(name, pattern))
+
+
+def _tag_ids(names: Sequence[str]) -> Tuple[int, ...]:
+    tag_ids = (TAG_TABLE.lookup(name) for name in names)
+    return tuple(tag_id for tag_id in tag_ids if tag_id is not None)
+
+
+def compile_query(node: Node, tag_names: Sequence[str]) -> Node:
+    if isinstance(node, Tag):
+        return AnyOf(_tag_ids((node.name,)))
+    elif isinstance(node, Pattern):
+        return AnyOf(_tag_ids(expand_pattern(node.pattern, tag_names)))
+    elif isinstance(node, Not):
+        return Not(compile_query(node.operand, tag_names))
+    elif isinstance(node, And):
+        operands: List[Node] = []
+        excluded: List[int] = []
+        for operand in node.operands:
+            compiled = compile_query(operand, tag_names)
+            # Flatten nested ANDs so the negations can be merged below
+            for term in (compiled.operands if isinstance(compiled, And) else [compiled]):
+                if isinstance(term, Not) and isinstance(term.operand, AnyOf):
+                    excluded.extend(term.operand.tag_ids)
+                else:
+                    operands.append(term)
+        # Check the positive terms first since they tend to narrow things down
+        operands.sort(key=lambda x: isinstance(x, Not))
+        if excluded:
+            # NOT a AND NOT b is the same as NOT (a OR b), which only needs
+            # one pass over the rows
+            operands.append(Not(AnyOf(tuple(dict.fromkeys(excluded)))))
+        return And(tuple(operands))
+    elif isinstance(node, Or):
+        return Or(tuple(compile_query(operand, tag_names) for operand in node.operands))
+    return node
+
+
+def evaluate(plan: Node, index: TagIndex) -> int:
+    if isinstance(plan, AnyOf):
+        result = 0
+        for tag_id in plan.tag_ids:
+            result |= index.tags.get(tag_id, 0)
+        return result
+    elif isinstance(plan, Untagged):
+        return index.untagged
+    elif isinstance(plan, Not):
+        return index.all_rows & ~evaluate(plan.operand, index)
+    elif isinstance(plan, And):
+        result = index.all_rows
+        for operand in plan.operands:
+            if not result:
+                break
+            if isinstance(operand, Not):
+                result &= ~evaluate(operand.operand, index)
+            else:
+                result &= evaluate(operand, index)
+        return result
+    elif isinstance(plan, Or):
+        result = 0
+        for operand in plan.operands:
+            result |= evaluate(operand, index)
+        return result
+    raise QueryError(f'{plan!r} has not been compiled')
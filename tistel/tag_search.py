@@ -0,0 +1,31 @@
+import bisect
+from typing import List, Optional, Sequence, Set
+
+
+class TagSearchIndex:
+    """
+    A sorted suffix array over the (case folded) tag names. Every tag
+    containing the query has a suffix starting with it, and all of those
+    sit next to each other in the array, so a search is two bisects plus
+    going through the matches.
+    """
+    def __init__(self) -> None:
+        self.suffixes: List[str] = []
+        self.suffix_ids: List[int] = []
+
+    def build(self, names: Sequence[str]) -> None:
+        entries = sorted((name.casefold()[start:], tag_id)
+                         for tag_id, name in enumerate(names)
+                         for start in range(len(name)))
+        self.suffixes = [suffix for suffix, _ in entries]
+        self.suffix_ids = [tag_id for _, tag_id in entries]
+
+    def search(self, text: str) -> Optional[Set[int]]:
+        """Return the ids of the matching tags, or None if nothing is filtered."""
+        query = text.strip().casefold()
+        if not query:
+            return None
+        start = bisect.bisect_left(self.suffixes, query)
+        # Everything starting with the query sorts before this
+        end = bisect.bisect_left(self.suffixes, query + '\U0010ffff', start)
+        return set(self.suffix_ids[start:end])
@@ -0,0 +1,47 @@
+import sys
+import threading
+from typing import Dict, FrozenSet, Iterable, List, Optional
+
+
+class TagTable:
+    """
+    Every tag name the program has seen, handed out as a small integer id.
+
+    Everything past the files and the screen passes tags around as ids,
+    so comparing and counting them never has to hash a string. Like the
+    path table, ids are never reused or removed, adding names takes a
+    lock and looking them up doesn't.
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._names: List[str] = []
+        self._ids: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def intern(self, name: str) -> int:
+        tag_id = self._ids.get(name)
+        if tag_id is None:
+            with self._lock:
+                tag_id = self._ids.get(name)
+                if tag_id is None:
+                    tag_id = len(self._names)
+                    self._names.append(sys.intern(name))
+                    self._ids[name] = tag_id
+        return tag_id
+
+    def intern_all(self, names: Iterable[str]) -> FrozenSet[int]:
+        return frozenset(self.intern(name) for name in names)
+
+    def lookup(self, name: str) -> Optional[int]:
+        return self._ids.get(name)
+
+    def name(self, tag_id: int) -> str:
+        return self._names[tag_id]
+
+    def sorted_names(self, tag_ids: Iterable[int]) -> List[str]:
+        return sorted(self._names[tag_id] for tag_id in tag_ids)
+
+
+TAG_TABLE = TagTable()
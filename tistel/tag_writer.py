@@ -0,0 +1,91 @@
+import logging
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+from libsyntyche.widgets import mk_signal1
+from PyQt5 import QtCore
+
+from . import jfti
+from .cache_service import CacheService
+from .journal import GROUP_SIZE, Journal, TagWrite
+from .path_table import PATHS
+from .tag_table import TAG_TABLE
+
+# How many times to try writing a file before giving up on it
+WRITE_ATTEMPTS = 3
+RETRY_DELAY = 0.5
+
+
+class TagWriter(QtCore.QObject):
+    """
+    Writes tags to the files on its own thread, through the journal.
+
+    The rest of the program has already updated its in-memory tags when
+    the writes get here, so all this reports back is how each one went.
+    """
+    # List[Tuple[TagWrite, bool]] for each finished group of writes
+    writes_done = mk_signal1(list)
+
+    def __init__(self, cache_service: CacheService) -> None:
+        super().__init__()
+        self.cache_service = cache_service
+        self.journal = Journal()
+
+    def _write(self, path: Path, write: TagWrite) -> bool:
+        tags = TAG_TABLE.sorted_names(write.new_tags)
+        for attempt in range(1, WRITE_ATTEMPTS + 1):
+            try:
+                jfti.set_tags(path, set(tags))
+            except Exception:
+                logging.exception(f'failed to set tags {tags!r} '
+                                  f'in {path!r} (attempt {attempt})')
+                if attempt < WRITE_ATTEMPTS:
+                    time.sleep(RETRY_DELAY * attempt)
+            else:
+                return True
+        return False
+
+    def write_tags(self, writes: List[TagWrite]) -> None:
+        for group_start in range(0, len(writes), GROUP_SIZE):
+            group = writes[group_start:group_start + GROUP_SIZE]
+            records: List[Dict[str, Any]] = []
+            results: List[Tuple[TagWrite, bool]] = []
+            try:
+                entry_ids = self.journal.log_intents(group)
+            except Exception:
+                # Without the intents logged there's no way to recover from
+                # a crash halfway through, so don't touch the files at all
+                logging.exception('failed to log tag writes to the journal')
+                self.writes_done.emit([(write, False) for write in group])
+                continue
+            try:
+                for entry_id, write in zip(entry_ids, group):
+                    path = PATHS.path(write.image_id)
+                    success = self._write(path, write)
+                    if success:
+                        try:
+                            records.append(self.journal.done_record(entry_id, path))
+                        except Exception:
+                            logging.exception(f'failed to stat {path!r} after writing it')
+                            success = False
+                    if not success:
+                        records.append(self.journal.failed_record(entry_id))
+                    results.append((write, success))
+            finally:
+                try:
+                    self.journal.commit(records)
+                except Exception:
+                    logging.exception('failed to log tag write results to the journal')
+                # Everything in the group has to be reported back one way or
+                # another, or the main window keeps waiting for it
+                results.extend((write, False) for write in group[len(results):])
+                self.writes_done.emit(results)
+        # Everything in this batch has been written, so move it into the cache.
+        # If the cache doesn't get saved after this, the files' new mtimes
+        # make the indexer read them again anyway.
+        self.cache_service.apply_journal(self.journal)
+        # Entries from a recovery that failed are still in there, and have to
+        # be left for the next start to try again
+        if self.cache_service.recovered:
+            self.journal.checkpoint()
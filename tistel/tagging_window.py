@@ -1,5 +1,8 @@
+import html
+import itertools
 from typing import (Any, Counter, Dict, FrozenSet, List, NamedTuple, Optional,
                     Set, Tuple, cast)
+from urllib.parse import quote, unquote
 
 from libsyntyche.widgets import Signal0, Signal1, mk_signal0, mk_signal1
 from PyQt5 import QtCore, QtGui, QtWidgets
@@ -7,21 +10,12 @@ from PyQt5.QtCore import Qt
 from PyQt5.QtWidgets import QDialogButtonBox
 
 from . import shared
-from .shared import (CustomDrawListItem, CustomDrawListWidget, ImageData,
-                     ListWidget2)
+from .shared import CustomDrawListView, ImageData
+from .tag_cooccurrence import TagCooccurrence
+from .tag_table import TAG_TABLE
 
-
-class SortProxyModel(QtCore.QSortFilterProxyModel):
-    def lessThan(self, left: QtCore.QModelIndex, right: QtCore.QModelIndex) -> bool:
-        model = cast(QtGui.QStandardItemModel, self.sourceModel())
-
-        def get_data(x: QtCore.QModelIndex) -> Tuple[bool, Any]:
-            item = cast(TaggingListItem, model.itemFromIndex(x))
-            checked = item.checkState() == Qt.Unchecked
-            if self.sortOrder() == Qt.DescendingOrder:
-                checked = not checked
-            return (checked, x.data(self.sortRole()))
-        return get_data(left) < get_data(right)
+# How many related tags to suggest at most
+SUGGESTION_COUNT = 8
 
 
 class TagInput(QtWidgets.QLineEdit):
@@ -78,9 +72,9 @@ class TagListDelegate(QtWidgets.QStyledItemDelegate):
     def paint(self, painter: QtGui.QPainter,
               option: QtWidgets.QStyleOptionViewItem,
               index: QtCore.QModelIndex) -> None:
-        parent = cast(CustomDrawListWidget[TaggingListItem], option.styleObject)
-        item = parent.itemFromIndex(index)
-        tag = item.tag_name
+        parent = cast(TagListWidget, option.styleObject)
+        tag = cast(str, index.data(shared.TAG_NAME))
+        check_state = cast(Qt.CheckState, index.data(Qt.CheckStateRole))
         painter.setRenderHints(QtGui.QPainter.Antialiasing)
         padding = (option.rect.height() - option.fontMetrics.height()) // 2
         rect = option.rect.adjusted(padding, padding, -padding, -padding)
@@ -89,10 +83,10 @@ class TagListDelegate(QtWidgets.QStyledItemDelegate):
         painter.fillRect(cb_rect, Qt.white)
         # TODO: de-hardcode this?
         check_color = QtGui.QColor('#06a')
-        if item.checkState() == Qt.PartiallyChecked:
+        if check_state == Qt.PartiallyChecked:
             bw = 2
             painter.fillRect(cb_rect.adjusted(bw, bw, -bw, -bw), check_color)
-        elif item.checkState() == Qt.Checked:
+        elif check_state == Qt.Checked:
             old_pen = painter.pen()
             new_pen = QtGui.QPen(check_color)
             new_pen.setWidth(3)
@@ -102,76 +96,219 @@ class TagListDelegate(QtWidgets.QStyledItemDelegate):
                                  cb_rect.center() + QtCore.QPoint(0, int(w * 0.45)),
                                  cb_rect.topRight() + QtCore.QPoint(-int(w * 0.2), int(w * 0.25)))
             painter.setPen(old_pen)
-        count = item.tag_count
-        visible_count = item.visible_tag_count
-        if item.hovering:
+        count = cast(int, index.data(shared.TAG_COUNT))
+        visible_count = cast(int, index.data(shared.VISIBLE_TAG_COUNT))
+        if index.row() == parent.hover_row:
             painter.fillRect(option.rect, QtGui.QColor(255, 255, 255, 0x33))
-        painter.drawText(rect, Qt.TextSingleLine, tag + (' (NEW)' if item.is_new else ''))
+        painter.drawText(rect, Qt.TextSingleLine,
+                         tag + (' (NEW)' if index.data(shared.IS_NEW) else ''))
         painter.drawText(rect, Qt.AlignRight | Qt.TextSingleLine, f'{visible_count} / {count}')
 
 
-class TaggingListItem(CustomDrawListItem):
-    def __init__(self, text: str) -> None:
-        super().__init__(text)
-        self.setCheckable(True)
-        self.setEditable(False)
-
-    @property
-    def is_new(self) -> bool:
-        return cast(bool, self.data(shared.IS_NEW))
-
-    @is_new.setter
-    def is_new(self, is_new: bool) -> None:
-        self.setData(is_new, shared.IS_NEW)
+class TagChanges(NamedTuple):
+    tags_to_add: FrozenSet[int]
+    tags_to_remove: FrozenSet[int]
 
-    @property
-    def tag_count(self) -> int:
-        return cast(int, self.data(shared.TAG_COUNT))
 
-    @tag_count.setter
-    def tag_count(self, total_count: int) -> None:
-        self.setData(total_count, shared.TAG_COUNT)
+class TaggingListModel(QtCore.QAbstractListModel):
+    """
+    All tags in the library, kept between uses of the tagging window.
 
-    @property
-    def tag_name(self) -> str:
-        return cast(str, self.data(shared.TAG_NAME))
+    Like the sidebar's tag list, the tags are stored by id in plain lists
+    and the model sorts itself. Tags added in the window but not applied
+    yet are kept at the end of the lists and dropped before the next use.
+    """
+    def __init__(self, parent: Optional[QtCore.QObject] = None) -> None:
+        super().__init__(parent)
+        # Model id -> tag table id, and the other way around
+        self.tags: List[int] = []
+        self.ids: Dict[int, int] = {}
+        self.names: List[str] = []
+        self.totals: List[int] = []
+        self.selected: List[int] = []
+        self.states: List[Qt.CheckState] = []
+        self.original_states: List[Qt.CheckState] = []
+        # The position of each tag when sorted by name
+        self.name_ranks: List[int] = []
+        # Every id from here on is a new tag
+        self.new_tags_start = 0
+        self.rows: List[int] = []
+        self._sort_role = shared.TAG_NAME
+        self._sort_order = Qt.AscendingOrder
+
+    def rowCount(self, parent: QtCore.QModelIndex = QtCore.QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.rows)
+
+    def data(self, index: QtCore.QModelIndex, role: int = Qt.DisplayRole) -> Any:
+        if not index.isValid() or index.row() >= len(self.rows):
+            return None
+        tag_id = self.rows[index.row()]
+        if role == Qt.DisplayRole:
+            return f'{self.names[tag_id]} ({self.selected[tag_id]}/{self.totals[tag_id]})'
+        elif role == Qt.CheckStateRole:
+            return self.states[tag_id]
+        elif role == shared.TAG_NAME:
+            return self.names[tag_id]
+        elif role == shared.TAG_COUNT:
+            return self.totals[tag_id]
+        elif role == shared.VISIBLE_TAG_COUNT:
+            return self.selected[tag_id]
+        elif role == shared.IS_NEW:
+            return tag_id >= self.new_tags_start
+        return None
+
+    def _update_name_ranks(self) -> None:
+        self.name_ranks = [0] * len(self.names)
+        for rank, tag_id in enumerate(sorted(range(len(self.names)),
+                                             key=self.names.__getitem__)):
+            self.name_ranks[tag_id] = rank
+
+    def set_tags(self, tags: Counter[int]) -> None:
+        self.beginResetModel()
+        self.tags = [tag for tag, count in tags.items() if count > 0]
+        self.names = [TAG_TABLE.name(tag) for tag in self.tags]
+        self.totals = [tags[tag] for tag in self.tags]
+        self.selected = [0] * len(self.names)
+        self.states = [Qt.Unchecked] * len(self.names)
+        self.original_states = list(self.states)
+        self.ids = {tag: tag_id for tag_id, tag in enumerate(self.tags)}
+        self.new_tags_start = len(self.names)
+        self._update_name_ranks()
+        self.rows = self._sorted_ids()
+        self.endResetModel()
+
+    def update_tags(self, tag_count_diff: Counter[int]) -> None:
+        self.drop_new_tags()
+        tags = Counter(dict(zip(self.tags, self.totals)))
+        tags.update(tag_count_diff)
+        if any(tag not in self.ids or tags[tag] <= 0 for tag in tag_count_diff):
+            # Tags were created or removed, which is rare enough to just
+            # rebuild everything
+            self.set_tags(tags)
+            return
+        for tag, diff in tag_count_diff.items():
+            self.totals[self.ids[tag]] += diff
+        # The window is hidden so nothing is shown until the next use,
+        # which redoes the sorting anyway
 
-    @tag_name.setter
-    def tag_name(self, tag_name: str) -> None:
-        self.setData(tag_name, shared.TAG_NAME)
+    def drop_new_tags(self) -> None:
+        if self.new_tags_start == len(self.names):
+            return
+        self.beginResetModel()
+        for tag in self.tags[self.new_tags_start:]:
+            del self.ids[tag]
+        for column in (self.tags, self.names, self.totals, self.selected,
+                       self.states, self.original_states):
+            del column[self.new_tags_start:]
+        self._update_name_ranks()
+        self.rows = self._sorted_ids()
+        self.endResetModel()
+
+    def start_editing(self, selected_tags: Counter[int], image_count: int) -> None:
+        self.drop_new_tags()
+        self.beginResetModel()
+        self.selected = [selected_tags.get(tag, 0) for tag in self.tags]
+        self.states = [Qt.Checked if count == image_count
+                       else Qt.Unchecked if count == 0
+                       else Qt.PartiallyChecked
+                       for count in self.selected]
+        self.original_states = list(self.states)
+        self.rows = self._sorted_ids()
+        self.endResetModel()
+
+    def add_tag(self, name: str) -> None:
+        tag = TAG_TABLE.intern(name)
+        tag_id = self.ids.get(tag)
+        if tag_id is None:
+            tag_id = len(self.tags)
+            self.beginInsertRows(QtCore.QModelIndex(), len(self.rows), len(self.rows))
+            self.ids[tag] = tag_id
+            self.tags.append(tag)
+            self.names.append(TAG_TABLE.name(tag))
+            self.totals.append(0)
+            self.selected.append(0)
+            self.states.append(Qt.Checked)
+            self.original_states.append(Qt.Unchecked)
+            self.rows.append(tag_id)
+            self.endInsertRows()
+            self._update_name_ranks()
+        else:
+            self.states[tag_id] = Qt.Checked
+        self.sort(0, self._sort_order)
+
+    def is_checked(self, tag: int) -> bool:
+        tag_id = self.ids.get(tag)
+        return tag_id is not None and self.states[tag_id] == Qt.Checked
+
+    def toggle(self, row: int) -> None:
+        tag_id = self.rows[row]
+        self.states[tag_id] = Qt.Unchecked if self.states[tag_id] == Qt.Checked else Qt.Checked
+        self.sort(0, self._sort_order)
+
+    def has_changes(self) -> bool:
+        return self.states != self.original_states
+
+    def changes(self) -> TagChanges:
+        tags_to_add: Set[int] = set()
+        tags_to_remove: Set[int] = set()
+        for tag, state, original_state in zip(self.tags, self.states,
+                                              self.original_states):
+            if state != original_state:
+                if state == Qt.Checked:
+                    tags_to_add.add(tag)
+                elif state == Qt.Unchecked:
+                    tags_to_remove.add(tag)
+        return TagChanges(
+            tags_to_add=frozenset(tags_to_add),
+            tags_to_remove=frozenset(tags_to_remove),
+        )
 
-    @property
-    def visible_tag_count(self) -> int:
-        return cast(int, self.data(shared.VISIBLE_TAG_COUNT))
+    # The same interface as QSortFilterProxyModel, for the sort menu
 
-    @visible_tag_count.setter
-    def visible_tag_count(self, visible_count: int) -> None:
-        self.setData(visible_count, shared.VISIBLE_TAG_COUNT)
+    def setSortRole(self, role: int) -> None:
+        self._sort_role = role
 
+    def sortOrder(self) -> Qt.SortOrder:
+        return self._sort_order
 
-class TagListWidget(CustomDrawListWidget[TaggingListItem]):
+    def _sorted_ids(self) -> List[int]:
+        if self._sort_role == shared.TAG_COUNT:
+            key = self.totals
+        elif self._sort_role == shared.VISIBLE_TAG_COUNT:
+            key = self.selected
+        else:
+            key = self.name_ranks
+        tag_ids = sorted(range(len(self.names)), key=key.__getitem__,
+                         reverse=self._sort_order == Qt.DescendingOrder)
+        # Checked and partially checked tags always go on top
+        states = self.states
+        tag_ids.sort(key=lambda tag_id: states[tag_id] == Qt.Unchecked)
+        return tag_ids
+
+    def sort(self, column: int, order: Qt.SortOrder = Qt.AscendingOrder) -> None:
+        self._sort_order = order
+        self.layoutAboutToBeChanged.emit()
+        old_rows = self.rows
+        self.rows = self._sorted_ids()
+        new_row_of = {tag_id: row for row, tag_id in enumerate(self.rows)}
+        old_indexes = self.persistentIndexList()
+        self.changePersistentIndexList(
+            old_indexes,
+            [self.index(new_row_of[old_rows[index.row()]]) for index in old_indexes])
+        self.layoutChanged.emit()
+
+
+class TagListWidget(CustomDrawListView):
     def mousePressEvent(self, event: QtGui.QMouseEvent) -> None:
-        item = self.itemAt(event.pos())
-        if item is not None:
-            if event.button() == Qt.LeftButton:
-                if item.checkState() == Qt.Checked:
-                    item.setCheckState(Qt.Unchecked)
-                else:
-                    item.setCheckState(Qt.Checked)
-
-
-class TagChanges(NamedTuple):
-    tags_to_add: FrozenSet[str]
-    tags_to_remove: FrozenSet[str]
+        index = self.indexAt(event.pos())
+        if index.isValid() and event.button() == Qt.LeftButton:
+            cast(TaggingListModel, self.model()).toggle(index.row())
 
 
 class TaggingWindow(QtWidgets.QDialog):
-    def __init__(self, images: List[ImageData], total_tags: Counter[str],
-                 parent: QtWidgets.QWidget) -> None:
+    def __init__(self, parent: QtWidgets.QWidget) -> None:
         super().__init__(parent)
         self.setObjectName('tagging_window')
-        self.original_tags: Counter[str] = total_tags
-        self.resize(400, int(parent.height() * 0.7))
 
         # Main layout
         layout = QtWidgets.QVBoxLayout(self)
@@ -186,12 +323,30 @@ class TaggingWindow(QtWidgets.QDialog):
         self.completer.setCaseSensitivity(Qt.CaseInsensitive)
         self.completer.setFilterMode(Qt.MatchContains)
         self.tag_input.setCompleter(self.completer)
-        self.completer.setModel(QtCore.QStringListModel(total_tags.keys()))
+        self.completer_model = QtCore.QStringListModel(self)
+        self.completer.setModel(self.completer_model)
         input_box.addWidget(self.tag_input)
         self.add_tag_button = QtWidgets.QPushButton('Add tag', self)
         input_box.addWidget(self.add_tag_button)
         layout.addLayout(input_box)
 
+        # Tags that often go together with the ones on the selected images
+        self.related_tags: List[int] = []
+        # The tags by how common they are, for the completer, and what the
+        # completer was last filled from, so it's only redone when needed
+        self._tags_by_count: Optional[List[int]] = None
+        self._completer_key: Optional[Tuple[Tuple[int, ...], int]] = None
+        self.suggestion_label = QtWidgets.QLabel(self)
+        self.suggestion_label.setObjectName('tagging_window_suggestions')
+        self.suggestion_label.setWordWrap(True)
+        self.suggestion_label.setTextFormat(Qt.RichText)
+        layout.addWidget(self.suggestion_label)
+
+        def add_suggested_tag(link: str) -> None:
+            self.tag_model.add_tag(unquote(link))
+
+        cast(Signal1[str], self.suggestion_label.linkActivated).connect(add_suggested_tag)
+
         def update_add_button(text: str) -> None:
             self.add_tag_button.setEnabled(bool(text.strip()))
 
@@ -205,31 +360,17 @@ class TaggingWindow(QtWidgets.QDialog):
         layout.addLayout(tag_header_layout)
         tag_header_layout.addWidget(QtWidgets.QLabel('All tags'))
         tag_header_layout.addStretch()
-        self._sort_model = SortProxyModel()
-        self.tag_list = TagListWidget(self, TagListDelegate, self._sort_model)
+        self.tag_model = TaggingListModel(self)
+        self.tag_list = TagListWidget(self, TagListDelegate)
+        self.tag_list.setModel(self.tag_model)
         self.tag_list.setObjectName('tagging_window_tag_list')
-        tag_counter: Counter[str] = Counter()
-        for img in images:
-            tag_counter.update(img.tags)
-        self.original_states: Dict[str, Qt.CheckState] = {}
-        for tag, total in total_tags.items():
-            count = tag_counter.get(tag, 0)
-            item = TaggingListItem(f'{tag} ({count}/{total})')
-            item.is_new = False
-            item.tag_name = tag
-            item.tag_count = total
-            item.visible_tag_count = count
-            item.setCheckState(Qt.Checked if count == len(images)
-                               else Qt.Unchecked if count == 0
-                               else Qt.PartiallyChecked)
-            self.original_states[tag] = item.checkState()
-            self.tag_list.addItem(item)
         layout.addWidget(self.tag_list)
-        self.tag_input.setFocus()
+        cast(Signal0, self.tag_model.layoutChanged).connect(self.update_suggestions)
+        cast(Signal0, self.tag_model.modelReset).connect(self.update_suggestions)
 
         # Sorting
         self.sort_button = shared.make_sort_menu(
-            self, self._sort_model,
+            self, self.tag_model,
             {'Name': shared.TAG_NAME,
              'Selected count': shared.VISIBLE_TAG_COUNT,
              'Total count': shared.TAG_COUNT},
@@ -239,29 +380,64 @@ class TaggingWindow(QtWidgets.QDialog):
         # Buttons
         button_box = QDialogButtonBox(self)
         button_box.addButton(QDialogButtonBox.Cancel)
-        self.accept_button = button_box.addButton(f'Apply to {len(images)} images',
-                                                  QDialogButtonBox.AcceptRole)
+        self.accept_button = button_box.addButton('Apply', QDialogButtonBox.AcceptRole)
         cast(Signal0, button_box.accepted).connect(self.accept)
         cast(Signal0, button_box.rejected).connect(self.reject)
         layout.addWidget(button_box)
 
+    def set_tags(self, tags: Counter[int]) -> None:
+        self.tag_model.set_tags(tags)
+        self._tags_by_count = None
+        self._completer_key = None
+
+    def update_tags(self, tag_count_diff: Counter[int]) -> None:
+        self.tag_model.update_tags(tag_count_diff)
+        self._tags_by_count = None
+        self._completer_key = None
+
+    def update_completer(self) -> None:
+        model = self.tag_model
+        key = (tuple(self.related_tags), len(model.tags))
+        if key == self._completer_key:
+            return
+        if self._tags_by_count is None or len(self._tags_by_count) != len(model.tags):
+            self._tags_by_count = sorted(range(len(model.tags)),
+                                         key=lambda tag_id: -model.totals[tag_id])
+        # The completer keeps the order of its model when filtering, so put
+        # the related tags first and the rest by how common they are
+        related = set(self.related_tags)
+        self.completer_model.setStringList(
+            [TAG_TABLE.name(tag) for tag in self.related_tags]
+            + [model.names[tag_id] for tag_id in self._tags_by_count
+               if model.tags[tag_id] not in related])
+        self._completer_key = key
+
+    def update_suggestions(self) -> None:
+        suggestions = itertools.islice(
+            (tag for tag in self.related_tags if not self.tag_model.is_checked(tag)),
+            SUGGESTION_COUNT
+        )
+        names = [TAG_TABLE.name(tag) for tag in suggestions]
+        links = ', '.join(f'<a href="{quote(name)}">{html.escape(name)}</a>'
+                          for name in names)
+        self.suggestion_label.setText(f'<b>Suggested:</b> {links}' if links else '')
+        self.suggestion_label.setVisible(bool(links))
+
     def reject(self) -> None:
-        items = self.tag_list.items()
-        for item in items:
-            if item.checkState() != self.original_states.get(item.tag_name):
-                QMB = QtWidgets.QMessageBox
-                answer = QMB.question(
-                    self,
-                    'Apply or discard tag changes',
-                    'You still have tag changes. Do you want to apply or discard them?',
-                    (QMB.Cancel | QMB.Discard | QMB.Apply),
-                    QMB.Cancel
-                )
-                if answer == QMB.Discard:
-                    super().reject()
-                elif answer == QMB.Apply:
-                    self.accept()
-                return
+        if self.tag_model.has_changes():
+            QMB = QtWidgets.QMessageBox
+            answer = QMB.question(
+                self,
+                'Apply or discard tag changes',
+                'You still have tag changes. Do you want to apply or discard them?',
+                (QMB.Cancel | QMB.Discard | QMB.Apply),
+                QMB.Cancel
+            )
+            if answer == QMB.Discard:
+                super().reject()
+            elif answer == QMB.Apply:
+                self.accept()
+            return
         super().reject()
 
     def keyPressEvent(self, event: QtGui.QKeyEvent) -> None:
@@ -276,37 +452,22 @@ class TaggingWindow(QtWidgets.QDialog):
             return
         tag = self.tag_input.text().strip()
         if tag:
-            tags = {item.tag_name: item for item in self.tag_list.items()}
-            if tag in tags:
-                item = tags[tag]
-                item.setCheckState(Qt.Checked)
-            else:
-                item = TaggingListItem(f'{tag} (NEW)')
-                item.is_new = True
-                item.tag_name = tag
-                item.tag_count = 0
-                item.visible_tag_count = 0
-                item.setCheckState(Qt.Checked)
-                self.tag_list.insertRow(0, item)
+            self.tag_model.add_tag(tag)
             self.tag_input.clear()
-            self.tag_list.model().sort(0)
-
-    @classmethod
-    def get_tag_changes(cls, images: List[ImageData], total_tags: Counter[str],
-                        parent: QtWidgets.QWidget) -> Optional[TagChanges]:
-        dialog = cls(images, total_tags, parent)
-        if dialog.exec_() == QtWidgets.QDialog.Accepted:
-            tags_to_add: Set[str] = set()
-            tags_to_remove: Set[str] = set()
-            for item in dialog.tag_list.items():
-                if item.checkState() != dialog.original_states.get(item.tag_name):
-                    if item.checkState() == Qt.Checked:
-                        tags_to_add.add(item.tag_name)
-                    elif item.checkState() == Qt.Unchecked:
-                        tags_to_remove.add(item.tag_name)
-            return TagChanges(
-                tags_to_add=frozenset(tags_to_add),
-                tags_to_remove=frozenset(tags_to_remove),
-            )
+
+    def get_tag_changes(self, images: List[ImageData], selected_tags: Counter[int],
+                        cooccurrence: TagCooccurrence) -> Optional[TagChanges]:
+        parent = cast(QtWidgets.QWidget, self.parent())
+        self.resize(400, int(parent.height() * 0.7))
+        on_all_images = {tag for tag, count in selected_tags.items() if count == len(images)}
+        self.related_tags = cooccurrence.related(selected_tags, on_all_images)
+        self.update_completer()
+        self.tag_model.start_editing(selected_tags, len(images))
+        self.accept_button.setText(f'Apply to {len(images)} images')
+        self.tag_input.clear()
+        self.tag_input.setFocus()
+        self.tag_list.scrollToTop()
+        if self.exec_() == QtWidgets.QDialog.Accepted:
+            return self.tag_model.changes()
         else:
             return None
@@ -1,17 +1,23 @@
 import enum
 import logging
 from pathlib import Path
-from typing import Counter, FrozenSet, List, Optional, Set, Tuple, cast
+from typing import (Any, Counter, Dict, FrozenSet, List, Optional, Set,
+                    Tuple, cast)
 
-from libsyntyche.widgets import (Signal0, Signal1, Signal2, mk_signal1,
-                                 mk_signal2)
+from libsyntyche.widgets import (Signal0, Signal1, Signal2, mk_signal0,
+                                 mk_signal1, mk_signal2)
 from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtCore import QPoint, Qt, pyqtProperty  # type: ignore
 
-from . import jfti, shared
+from . import jfti, shared, tag_query
+from .cache import CachedImageData
 from .image_loading import THUMB_SIZE, ImageLoader
+from .path_table import PATHS
 from .settings import Settings
-from .shared import CACHE, Cache, ImageData, ListWidget2, TagState, TagStates
+from .shared import ImageData, ListWidget2, TagStates
+from .startup_profile import STARTUP_PROFILE
+from .tag_cooccurrence import TagCooccurrence
+from .tag_index import TagIndex, make_bitmap
 
 
 class Mode(enum.Enum):
@@ -64,7 +70,37 @@ class StatusBar(QtWidgets.QFrame):
         self.column_count_label.setToolTip('Change how many columns are visible')
         self.column_count_label.setObjectName('thumb_view_column_count')
         layout.addWidget(self.column_count_label)
-        layout.addStretch()
+        # Tag query
+        self.query_input = QtWidgets.QLineEdit(self)
+        self.query_input.setObjectName('thumb_view_query_input')
+        self.query_input.setPlaceholderText('Filter, e.g. cat* -sketch (red|blue)')
+        self.query_input.setClearButtonEnabled(True)
+        layout.addWidget(self.query_input, stretch=1)
+        # Tag writes in the background
+        self.write_label = QtWidgets.QLabel(self)
+        self.write_label.setObjectName('thumb_view_write_label')
+        layout.addWidget(self.write_label)
+        self.write_label.hide()
+        # Indexing in the background
+        self.index_label = QtWidgets.QLabel(self)
+        self.index_label.setObjectName('thumb_view_index_label')
+        layout.addWidget(self.index_label)
+        self.index_label.hide()
+
+    def set_pending_writes(self, pending: int, failed: int) -> None:
+        parts = []
+        if pending:
+            parts.append(f'Writing tags... ({pending} left)')
+        if failed:
+            parts.append(f'{failed} failed')
+        self.write_label.setText(', '.join(parts))
+        self.write_label.setToolTip('Tags that failed to be written have been reverted'
+                                    if failed else '')
+        self.write_label.setVisible(bool(parts))
+
+    def set_index_status(self, text: str) -> None:
+        self.index_label.setText(text)
+        self.index_label.setVisible(bool(text))
 
     def update_column_count(self, cols: int) -> None:
         self.column_count_label.setValue(cols)
@@ -91,28 +127,41 @@ class ProgressBar(QtWidgets.QProgressBar):
 
 
 class FilterProxyModel(QtCore.QSortFilterProxyModel):
-    def __init__(self) -> None:
+    def __init__(self, tag_index: TagIndex) -> None:
         super().__init__()
-        self.tag_whitelist: FrozenSet[str] = frozenset()
-        self.tag_blacklist: FrozenSet[str] = frozenset()
-        self.untagged_state: TagState = TagState.DEFAULT
+        self.tag_index = tag_index
+        self.tag_query: tag_query.Node = tag_query.EVERYTHING
+        self.text_query: tag_query.Node = tag_query.EVERYTHING
+        self._plan: Optional[Tuple[int, tag_query.Node]] = None
+        self.visible_rows = 0
+        self._visible_bytes = b''
 
     def filterAcceptsRow(self, source_row: int, source_parent: QtCore.QModelIndex) -> bool:
-        source_model = cast(QtGui.QStandardItemModel, self.sourceModel())
-        tags = cast(ThumbViewItem, source_model.item(source_row, 0)).tags
-        if (self.untagged_state == TagState.WHITELISTED and tags) \
-                or (self.untagged_state == TagState.BLACKLISTED and not tags) \
-                or (self.tag_whitelist and not self.tag_whitelist.issubset(tags)) \
-                or (self.tag_blacklist and not self.tag_blacklist.isdisjoint(tags)):
-            return False
-        return True
+        if source_row >= self.tag_index.size:
+            return True
+        return bool(self._visible_bytes[source_row >> 3] >> (source_row & 7) & 1)
+
+    def update_visible_rows(self) -> None:
+        # Wildcards are expanded when compiling, so the plan has to be
+        # recompiled if the set of tags in the index has changed
+        if self._plan is None or self._plan[0] != self.tag_index.generation:
+            query = tag_query.And((self.tag_query, self.text_query))
+            self._plan = (self.tag_index.generation,
+                          tag_query.compile_query(query, self.tag_index.tag_names))
+        self.visible_rows = tag_query.evaluate(self._plan[1], self.tag_index)
+        self._visible_bytes = self.visible_rows.to_bytes((self.tag_index.size + 7) // 8,
+                                                         'little')
 
     def set_tag_filter(self, states: TagStates) -> None:
-        self.tag_whitelist = states.whitelist
-        self.tag_blacklist = states.blacklist
-        self.untagged_state = states.untagged_state
+        self.tag_query = tag_query.from_tag_states(states)
+        self._plan = None
+        self.update_visible_rows()
         self.invalidateFilter()
 
+    def set_text_query(self, query: tag_query.Node) -> None:
+        self.text_query = query
+        self._plan = None
+
 
 class ThumbViewItem(QtGui.QStandardItem):
     @property
@@ -131,14 +180,6 @@ class ThumbViewItem(QtGui.QStandardItem):
     def file_format(self, file_format: str) -> None:
         self.setData(file_format, shared.FILE_FORMAT)
 
-    @property
-    def file_name(self) -> str:
-        return cast(str, self.data(shared.FILE_NAME))
-
-    @file_name.setter
-    def file_name(self, file_name: str) -> None:
-        self.setData(file_name, shared.FILE_NAME)
-
     @property
     def file_size(self) -> int:
         return cast(int, self.data(shared.FILE_SIZE))
@@ -148,39 +189,38 @@ class ThumbViewItem(QtGui.QStandardItem):
         self.setData(file_size, shared.FILE_SIZE)
 
     @property
-    def path(self) -> Path:
-        return cast(Path, self.data(shared.PATH))
+    def image_id(self) -> int:
+        return cast(int, self.data(shared.IMAGE_ID))
 
-    @path.setter
-    def path(self, path: Path) -> None:
-        self.setData(path, shared.PATH)
+    @image_id.setter
+    def image_id(self, image_id: int) -> None:
+        self.setData(image_id, shared.IMAGE_ID)
 
     @property
-    def path_string(self) -> str:
-        return cast(str, self.data(shared.PATH_STRING))
-
-    @path_string.setter
-    def path_string(self, path_string: str) -> None:
-        self.setData(path_string, shared.PATH_STRING)
+    def path(self) -> Path:
+        return PATHS.path(self.image_id)
 
     @property
-    def tags(self) -> Set[str]:
-        return cast(Set[str], self.data(shared.TAGS))
+    def tags(self) -> FrozenSet[int]:
+        return cast(FrozenSet[int], self.data(shared.TAGS))
 
     @tags.setter
-    def tags(self, tags: Set[str]) -> None:
+    def tags(self, tags: FrozenSet[int]) -> None:
         self.setData(tags, shared.TAGS)
 
 
 class ThumbView(ListWidget2[ThumbViewItem]):
-    image_queued: Signal2[int, List[Tuple[int, bool, Path]]] = mk_signal2(int, list)
+    image_queued: Signal2[int, List[Tuple[int, bool, int]]] = mk_signal2(int, list)
     mode_changed = mk_signal1(Mode)
     image_selected = cast(Signal1[Optional[ImageData]], mk_signal1(object))
     visible_selection_changed = cast(Signal1[List[ImageData]], mk_signal1(list))
+    query_changed = mk_signal0()
 
     def __init__(self, progress: ProgressBar, status_bar: StatusBar,
                  config: Settings, parent: QtWidgets.QWidget) -> None:
-        self._filter_model = FilterProxyModel()
+        self.tag_index = TagIndex()
+        self.tag_cooccurrence = TagCooccurrence(self.tag_index)
+        self._filter_model = FilterProxyModel(self.tag_index)
         super().__init__(parent, self._filter_model)
         self._mode = Mode.normal
         self.config = config
@@ -190,6 +230,13 @@ class ThumbView(ListWidget2[ThumbViewItem]):
         self.batch = 0
         self.scroll_ratio: Optional[float] = None
         self.selected_indexes: List[QtCore.QPersistentModelIndex] = []
+        self._counted_tags: Optional[Tuple[int, int, Counter[int]]] = None
+        # What the items were made from, to compare against when refreshing
+        self._entries: Dict[int, CachedImageData] = {}
+        # The images that are still waiting for their thumbnails
+        self._pending_thumbs: Set[int] = set()
+        # Raw sort key values for the sort roles that haven't been ranked yet
+        self._sort_columns: Dict[int, List[Any]] = {}
         self._current_image_color = QtGui.QColor(Qt.green)
         self._selected_image_overlay_color = QtGui.QColor(0, 255, 0, 40)
 
@@ -230,15 +277,42 @@ class ThumbView(ListWidget2[ThumbViewItem]):
             self.adjust_size(cast(QtWidgets.QWidget, self.parent()).width())
 
         self.status_bar.column_count_label.valueChanged.connect(update_column_count)
+
+        query_timer = QtCore.QTimer(self)
+        query_timer.setSingleShot(True)
+        query_timer.setInterval(200)
+
+        def update_text_query() -> None:
+            query_input = self.status_bar.query_input
+            try:
+                query = tag_query.parse(query_input.text())
+            except tag_query.QueryError as e:
+                query_input.setToolTip(f'Invalid query: {e}')
+                query_input.setProperty('invalid', True)
+            else:
+                query_input.setToolTip('')
+                query_input.setProperty('invalid', False)
+                self._filter_model.set_text_query(query)
+                self.query_changed.emit()
+            query_input.style().polish(query_input)
+
+        cast(Signal0, query_timer.timeout).connect(update_text_query)
+        cast(Signal1[str], self.status_bar.query_input.textChanged
+             ).connect(lambda _: query_timer.start())
         self.selectionModel().selectionChanged.connect(self.update_selection_info)
         self.update_selection_info()
 
         self.status_bar.layout().addWidget(shared.make_sort_menu(
             self.status_bar,
             self._filter_model,
-            {'Path': shared.PATH_STRING,
-             'File name': shared.FILE_NAME,
-             'File size': shared.FILE_SIZE},
+            {'Path': shared.SORT_PATH,
+             'File name': shared.SORT_FILE_NAME,
+             'File size': shared.SORT_FILE_SIZE,
+             'Modified time': shared.SORT_MTIME,
+             'Created time': shared.SORT_CTIME,
+             'Pixel count': shared.SORT_PIXEL_COUNT,
+             'Aspect ratio': shared.SORT_ASPECT_RATIO},
+            self.prepare_sort_role,
         ))
 
         def emit_image_selected(current: Optional[ThumbViewItem],
@@ -312,17 +386,53 @@ class ThumbView(ListWidget2[ThumbViewItem]):
     def allow_fullscreen(self) -> bool:
         return self._mode == Mode.normal
 
-    def get_tag_count(self) -> Tuple[int, Counter[str]]:
-        untagged = 0
-        tag_count: Counter[str] = Counter()
-        for item in self.visibleItems():
-            tags = item.tags
-            if not tags:
-                untagged += 1
-            else:
-                tag_count.update(tags)
+    def get_tag_count(self) -> Tuple[int, Counter[int]]:
+        visible = self._filter_model.visible_rows
+        untagged, tag_count = self.tag_index.count(visible, self._counted_tags)
+        self._counted_tags = (visible, untagged, tag_count)
         return (untagged, tag_count)
 
+    def _sort_ranks(self, role: int) -> List[int]:
+        column = self._sort_columns.pop(role)
+        ranks = [0] * len(column)
+        for rank, row in enumerate(sorted(range(len(column)), key=column.__getitem__)):
+            ranks[row] = rank
+        return ranks
+
+    def prepare_sort_role(self, role: int) -> None:
+        # Every sort key is turned into a plain int rank the first time
+        # it's used, so the proxy never has to compare anything fancier
+        if role in self._sort_columns:
+            for row, rank in enumerate(self._sort_ranks(role)):
+                self.item(row).setData(rank, role)
+
+    def count_tags(self, images: List[ImageData]) -> Counter[int]:
+        rows = make_bitmap((cast(ThumbViewItem, image).row() for image in images),
+                           self.tag_index.size)
+        return self.tag_index.count(rows)[1]
+
+    def update_tag_index(self, images: List[ImageData]) -> None:
+        for image in images:
+            row = cast(ThumbViewItem, image).row()
+            old_tags = self.tag_index.row_tags[row]
+            if self.tag_index.set_row_tags(row, image.tags):
+                self._counted_tags = None
+                self.tag_cooccurrence.update(old_tags, image.tags)
+
+    def neighbour_paths(self, count: int) -> List[Path]:
+        total = self.visibleCount()
+        current = self.currentRow()
+        if current < 0 or total < 2:
+            return []
+        rows = []
+        for diff in range(1, count + 1):
+            rows.extend([(current + diff) % total, (current - diff) % total])
+        paths = []
+        for row in dict.fromkeys(rows):
+            if row != current:
+                paths.append(self.visibleItem(row).path)
+        return paths
+
     def selectedItems(self) -> List[ImageData]:
         out: List[ImageData] = []
         for p_index in self.selected_indexes:
@@ -461,62 +571,146 @@ class ThumbView(ListWidget2[ThumbViewItem]):
             br = rect.bottomRight()
             painter.drawPolyline(br - xdiff, br, br - ydiff)
 
-    def load_index(self, skip_thumb_cache: bool) -> Optional[Tuple[int, Counter[str]]]:
-        if not CACHE.exists():
-            return None
+    def _make_sort_columns(self, entries: List[Tuple[int, CachedImageData]],
+                           path_ranks: List[int]) -> None:
+        self._sort_columns = {
+            shared.SORT_PATH: path_ranks,
+            shared.SORT_FILE_NAME: [PATHS.name(image_id) for image_id, _ in entries],
+            shared.SORT_FILE_SIZE: [data.size for _, data in entries],
+            shared.SORT_MTIME: [data.mtime for _, data in entries],
+            shared.SORT_CTIME: [data.ctime for _, data in entries],
+            shared.SORT_PIXEL_COUNT: [data.w * data.h for _, data in entries],
+            shared.SORT_ASPECT_RATIO: [data.w / data.h if data.h > 0 else 0.0
+                                       for _, data in entries],
+        }
+
+    def _make_item(self, image_id: int) -> ThumbViewItem:
+        item_text = PATHS.name(image_id) if self.config.show_names else ''
+        item = ThumbViewItem(self.default_icon, item_text)
+        item.setEditable(False)
+        return item
+
+    def _set_item_data(self, item: ThumbViewItem, image_id: int, data: CachedImageData,
+                       tags: FrozenSet[int]) -> None:
+        item.image_id = image_id
+        item.file_size = data.size
+        item.tags = tags
+        item.dimensions = (data.w, data.h)
+        item.file_format = jfti.identify_image_format(PATHS.path(image_id)) or ''
+
+    def _show_thumbnail_progress(self) -> None:
+        total = self.count()
+        if self._pending_thumbs:
+            self.progress.setMaximum(total)
+            self.progress.setValue(total - len(self._pending_thumbs))
+            self.progress.show()
+        else:
+            self.progress.hide()
+
+    @STARTUP_PROFILE.phase('thumbnail view load')
+    def load_index(self, entries: List[Tuple[int, CachedImageData]],
+                   skip_thumb_cache: bool) -> Tuple[int, Counter[int]]:
         self.clear()
         self.batch += 1
         imgs = []
-        cache = Cache.load()
-        tag_count: Counter[str] = Counter()
-        root_paths = [p for p in self.config.active_paths]
         n = 0
-        untagged = 0
-        for path, data in sorted(cache.images.items()):
-            if not path.exists():
-                del cache.images[path]
-                continue
-            for p in root_paths:
-                if path.is_relative_to(p):
-                    break
-            else:
-                continue
-            item_text = path.name if self.config.show_names else ''
-            item = ThumbViewItem(self.default_icon, item_text)
-            item.setEditable(False)
+        # Build the index before adding any items so the filter
+        # has something to go on when the rows are inserted
+        self.tag_index.build(data.tags for _, data in entries)
+        self._counted_tags = None
+        untagged, tag_count = self.tag_index.count(self.tag_index.all_rows)
+        self.tag_cooccurrence.clear()
+        self._filter_model.update_visible_rows()
+        # The entries are sorted by path already
+        self._make_sort_columns(entries, list(range(len(entries))))
+        # The active sort key has to be set before the items are added,
+        # otherwise the proxy would move every item around as it's updated
+        sort_role = self._filter_model.sortRole()
+        sort_ranks = (self._sort_ranks(sort_role)
+                      if sort_role in self._sort_columns else None)
+        for image_id, data in entries:
+            item = self._make_item(image_id)
+            if sort_ranks is not None:
+                item.setData(sort_ranks[n], sort_role)
             self.appendRow(item)
-            item.path = path
-            item.path_string = str(path)
-            item.file_name = path.name
-            item.file_size = data.size
-            item.tags = set(data.tags)
-            item.dimensions = (data.w, data.h)
-            item.file_format = jfti.identify_image_format(path) or ''
-            imgs.append((n, skip_thumb_cache, path))
+            # The index has a shared set for these already
+            self._set_item_data(item, image_id, data, self.tag_index.row_tags[n])
+            imgs.append((n, skip_thumb_cache, image_id))
             n += 1
-            tag_count.update(data.tags)
-            if not data.tags:
-                untagged += 1
+        self._entries = dict(entries)
+        self._pending_thumbs = set(self._entries)
         if not self.selectionModel().currentIndex().isValid():
             self.setCurrentRow(0)
         self.image_queued.emit(self.batch, imgs)
-        total = self.count()
-        if total > 0:
-            self.progress.setMaximum(total)
-            self.progress.setValue(0)
-            self.progress.show()
-        else:
-            self.progress.hide()
+        self._show_thumbnail_progress()
         self.update_selection_info()
         return (untagged, tag_count)
 
+    def refresh_index(self, entries: List[Tuple[int, CachedImageData]],
+                      keep_tags: Set[int]) -> Optional[Tuple[int, Counter[int]]]:
+        """
+        Bring the view up to date with entries without starting over, so
+        the thumbnails, selection and scroll position stay as they are.
+        Return the new tag counts, or None if nothing had changed.
+
+        The images in keep_tags have had their tags changed since entries
+        were read, so their tags are left alone.
+        """
+        new_entries = dict(entries)
+        rows = {item.image_id: row for row, item in enumerate(self.items())}
+        removed_rows = [row for image_id, row in rows.items() if image_id not in new_entries]
+        added = [(image_id, data) for image_id, data in entries if image_id not in rows]
+        changed = [(rows[image_id], data) for image_id, data in entries
+                   if image_id in rows and data != self._entries[image_id]]
+        if not (removed_rows or added or changed):
+            return None
+        # Everything is sorted once at the end instead of after every change
+        self._filter_model.setDynamicSortFilter(False)
+        for row, data in changed:
+            item = self.item(row)
+            tags = item.tags if item.image_id in keep_tags else frozenset(data.tags)
+            self._set_item_data(item, item.image_id, data, tags)
+        for row in sorted(removed_rows, reverse=True):
+            self._pending_thumbs.discard(self.item(row).image_id)
+            self._model.removeRow(row)
+        imgs = []
+        if removed_rows:
+            self.selected_indexes = [index for index in self.selected_indexes
+                                     if index.isValid()]
+            # The thumbnails on their way are for rows that have moved now
+            self.batch += 1
+            imgs = [(row, False, item.image_id) for row, item in enumerate(self.items())
+                    if item.image_id in self._pending_thumbs]
+        for image_id, data in added:
+            item = self._make_item(image_id)
+            self.appendRow(item)
+            self._set_item_data(item, image_id, data, frozenset(data.tags))
+            imgs.append((item.row(), False, image_id))
+            self._pending_thumbs.add(image_id)
+        self._entries = new_entries
+        row_entries = [(item.image_id, self._entries[item.image_id]) for item in self.items()]
+        path_ranks = {image_id: rank for rank, (image_id, _) in enumerate(entries)}
+        self._make_sort_columns(row_entries,
+                                [path_ranks[image_id] for image_id, _ in row_entries])
+        sort_role = self._filter_model.sortRole()
+        self.prepare_sort_role(sort_role)
+        self.tag_index.build(item.tags for item in self.items())
+        self._counted_tags = None
+        self.tag_cooccurrence.clear()
+        self._filter_model.setDynamicSortFilter(True)
+        self._filter_model.update_visible_rows()
+        self._filter_model.invalidateFilter()
+        if imgs:
+            self.image_queued.emit(self.batch, imgs)
+        self._show_thumbnail_progress()
+        self.update_selection_info()
+        return self.tag_index.count(self.tag_index.all_rows)
+
     def add_thumbnail(self, index: int, batch: int, icon: QtGui.QIcon) -> None:
         if batch != self.batch:
             return
         item = self.item(index)
         item.setIcon(icon)
-        done = self.progress.value() + 1
-        total = self.count()
-        self.progress.setValue(done)
-        if done == total:
-            self.progress.hide()
+        STARTUP_PROFILE.finish('first thumbnail shown')
+        self._pending_thumbs.discard(item.image_id)
+        self._show_thumbnail_progress()
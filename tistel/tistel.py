@@ -1,28 +1,37 @@
 #!/usr/bin/env python3
 import logging
 import sys
-import time
 from pathlib import Path
-from typing import (Any, Counter, Dict, FrozenSet, List, NamedTuple, Optional,
-                    Set, cast)
+from typing import (TYPE_CHECKING, Any, Counter, FrozenSet, Iterable, List,
+                    Optional, Set, Tuple, cast)
 
 from libsyntyche import app
 from libsyntyche.widgets import (Signal0, Signal2, kill_theming, mk_signal0,
-                                 mk_signal2)
+                                 mk_signal1, mk_signal2)
 from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtCore import Qt
 
 from . import jfti
+from .cache import Cache, CachedImageData
+from .cache_service import CacheService
 from .details_view import DetailsBox
-from .image_loading import Indexer, set_rotation, try_to_get_orientation
+from .image_loading import Indexer, thumbnail_pixmap
 from .image_view import ImagePreview
-from .settings import Settings, SettingsWindow
-from .shared import CACHE, CSS_FILE, THUMBNAILS, Cache, ImageData
+from .journal import TagWrite
+from .path_table import PATHS
+from .settings import Settings
+from .shared import CSS_FILE, THUMBNAILS, ImageData
 from .sidebar import SideBar
-from .tagging_window import TagChanges, TaggingWindow
+from .startup_profile import STARTUP_PROFILE
+from .tag_writer import TagWriter
 from .thumb_view import Container as ThumbViewContainer
 from .thumb_view import Mode as ThumbViewMode
 from .thumb_view import ProgressBar, StatusBar, ThumbView
+from .trace import TRACE
+
+if TYPE_CHECKING:
+    from .settings import SettingsWindow
+    from .tagging_window import TaggingWindow
 
 
 class Divider(QtWidgets.QFrame):
@@ -61,6 +70,8 @@ class Divider(QtWidgets.QFrame):
 
 class MainWindow(app.RootWindow):
     start_indexing: Signal2[Set[Path], bool] = mk_signal2(set, bool)
+    queue_tag_writes = mk_signal1(list)
+    request_snapshot: Signal2[int, Set[Path]] = mk_signal2(int, set)
 
     def __init__(self, config: Settings) -> None:
         super().__init__('tistel')
@@ -71,7 +82,8 @@ class MainWindow(app.RootWindow):
         # Settings
         self.config = config
         self.untagged_count = 0
-        self.tag_count: Counter[str] = Counter()
+        # Tag id -> how many images have it
+        self.tag_count: Counter[int] = Counter()
 
         # Main layout
         kill_theming(self.layout())
@@ -98,7 +110,7 @@ class MainWindow(app.RootWindow):
         thumb_view_container_layout = QtWidgets.QVBoxLayout(self.thumb_view_container)
         kill_theming(thumb_view_container_layout)
 
-        status_bar = StatusBar(self)
+        self.status_bar = status_bar = StatusBar(self)
         thumb_view_container_layout.addWidget(status_bar)
 
         self.thumb_view = ThumbView(progress, status_bar, config, self.thumb_view_container)
@@ -108,6 +120,7 @@ class MainWindow(app.RootWindow):
 
         self.sidebar.tag_list.tag_state_updated.connect(
             self.update_tag_filter)
+        self.thumb_view.query_changed.connect(self.update_tag_filter)
         self.thumb_view.image_selected.connect(
             self.sidebar.tag_list.set_current_image_data)
         self.thumb_view.visible_selection_changed.connect(
@@ -124,17 +137,9 @@ class MainWindow(app.RootWindow):
             if not self.image_view.isVisible():
                 return
             if current:
-                path = current.path
-                orientation = try_to_get_orientation(path)
-                pixmap: Optional[QtGui.QPixmap] = None
-                if orientation:
-                    transform = set_rotation(orientation)
-                    if not transform.isIdentity():
-                        img = QtGui.QImage(str(path)).transformed(transform)
-                        pixmap = QtGui.QPixmap.fromImage(img)
-                if pixmap is None:
-                    pixmap = QtGui.QPixmap(str(path))
-                self.image_view.setPixmap(pixmap)
+                self.image_view.load_image(current.path, thumbnail_pixmap(current.icon()))
+                self.image_view.prefetch(
+                    self.thumb_view.neighbour_paths(self.image_view.prefetch_count))
                 self.image_info_box.set_info(current)
             else:
                 self.image_view.setPixmap(None)
@@ -158,6 +163,10 @@ class MainWindow(app.RootWindow):
 
         self.splitter.addWidget(self.image_view_splitter, stretch=1)
 
+        # Tagging dialog, made the first time it's needed and then kept
+        # around so its tag list doesn't have to be rebuilt every time
+        self.tagging_window: Optional['TaggingWindow'] = None
+
         # Toggle fullscreen
         def toggle_fullscreen() -> None:
             if self.thumb_view_container.isHidden():
@@ -200,10 +209,14 @@ class MainWindow(app.RootWindow):
 
         self.thumb_view.mode_changed.connect(thumb_view_mode_change)
 
-        # Settings dialog
-        self.settings_dialog = SettingsWindow(self)
+        # Settings dialog, made the first time it's needed
+        self.settings_dialog: Optional['SettingsWindow'] = None
 
         def show_settings_window() -> None:
+            if self.settings_dialog is None:
+                # Not imported at the top since it's not needed to start up
+                from .settings import SettingsWindow
+                self.settings_dialog = SettingsWindow(self)
             self.settings_dialog.set_up(self.config)
             result = self.settings_dialog.exec_()
             if result == QtWidgets.QDialog.Accepted:
@@ -214,7 +227,7 @@ class MainWindow(app.RootWindow):
                     self.config.update(new_config)
                     self.config.save()
                     if self.settings_dialog.clear_cache:
-                        CACHE.unlink()
+                        self.cache_service.clear()
                     skip_thumb_cache = self.settings_dialog.reset_thumbnails
                     if update_paths:
                         self.index_images(skip_thumb_cache)
@@ -223,7 +236,8 @@ class MainWindow(app.RootWindow):
                     if update_names:
                         count = self.thumb_view.count()
                         for item in self.thumb_view.items():
-                            item.setText(item.path.name if self.config.show_names else '')
+                            item.setText(PATHS.name(item.image_id)
+                                         if self.config.show_names else '')
                         self.thumb_view.update_thumb_size()
 
         cast(Signal0, self.sidebar.settings_button.clicked
@@ -232,9 +246,53 @@ class MainWindow(app.RootWindow):
         cast(Signal0, QtWidgets.QShortcut(QtGui.QKeySequence('Ctrl+T'), self).activated
              ).connect(self.show_tagging_dialog)
 
+        # The cache, which finishes any tag changes that were cut short
+        # last time before anything else gets to see it
+        self.latest_snapshot = 0
+        self.skip_thumb_cache = False
+        self.cache_service = CacheService()
+        self.cache_thread = QtCore.QThread()
+        self.cache_service.moveToThread(self.cache_thread)
+        # Whatever hasn't been saved yet is saved on the cache's own thread
+        # once it stops, and quitting waits for that
+        cast(Signal0, self.cache_thread.finished
+             ).connect(self.cache_service.flush, Qt.DirectConnection)
+
+        def stop_cache_service() -> None:
+            self.cache_thread.quit()
+            self.cache_thread.wait()
+        cast(Signal0, QtWidgets.QApplication.instance().aboutToQuit  # type: ignore
+             ).connect(stop_cache_service)
+        cast(Signal0, self.cache_thread.started).connect(self.cache_service.load)
+        self.cache_service.snapshot_ready.connect(self.snapshot_ready)
+        self.request_snapshot.connect(self.cache_service.request_snapshot)
+        self.cache_thread.start()
+
+        # Tag writing
+        self.pending_writes = 0
+        self.failed_writes = 0
+        # The arguments to index_images for when the writes are done, if
+        # it was called while they were going on
+        self.reload_after_writes: Optional[Tuple[bool, bool]] = None
+        self.tag_writer = TagWriter(self.cache_service)
+        self.tag_writer_thread = QtCore.QThread()
+        cast(Signal0, QtWidgets.QApplication.instance().aboutToQuit  # type: ignore
+             ).connect(self.tag_writer_thread.quit)
+        self.tag_writer.moveToThread(self.tag_writer_thread)
+        self.tag_writer.writes_done.connect(self.tag_writes_done)
+        self.queue_tag_writes.connect(self.tag_writer.write_tags)
+        self.tag_writer_thread.start()
+
         # Reloading
         self.indexing = True
-        self.indexer = Indexer()
+        # Indexing that happens while the cached images are already shown,
+        # which only shows up in the status bar
+        self.background_indexing = False
+        # Images whose tags have been changed since the indexing started
+        self.retagged_while_indexing: Set[int] = set()
+        # The paths the images in the view are from
+        self.shown_paths: Optional[Set[Path]] = None
+        self.indexer = Indexer(self.cache_service)
         self.indexer_thread = QtCore.QThread()
         cast(Signal0, QtWidgets.QApplication.instance().aboutToQuit  # type: ignore
              ).connect(self.indexer_thread.quit)
@@ -250,9 +308,23 @@ class MainWindow(app.RootWindow):
         def reset_progressbar(*args: Any) -> None:
             self.indexer_progressbar.reset()
         self.indexer.done.connect(reset_progressbar)
-        self.indexer.set_text.connect(self.indexer_progressbar.setLabelText)
-        self.indexer.set_value.connect(self.indexer_progressbar.setValue)
-        self.indexer.set_max.connect(self.indexer_progressbar.setMaximum)
+
+        def set_indexer_text(text: str) -> None:
+            if self.background_indexing:
+                self.status_bar.set_index_status(text)
+            else:
+                self.indexer_progressbar.setLabelText(text)
+        self.indexer.set_text.connect(set_indexer_text)
+
+        def set_indexer_value(value: int) -> None:
+            if not self.background_indexing:
+                self.indexer_progressbar.setValue(value)
+        self.indexer.set_value.connect(set_indexer_value)
+
+        def set_indexer_max(value: int) -> None:
+            if not self.background_indexing:
+                self.indexer_progressbar.setMaximum(value)
+        self.indexer.set_max.connect(set_indexer_max)
 
         cast(Signal0, self.sidebar.reload_button.clicked).connect(self.index_images)
 
@@ -265,7 +337,9 @@ class MainWindow(app.RootWindow):
             self.image_view_splitter.setSizes(config.side_splitter)
         self.make_event_filter()
         self.show()
-        self.index_images()
+        # Show what the cache has right away and check for changes after
+        self.load_index(False)
+        self.index_images(background=True)
         self.thumb_view.setFocus()
 
     def resizeEvent(self, event: QtGui.QResizeEvent) -> None:
@@ -277,39 +351,98 @@ class MainWindow(app.RootWindow):
             - self.image_view.minimumSizeHint().width()
         )
 
+    def get_tagging_window(self) -> 'TaggingWindow':
+        if self.tagging_window is None:
+            # Not imported at the top since it's not needed to start up
+            from .tagging_window import TaggingWindow
+            self.tagging_window = TaggingWindow(self)
+            self.tagging_window.set_tags(self.tag_count)
+        return self.tagging_window
+
     def show_tagging_dialog(self) -> None:
-        current_index = self.thumb_view.currentIndex()
-        selected_items = self.thumb_view.selectedItems()
+        selected_items = [item for item in self.thumb_view.selectedItems()
+                          if item.file_format in jfti.TAGGABLE_FORMATS]
         if not selected_items:
             return
-        result = TaggingWindow.get_tag_changes(selected_items, self.tag_count, self)
+        result = self.get_tagging_window().get_tag_changes(
+            selected_items, self.thumb_view.count_tags(selected_items),
+            self.thumb_view.tag_cooccurrence)
         if not result:
             return
-        slider_pos = self.thumb_view.verticalScrollBar().sliderPosition()
-        changes = tag_images(set(self.tag_count.keys()), result, selected_items)
-        if not changes.updated_files:
-            return
-        # Update the cache
-        if not CACHE.exists():
-            logging.error("The cache couldn't be found! This shouldn't happen!")
-            return
-        cache = Cache.load()
-        cache.updated = time.time()
-        for path, tags in changes.updated_files.items():
-            if path not in cache.images:
-                logging.error(f"The image at {path!r} couldn't be found in the cache! "
-                              "This shouldn't happen!")
+        writes = self.set_image_tags(
+            (image, (image.tags | result.tags_to_add) - result.tags_to_remove)
+            for image in selected_items
+        )
+        if writes:
+            self.pending_writes += len(writes)
+            self.status_bar.set_pending_writes(self.pending_writes, self.failed_writes)
+            self.queue_tag_writes.emit(writes)
+
+    def set_image_tags(self, new_tags: Iterable[Tuple[ImageData, FrozenSet[int]]]
+                       ) -> List[TagWrite]:
+        """
+        Change the tags of the images in memory and update everything that
+        depends on them, and return what needs to be written to the files.
+        """
+        writes: List[TagWrite] = []
+        changed_images: List[ImageData] = []
+        tag_count_diff: Counter[int] = Counter()
+        untagged_diff = 0
+        for image, tags in new_tags:
+            old_tags = image.tags
+            if old_tags == tags:
                 continue
-            cache.images[path].tags = list(tags)
-        cache.save()
-        # Update the tag list
-        self.untagged_count += changes.untagged_diff
-        self.tag_count.update(changes.new_tag_count)
-        self.sidebar.tag_list.update_tags(self.untagged_count, changes.new_tag_count,
-                                          changes.created_tags)
+            tag_count_diff.update({t: 1 for t in tags - old_tags})
+            tag_count_diff.update({t: -1 for t in old_tags - tags})
+            if not old_tags:
+                untagged_diff -= 1
+            elif not tags:
+                untagged_diff += 1
+            image.tags = tags
+            changed_images.append(image)
+            if self.indexing:
+                self.retagged_while_indexing.add(image.image_id)
+            writes.append(TagWrite(image.image_id, old_tags, tags))
+        if not writes:
+            return writes
+        current_index = self.thumb_view.currentIndex()
+        slider_pos = self.thumb_view.verticalScrollBar().sliderPosition()
+        created_tags = frozenset(tag for tag, diff in tag_count_diff.items()
+                                 if diff > 0 and self.tag_count[tag] <= 0)
+        self.thumb_view.update_tag_index(changed_images)
+        self.untagged_count += untagged_diff
+        self.tag_count.update(tag_count_diff)
+        self.sidebar.tag_list.update_tags(self.untagged_count, tag_count_diff, created_tags)
+        if self.tagging_window is not None:
+            self.tagging_window.update_tags(tag_count_diff)
         self.update_tag_filter()
         self.thumb_view.setCurrentIndex(current_index)
         self.thumb_view.verticalScrollBar().setSliderPosition(slider_pos)
+        return writes
+
+    def tag_writes_done(self, results: List[Tuple[TagWrite, bool]]) -> None:
+        self.pending_writes -= len(results)
+        failed = [write for write, success in results if not success]
+        if failed:
+            self.failed_writes += len(failed)
+            # Put back the old tags on the images that couldn't be written,
+            # unless they've been changed again since
+            images = {image.image_id: image for image in self.thumb_view.items()}
+            rollback = []
+            for write in failed:
+                image = images.get(write.image_id)
+                if image is not None and image.tags == write.new_tags:
+                    rollback.append((cast(ImageData, image), write.old_tags))
+            self.set_image_tags(rollback)
+        self.status_bar.set_pending_writes(self.pending_writes, self.failed_writes)
+        if not self.pending_writes:
+            # The failures stay on screen until more tags are written, but
+            # only get counted against the writes they were a part of
+            self.failed_writes = 0
+        if not self.pending_writes and self.reload_after_writes is not None:
+            skip_thumb_cache, background = self.reload_after_writes
+            self.reload_after_writes = None
+            self.index_images(skip_thumb_cache, background)
 
     def make_event_filter(self) -> None:
         class MainWindowEventFilter(QtCore.QObject):
@@ -324,18 +457,80 @@ class MainWindow(app.RootWindow):
         self.close_filter = MainWindowEventFilter()
         self.installEventFilter(self.close_filter)
 
-    def index_images(self, skip_thumb_cache: bool = False) -> None:
+    def index_images(self, skip_thumb_cache: bool = False, background: bool = False) -> None:
+        if self.pending_writes:
+            # The cache is behind until the writes are done
+            if self.reload_after_writes is not None:
+                # Anything that was asked for by either call still happens
+                skip_thumb_cache = skip_thumb_cache or self.reload_after_writes[0]
+                background = background and self.reload_after_writes[1]
+            self.reload_after_writes = (skip_thumb_cache, background)
+            return
         self.indexing = True
+        self.background_indexing = background
+        self.retagged_while_indexing.clear()
+        if background:
+            self.status_bar.set_index_status('Checking for changes...')
         self.start_indexing.emit(self.config.active_paths, skip_thumb_cache)
 
     def load_index(self, skip_thumb_cache: bool) -> None:
         self.indexing = False
+        self.background_indexing = False
         self.indexer_progressbar.accept()
-        result = self.thumb_view.load_index(skip_thumb_cache)
-        if result is not None:
-            self.untagged_count, self.tag_count = result
-            self.sidebar.tag_list.set_tags(self.untagged_count, self.tag_count)
+        self.status_bar.set_index_status('')
+        # The cache service sorts out the images on its own thread and the
+        # rest happens in snapshot_ready
+        self.latest_snapshot += 1
+        self.skip_thumb_cache = self.skip_thumb_cache or skip_thumb_cache
+        self.request_snapshot.emit(self.latest_snapshot, self.config.active_paths)
+
+    def snapshot_ready(self, request_id: int,
+                       entries: List[Tuple[int, CachedImageData]]) -> None:
+        if request_id != self.latest_snapshot:
+            return
+        skip_thumb_cache = self.skip_thumb_cache
+        self.skip_thumb_cache = False
+        if self.shown_paths == self.config.active_paths and not skip_thumb_cache:
+            self.refresh_index(entries)
+            return
+        self.shown_paths = set(self.config.active_paths)
+        self.image_view.image_cache.clear()
+        self.image_view.full_sizes.clear()
+        self.image_view.tile_cache.clear()
+        self.untagged_count, self.tag_count = \
+            self.thumb_view.load_index(entries, skip_thumb_cache)
+        self.sidebar.tag_list.set_tags(self.untagged_count, self.tag_count)
+        if self.tagging_window is not None:
+            self.tagging_window.set_tags(self.tag_count)
         self.sidebar.dir_tree.update_paths(self.config.active_paths)
+        if not entries:
+            # There won't be a first thumbnail to wait for
+            STARTUP_PROFILE.finish('empty view shown')
+
+    def refresh_index(self, entries: List[Tuple[int, CachedImageData]]) -> None:
+        """
+        Update the images already in the view with what the indexer found,
+        instead of loading them all over again.
+        """
+        counts = self.thumb_view.refresh_index(entries, self.retagged_while_indexing)
+        self.retagged_while_indexing.clear()
+        if counts is None:
+            return
+        current_index = QtCore.QPersistentModelIndex(self.thumb_view.currentIndex())
+        slider_pos = self.thumb_view.verticalScrollBar().sliderPosition()
+        old_tag_count = self.tag_count
+        self.untagged_count, self.tag_count = counts
+        tag_count_diff = Counter(self.tag_count)
+        tag_count_diff.subtract(old_tag_count)
+        created_tags = frozenset(tag for tag in self.tag_count if old_tag_count[tag] <= 0)
+        self.sidebar.tag_list.update_tags(self.untagged_count, tag_count_diff, created_tags)
+        if self.tagging_window is not None:
+            self.tagging_window.update_tags(tag_count_diff)
+        self.sidebar.dir_tree.update_paths(self.config.active_paths)
+        self.update_tag_filter()
+        if current_index.isValid():
+            self.thumb_view.setCurrentIndex(QtCore.QModelIndex(current_index))
+        self.thumb_view.verticalScrollBar().setSliderPosition(slider_pos)
 
     def update_tag_filter(self) -> None:
         self.thumb_view.set_tag_filter(self.sidebar.tag_list.get_tag_states())
@@ -347,55 +542,6 @@ class MainWindow(app.RootWindow):
             self.image_view.setPixmap(None)
 
 
-class TagUpdateResult(NamedTuple):
-    untagged_diff: int
-    updated_files: Dict[Path, Set[str]]
-    new_tag_count: Counter[str]
-    created_tags: FrozenSet[str]
-
-
-def tag_images(original_tags: Set[str], changes: TagChanges,
-               images: List[ImageData]) -> TagUpdateResult:
-    # Progress dialog
-    progress_dialog = QtWidgets.QProgressDialog(
-        'Tagging images...', 'Cancel', 0, len(images))
-    progress_dialog.setWindowModality(Qt.WindowModal)
-    progress_dialog.setMinimumDuration(0)
-    # Info about the data we're working with
-    total = len(images)
-    created_tags = changes.tags_to_add - original_tags
-    # Info about the changes
-    new_tag_count: Counter[str] = Counter()
-    untagged_diff = 0
-    updated_files = {}
-    # Tag the files
-    for n, image in enumerate(images):
-        progress_dialog.setLabelText(f'Tagging images... ({n}/{total})')
-        progress_dialog.setValue(n)
-        old_tags = image.tags
-        new_tags = (old_tags | changes.tags_to_add) - changes.tags_to_remove
-        if old_tags != new_tags:
-            added_tags = new_tags - old_tags
-            removed_tags = old_tags - new_tags
-            new_tag_count.update({t: 1 for t in added_tags})
-            new_tag_count.update({t: -1 for t in removed_tags})
-            try:
-                jfti.set_tags(image.path, new_tags)
-            except Exception:
-                logging.exception(f'failed to set tags {new_tags!r} in {image.path!r}')
-                raise
-            image.tags = new_tags
-            updated_files[image.path] = new_tags
-            if not old_tags and new_tags:
-                untagged_diff -= 1
-            elif old_tags and not new_tags:
-                untagged_diff += 1
-        if progress_dialog.wasCanceled():
-            break
-    progress_dialog.setValue(total)
-    return TagUpdateResult(untagged_diff, updated_files, new_tag_count, created_tags)
-
-
 def main() -> int:
     import argparse
     parser = argparse.ArgumentParser()
@@ -403,9 +549,28 @@ def main() -> int:
                         metavar='path', type=Path,
                         help='Use these paths instead of the settings')
     parser.add_argument('--auto-refresh-css', action='store_true')
+    parser.add_argument('--export-cache', metavar='path', type=Path,
+                        help='Write the cache to this path as JSON and quit')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='Print how long each part of starting up takes')
+    parser.add_argument('--trace', metavar='path', type=Path,
+                        help='Time the indexing and thumbnail stages and write '
+                             'them to this path as a Chrome trace when quitting')
     logging.basicConfig()
 
     args = parser.parse_args()
+    if args.profile_startup:
+        STARTUP_PROFILE.enable()
+    if args.trace is not None:
+        TRACE.enable()
+
+    if args.export_cache is not None:
+        try:
+            cache = Cache.load()
+        except FileNotFoundError:
+            parser.error('there is no cache to export')
+        cache.export_json(args.export_cache)
+        return 0
 
     app = QtWidgets.QApplication(sys.argv)
 
@@ -425,10 +590,15 @@ def main() -> int:
             app.setStyleSheet(CSS_FILE.read_text())
         event_filter.activation_event.connect(refresh_css)
     paths: List[Path] = args.paths
-    config = Settings.load(paths)
-    window = MainWindow(config)
+    with STARTUP_PROFILE.phase('Settings.load'):
+        config = Settings.load(paths)
+    with STARTUP_PROFILE.phase('widget construction'):
+        window = MainWindow(config)
     app.setActiveWindow(window)
-    sys.exit(app.exec_())
+    exit_code = app.exec_()
+    if args.trace is not None:
+        TRACE.save(args.trace)
+    sys.exit(exit_code)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,79 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List
+
+
+class Trace:
+    """
+    Timing spans and counters for the indexing and thumbnail pipelines,
+    for --trace.
+
+    The events are saved in the Chrome trace event format, so a trace
+    can be opened in chrome://tracing or Perfetto to see which stage a
+    slow reload spent its time in. Nothing is recorded unless the trace
+    has been enabled.
+    """
+    def __init__(self) -> None:
+        self.enabled = False
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+        self._events: List[Dict[str, Any]] = []
+        self._counters: Dict[str, int] = {}
+        self._threads: Dict[int, str] = {}
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def _timestamp(self, t: float) -> float:
+        # In microseconds, which is what the format wants
+        return (t - self.started) * 1_000_000
+
+    def _add(self, event: Dict[str, Any]) -> None:
+        # Called with the lock held
+        thread_id = threading.get_ident()
+        if thread_id not in self._threads:
+            self._threads[thread_id] = threading.current_thread().name
+        event['pid'] = os.getpid()
+        event['tid'] = thread_id
+        self._events.append(event)
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        """Time a block, or every call to a function when used as a decorator."""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self._lock:
+                self._add({'name': name, 'ph': 'X', 'ts': self._timestamp(start),
+                           'dur': self._timestamp(end) - self._timestamp(start)})
+
+    def count(self, name: str, amount: int = 1) -> None:
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        with self._lock:
+            value = self._counters.get(name, 0) + amount
+            self._counters[name] = value
+            self._add({'name': name, 'ph': 'C', 'ts': self._timestamp(now),
+                       'args': {'value': value}})
+
+    def save(self, path: Path) -> None:
+        with self._lock:
+            events = list(self._events)
+            events.extend({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(),
+                           'tid': thread_id, 'args': {'name': thread_name}}
+                          for thread_id, thread_name in self._threads.items())
+        with path.open('w', encoding='utf-8') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+TRACE = Trace()